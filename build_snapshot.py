@@ -0,0 +1,190 @@
+"""
+Compila os arquivos data/*_static.json em um snapshot binário (data/snapshot/),
+junto com o grafo de vizinhança derivado do GeoJSON combinado dos municípios
+
+Uso:
+    python build_snapshot.py              # gera/atualiza o snapshot
+    python build_snapshot.py --benchmark  # compara o tempo de carga JSON x snapshot
+    python build_snapshot.py --memory     # compara a memória residente por worker
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from dataset_engine import DatasetEngine, SNAPSHOT_DIR, snapshot_status, source_fingerprints
+from municipality_graph import GEOJSON_FILE, build_graph
+
+DATA_DIR = 'data'
+
+
+def publish_snapshot(snapshot_dir, generation):
+    """Aponta data/snapshot para a geração nova sem nenhum instante sem snapshot; retorna a anterior (ou None)
+
+    data/snapshot é um link simbólico trocado com os.replace (atômico). Um snapshot antigo em
+    diretório comum sai do caminho uma única vez; sem suporte a links, a troca é por dois renames.
+    """
+    data_dir = os.path.dirname(snapshot_dir)
+    previous = None
+    if os.path.islink(snapshot_dir):
+        previous = os.path.join(data_dir, os.readlink(snapshot_dir))
+    elif os.path.isdir(snapshot_dir):
+        previous = f'{snapshot_dir}.old.{os.getpid()}'
+        os.rename(snapshot_dir, previous)
+
+    link = f'{snapshot_dir}.link.{os.getpid()}'
+    try:
+        os.symlink(generation, link, target_is_directory=True)
+    except (OSError, NotImplementedError):
+        os.rename(os.path.join(data_dir, generation), snapshot_dir)
+        return previous
+    os.replace(link, snapshot_dir)
+    return previous
+
+
+def build_snapshot(data_dir=DATA_DIR):
+    """Carrega os JSON e grava o snapshot em um diretório novo, publicado no final por troca atômica do link"""
+    snapshot_dir = os.path.join(data_dir, SNAPSHOT_DIR)
+
+    fingerprints = source_fingerprints(data_dir)
+    start = time.perf_counter()
+    engine = DatasetEngine.from_json(data_dir)
+    print(f"JSON carregado em {time.perf_counter() - start:.2f}s")
+
+    # Grafo de vizinhança a partir do GeoJSON combinado (combine_geojson.py), se disponível
+    if os.path.exists(GEOJSON_FILE):
+        try:
+            start = time.perf_counter()
+            engine.graph = build_graph(engine.index, GEOJSON_FILE)
+            print(f"Grafo de vizinhança: {engine.graph.edges} divisas em {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            print(f"Erro ao gerar o grafo de vizinhança a partir de {GEOJSON_FILE}: {e}")
+    else:
+        print(f"{GEOJSON_FILE} não encontrado (rode combine_geojson.py); snapshot sem grafo de vizinhança")
+
+    # Diretório novo e de nome único por build (legível pelos workers, como os anteriores)
+    generation_dir = tempfile.mkdtemp(prefix=SNAPSHOT_DIR + '.', dir=data_dir)
+    os.chmod(generation_dir, 0o755)
+    generation = os.path.basename(generation_dir)
+    engine.to_snapshot(generation_dir, source_files=fingerprints)
+
+    # Só depois da troca o snapshot anterior é apagado (e não sobrescrito): workers em
+    # execução mantêm os arquivos antigos mapeados até reiniciarem
+    previous = publish_snapshot(snapshot_dir, generation)
+    if previous is not None and os.path.isdir(previous) and \
+            os.path.realpath(previous) != os.path.realpath(generation_dir):
+        shutil.rmtree(previous)
+    # Gerações de builds interrompidos antes da troca
+    for name in os.listdir(data_dir):
+        path = os.path.join(data_dir, name)
+        if name.startswith(SNAPSHOT_DIR + '.') and name != generation and not os.path.islink(path) \
+                and os.path.isdir(path):
+            shutil.rmtree(path)
+
+    size = sum(os.path.getsize(os.path.join(snapshot_dir, name)) for name in os.listdir(snapshot_dir))
+    print(f"Snapshot gravado em {snapshot_dir} ({len(engine.index)} municípios, {size / 1024 / 1024:.1f} MB)")
+
+
+def _time_loader(loader, data_dir, runs):
+    """Tempo de carga em processos novos (inclui import do numpy, como no start de um worker)"""
+    code = (
+        "import sys, time; start = time.perf_counter(); "
+        "from dataset_engine import DatasetEngine; "
+        f"DatasetEngine.{loader}(sys.argv[1]); "
+        "print(time.perf_counter() - start)"
+    )
+    target = os.path.abspath(data_dir if loader == 'from_json' else os.path.join(data_dir, SNAPSHOT_DIR))
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code, target], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+    return min(timings), sum(timings) / len(timings)
+
+
+def benchmark(data_dir=DATA_DIR, runs=5):
+    """Compara o tempo de inicialização com JSON e com o snapshot"""
+    status = snapshot_status(data_dir)
+    if status is not None:
+        print(f"Snapshot desatualizado ({status}), gerando antes do benchmark")
+        build_snapshot(data_dir)
+
+    print(f"Benchmark de inicialização ({runs} execuções cada)")
+    results = {}
+    for loader in ('from_json', 'from_snapshot'):
+        best, mean = _time_loader(loader, data_dir, runs)
+        results[loader] = best
+        print(f"  {loader:<14} melhor {best * 1000:8.1f} ms   média {mean * 1000:8.1f} ms")
+    print(f"  Ganho: {results['from_json'] / max(results['from_snapshot'], 1e-9):.1f}x")
+
+
+# Carrega os dados de um jeito e imprime a memória residente (total e compartilhada) acrescida
+_MEMORY_PROBE = """
+import json, os, sys
+import numpy as np
+from dataset_engine import DATA_SOURCES, DatasetEngine, SNAPSHOT_DIR
+
+def statm():
+    with open('/proc/self/statm') as f:
+        fields = f.read().split()
+    page = os.sysconf('SC_PAGE_SIZE')
+    return int(fields[1]) * page, int(fields[2]) * page
+
+mode, data_dir = sys.argv[1], sys.argv[2]
+before_rss, before_shared = statm()
+if mode == 'dicts':
+    data = {}
+    for source, (filename, _, _) in DATA_SOURCES.items():
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data[source] = json.load(f)
+else:
+    engine = DatasetEngine.from_json(data_dir) if mode == 'json' else \
+        DatasetEngine.from_snapshot(os.path.join(data_dir, SNAPSHOT_DIR))
+    # Tocar todas as páginas, como um worker depois de atender requisições
+    for dataset in engine.sources.values():
+        float(np.asarray(dataset.values).sum()); int(np.asarray(dataset.present).sum())
+rss, shared = statm()
+print(rss - before_rss, shared - before_shared)
+"""
+
+
+def memory_report(data_dir=DATA_DIR):
+    """Memória residente por worker: dicts JSON (formato antigo) x matrizes (JSON) x snapshot (mmap)"""
+    if not os.path.exists('/proc/self/statm'):
+        print("Relatório de memória disponível apenas no Linux (/proc/self/statm)")
+        return
+    status = snapshot_status(data_dir)
+    if status is not None:
+        print(f"Snapshot desatualizado ({status}), gerando antes do relatório")
+        build_snapshot(data_dir)
+
+    labels = {
+        'dicts': 'dicts JSON (antigo)',
+        'json': 'matrizes via JSON',
+        'snapshot': 'snapshot (mmap)'
+    }
+    print("Memória residente acrescida pelos dados, por worker")
+    baseline = None
+    for mode, label in labels.items():
+        output = subprocess.run([sys.executable, '-c', _MEMORY_PROBE, mode, os.path.abspath(data_dir)],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        rss, shared = (int(value) for value in output.stdout.strip().splitlines()[-1].split())
+        private = rss - shared
+        baseline = baseline or private
+        print(f"  {label:<20} RSS {rss / 1024 / 1024:7.1f} MB   privada {private / 1024 / 1024:7.1f} MB"
+              f"   ({private / max(baseline, 1) * 100:5.1f}% do formato antigo)")
+    print("  Páginas compartilhadas do snapshot são contadas uma única vez entre workers (page cache)")
+
+
+if __name__ == "__main__":
+    if '--benchmark' in sys.argv:
+        benchmark()
+    elif '--memory' in sys.argv:
+        memory_report()
+    else:
+        build_snapshot()
@@ -0,0 +1,69 @@
+"""
+Comparação de N séries (fonte, categoria) sobre os municípios em comum
+
+As séries são colunas das matrizes dos datasets; o conjunto comum é a interseção
+dos municípios válidos de cada uma (os mesmos dos rankings). Correlações de
+Pearson e Spearman saem de uma única np.corrcoef sobre a matriz alinhada.
+"""
+import numpy as np
+
+
+def average_ranks(values):
+    """Ranks 1..n com empates recebendo a média dos ranks (como scipy.stats.rankdata)"""
+    sorter = np.argsort(values, kind='mergesort')
+    inverse = np.empty(len(values), dtype=np.intp)
+    inverse[sorter] = np.arange(len(values))
+    ordered = values[sorter]
+    starts = np.r_[True, ordered[1:] != ordered[:-1]]
+    dense = starts.cumsum()[inverse]
+    bounds = np.r_[np.flatnonzero(starts), len(values)]
+    return 0.5 * (bounds[dense] + bounds[dense - 1] + 1)
+
+
+def correlation_matrix(matrix):
+    """Matriz de correlação (séries nas linhas); None onde a série é constante"""
+    if matrix.shape[1] < 2:
+        return [[None] * len(matrix) for _ in range(len(matrix))]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlations = np.atleast_2d(np.corrcoef(matrix))
+    return [[float(value) if np.isfinite(value) else None for value in row] for row in correlations]
+
+
+def compare_series(engine, rankings, series, state=None):
+    """Vetores alinhados, razões e correlações de várias séries nos municípios comuns a todas"""
+    registry = engine.index
+    common = np.ones(len(registry), dtype=bool)
+    for source, category in series:
+        common &= rankings.rankings[(source, category)].rank >= 0
+    if state:
+        common &= np.asarray(registry.states, dtype=str) == state
+    positions = np.flatnonzero(common)
+
+    datasets = [engine[source] for source, _ in series]
+    matrix = np.vstack([dataset.values[positions, dataset.category_index[category]]
+                        for dataset, (_, category) in zip(datasets, series)]) \
+        if series else np.empty((0, len(positions)))
+    reference = np.maximum(matrix[0], 1) if len(series) else None
+
+    return {
+        'common_municipalities': len(positions),
+        'municipalities': {
+            'codes': [registry.codes[position] for position in positions.tolist()],
+            'names': registry.names[positions].tolist(),
+            'states': registry.states[positions].tolist()
+        },
+        'series': [{
+            'source': source,
+            'category': category,
+            'unit': dataset.units[dataset.category_index[category]],
+            'total': dataset.as_number(row.sum(), [category]),
+            'values': dataset.python_values(category, positions),
+            # Razão em relação à primeira série (mesma regra da comparação de duas culturas)
+            'ratio_to_first': (row / reference).tolist()
+        } for dataset, (source, category), row in zip(datasets, series, matrix)],
+        'correlations': {
+            'pearson': correlation_matrix(matrix),
+            'spearman': correlation_matrix(np.array([average_ranks(row) for row in matrix])
+                                           if len(series) else matrix)
+        }
+    }
@@ -0,0 +1,614 @@
+"""
+Motor de datasets colunares para as bases estáticas (data/*_static.json)
+
+Cada fonte é mantida como uma matriz densa (município × categoria) de floats,
+com um índice de municípios compartilhado entre todas as fontes e um índice
+de categorias por fonte. Consultas territoriais viram gathers e somas em
+arrays em vez de laços Python sobre dicionários aninhados. Nome, UF e região
+de cada município ficam uma única vez no cadastro canônico (MunicipalityRegistry);
+as fontes guardam apenas valores numéricos indexados pelas posições do cadastro.
+
+As matrizes podem ser compiladas offline em um snapshot binário (build_snapshot.py):
+arquivos .npy abertos com mmap, compartilhados entre workers pelo page cache do SO.
+O grafo de vizinhança dos municípios (municipality_graph.py), quando gerado, é
+gravado no mesmo snapshot.
+"""
+import hashlib
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+
+from municipality_graph import MunicipalityGraph
+
+# Fontes estáticas: chave -> (arquivo em data/, campo de valor, rótulo para log)
+DATA_SOURCES = {
+    'crops': ('crop_data_static.json', 'harvested_area', 'crop'),
+    'fertilizers': ('fertilizer_data_static_corrigido.json', 'value', 'fertilizer'),
+    'agrotoxico': ('agrotoxico_data_static.json', 'value', 'agrotoxico'),
+    'consultoria': ('consultoria_tecnica_data_static.json', 'value', 'consultoria tecnica'),
+    'corretivos': ('corretivos_data_static.json', 'value', 'corretivos'),
+    'despesa': ('despesa_data_static.json', 'value', 'despesa'),
+    'escolaridade': ('escolaridade_data_static.json', 'value', 'escolaridade'),
+    'receita': ('receita_data_static.json', 'value', 'receita'),
+}
+
+# Arquivo opcional em data/ com {código: {"mesorregiao": ..., "microrregiao": ...}}
+REGIONS_FILE = 'municipios_regioes.json'
+
+# Região geográfica pelo primeiro dígito do código IBGE
+REGIONS_BY_DIGIT = {
+    '1': 'Norte', '2': 'Nordeste', '3': 'Sudeste', '4': 'Sul', '5': 'Centro-Oeste'
+}
+
+# UF pelos dois primeiros dígitos do código IBGE (usado quando a fonte não informa)
+UF_BY_CODE = {
+    '11': 'RO', '12': 'AC', '13': 'AM', '14': 'RR', '15': 'PA', '16': 'AP', '17': 'TO',
+    '21': 'MA', '22': 'PI', '23': 'CE', '24': 'RN', '25': 'PB', '26': 'PE', '27': 'AL',
+    '28': 'SE', '29': 'BA', '31': 'MG', '32': 'ES', '33': 'RJ', '35': 'SP', '41': 'PR',
+    '42': 'SC', '43': 'RS', '50': 'MS', '51': 'MT', '52': 'GO', '53': 'DF'
+}
+
+# Versão do formato do snapshot binário; incrementar ao mudar o layout dos arquivos
+SNAPSHOT_VERSION = 4
+SNAPSHOT_DIR = 'snapshot'
+SNAPSHOT_MANIFEST = 'manifest.json'
+
+# Palavras que indicam regiões/agregações em vez de municípios
+REGION_KEYWORDS = [
+    'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul',
+    'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
+    'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
+    'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
+]
+
+# Nomes muito genéricos ou que são claramente regiões
+EXCLUDED_REGION_NAMES = [
+    'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
+    'dourados', 'norte mato-grossense', 'portal da amazônia'
+]
+
+# Bits da classificação de cada linha do eixo de municípios
+MUNICIPALITY_CODE = 1    # código IBGE de município (7 dígitos, iniciando em 1-5) com nome
+NO_REGION_KEYWORD = 2    # nome sem palavras de região/agregação
+NOT_EXCLUDED_NAME = 4    # nome fora da lista de regiões conhecidas
+ALL_VALID = MUNICIPALITY_CODE | NO_REGION_KEYWORD | NOT_EXCLUDED_NAME
+
+
+def content_hash(*parts):
+    """Hash curto e estável do conteúdo (arrays, listas e strings) usado como versão dos dados"""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray) and part.dtype != object:
+            digest.update(str(part.dtype).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps([str(item) for item in part] if isinstance(part, np.ndarray) else part,
+                                     ensure_ascii=False).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:16]
+
+
+def classify_municipalities(codes, names):
+    """Bitmask de validade por linha, calculada uma vez na carga"""
+    flags = np.zeros(len(codes), dtype=np.uint8)
+    for i, (code, name) in enumerate(zip(codes, names)):
+        name = str(name)
+        if len(code) == 7 and code.isdigit() and code[0] in '12345' and name:
+            flags[i] |= MUNICIPALITY_CODE
+        name_lower = name.lower()
+        if not any(keyword in name_lower for keyword in REGION_KEYWORDS):
+            flags[i] |= NO_REGION_KEYWORD
+        if name_lower not in EXCLUDED_REGION_NAMES:
+            flags[i] |= NOT_EXCLUDED_NAME
+    return flags
+
+
+def aggregate_kind(code):
+    """Tipo de uma linha que não é município (pela forma do código IBGE)"""
+    if set(code) == {'0'}:
+        return 'nacional'
+    if len(code) == 7 and code.isdigit() and code.startswith('0'):
+        return 'agregado'
+    if code.isdigit() and len(code) == 1:
+        return 'regiao'
+    if code.isdigit() and len(code) == 2:
+        return 'uf'
+    if code.isdigit() and len(code) in (4, 5):
+        return 'meso_microrregiao'
+    return 'outro'
+
+
+def name_flags(flag):
+    """Critérios de nome que um município (código válido) não atende"""
+    flags = []
+    if not flag & NO_REGION_KEYWORD:
+        flags.append('region_keyword')
+    if not flag & NOT_EXCLUDED_NAME:
+        flags.append('excluded_name')
+    return flags
+
+
+class MunicipalityRegistry:
+    """Cadastro canônico código IBGE -> posição, nome, UF, região e meso/microrregião"""
+
+    def __init__(self, codes, names=None, states=None, mesoregions=None, microregions=None, flags=None,
+                 version=None):
+        self.codes = list(codes)
+        self.positions = {code: i for i, code in enumerate(self.codes)}
+        empty = np.array([''] * len(self.codes), dtype=object)
+        self.names = names if names is not None else empty
+        self.states = states if states is not None else empty
+        self.regions = np.array([REGIONS_BY_DIGIT.get(code[:1], '') if len(code) == 7 else ''
+                                 for code in self.codes], dtype=object)
+        self.mesoregions = mesoregions if mesoregions is not None else empty
+        self.microregions = microregions if microregions is not None else empty
+        # Classificação de validade por linha (bits MUNICIPALITY_CODE | NO_REGION_KEYWORD | NOT_EXCLUDED_NAME)
+        self.flags = flags if flags is not None else classify_municipalities(self.codes, self.names)
+        self._valid_masks = {}
+        self.version = version or content_hash(self.codes, self.names, self.states,
+                                               self.mesoregions, self.microregions)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return str(code) in self.positions
+
+    def position(self, code):
+        """Posição de um código (-1 se desconhecido)"""
+        return self.positions.get(str(code), -1)
+
+    def resolve(self, codes):
+        """Converte uma lista de códigos em posições, mantendo ordem e duplicatas (-1 = desconhecido)"""
+        return np.fromiter((self.positions.get(str(code), -1) for code in codes),
+                           dtype=np.int64, count=len(codes))
+
+    def lookup(self, code):
+        """Dados cadastrais de um município (None se o código não consta em nenhuma fonte)"""
+        position = self.position(code)
+        if position < 0:
+            return None
+        return {
+            'code': self.codes[position],
+            'name': str(self.names[position]),
+            'state': str(self.states[position]),
+            'region': str(self.regions[position]),
+            'mesoregion': str(self.mesoregions[position]),
+            'microregion': str(self.microregions[position])
+        }
+
+    def valid_mask(self, check_keywords=True, check_excluded_names=True):
+        """Máscara booleana das linhas que são municípios válidos segundo os critérios pedidos"""
+        required = MUNICIPALITY_CODE
+        if check_keywords:
+            required |= NO_REGION_KEYWORD
+        if check_excluded_names:
+            required |= NOT_EXCLUDED_NAME
+        if required not in self._valid_masks:
+            self._valid_masks[required] = (self.flags & required) == required
+        return self._valid_masks[required]
+
+
+class ColumnarDataset:
+    """Uma fonte de dados como matriz densa (município × categoria)"""
+
+    def __init__(self, name, value_field, index, categories, values, present,
+                 integral, units, version=None):
+        self.name = name
+        self.value_field = value_field
+        self.index = index
+        self.categories = list(categories)
+        self.category_index = {category: j for j, category in enumerate(self.categories)}
+        self.values = values        # float64 (municípios × categorias), 0 onde ausente
+        self.present = present      # bool (municípios × categorias)
+        self.integral = integral    # bool por categoria: todos os valores originais eram inteiros
+        self.units = units          # unidade por categoria (None se o JSON não informa)
+        self.aggregates = AggregateTable(self)
+        # Versão do conteúdo (inclui o cadastro, pois nomes e UFs fazem parte das respostas)
+        self.version = version or content_hash(index.version, name, value_field, self.categories, units,
+                                               np.asarray(integral), np.asarray(values), np.asarray(present))
+
+    @property
+    def names(self):
+        return self.index.names
+
+    @property
+    def states(self):
+        return self.index.states
+
+    @property
+    def flags(self):
+        return self.index.flags
+
+    def __contains__(self, category):
+        return category in self.category_index
+
+    def __len__(self):
+        return len(self.categories)
+
+    def column(self, category):
+        """Vetor de valores de uma categoria sobre todo o eixo de municípios"""
+        return self.values[:, self.category_index[category]]
+
+    def rows(self, category):
+        """Posições dos municípios presentes em uma categoria"""
+        return np.flatnonzero(self.present[:, self.category_index[category]])
+
+    def valid_mask(self, check_keywords=True, check_excluded_names=True):
+        """Máscara de municípios válidos do cadastro"""
+        return self.index.valid_mask(check_keywords, check_excluded_names)
+
+    def municipality_rows(self):
+        """Posições dos municípios presentes em ao menos uma categoria"""
+        return np.flatnonzero(self.present.any(axis=1))
+
+    def python_values(self, category, positions):
+        """Valores de uma categoria como números Python (int quando o JSON original era inteiro)"""
+        j = self.category_index[category]
+        column = self.values[positions, j]
+        if self.integral[j]:
+            return column.astype(np.int64).tolist()
+        return column.tolist()
+
+    def as_number(self, value, categories=None):
+        """Converte um agregado numpy para int/float Python conforme as categorias somadas"""
+        if categories is None:
+            integral = bool(self.integral.all()) if len(self.integral) else True
+        else:
+            integral = all(self.integral[self.category_index[c]] for c in categories)
+        return int(round(float(value))) if integral else float(value)
+
+    def records(self, category, positions=None, value_field=None, default_unit=None, fields=None):
+        """Materializa {código: registro} no formato dos arquivos JSON originais
+
+        fields restringe os campos de cada registro (ex.: ['harvested_area'] ou ['value', 'state_code']).
+        """
+        j = self.category_index[category]
+        if positions is None:
+            positions = self.rows(category)
+        value_field = value_field or self.value_field
+        unit = self.units[j] if self.units[j] is not None else default_unit
+        codes = self.index.codes
+        include = (lambda field: True) if fields is None else (lambda field: field in fields)
+        include_name, include_state = include('municipality_name'), include('state_code')
+        include_value, include_unit = include(value_field), include('unit') and unit is not None
+        names = self.names[positions].tolist() if include_name else None
+        states = self.states[positions].tolist() if include_state else None
+        values = self.python_values(category, positions)
+        result = {}
+        for i, position in enumerate(positions.tolist()):
+            record = {}
+            if include_name:
+                record['municipality_name'] = names[i]
+            if include_state:
+                record['state_code'] = states[i]
+            if include_value:
+                record[value_field] = values[i]
+            if include_unit:
+                record['unit'] = unit
+            result[codes[position]] = record
+        return result
+
+    def columnar(self, category, positions=None, default_unit=None, fields=None):
+        """Formato compacto: arrays paralelos de códigos e valores e uma única unidade
+
+        Nomes e UFs só entram (como arrays paralelos) se pedidos em fields; o normal é
+        o cliente obtê-los uma vez pelo cadastro de municípios.
+        """
+        j = self.category_index[category]
+        if positions is None:
+            positions = self.rows(category)
+        codes = self.index.codes
+        payload = {
+            'codes': [codes[position] for position in positions.tolist()],
+            'values': self.python_values(category, positions),
+            'unit': self.units[j] if self.units[j] is not None else default_unit,
+            'registry_version': self.index.version
+        }
+        if fields is not None and 'municipality_name' in fields:
+            payload['municipality_name'] = self.names[positions].tolist()
+        if fields is not None and 'state_code' in fields:
+            payload['state_code'] = self.states[positions].tolist()
+        return payload
+
+    def float32_layer(self, category, positions=None):
+        """Valores da categoria como Float32 little-endian na ordem do cadastro (NaN fora de positions)"""
+        j = self.category_index[category]
+        if positions is None:
+            positions = self.rows(category)
+        layer = np.full(len(self.index), np.nan, dtype='<f4')
+        layer[positions] = self.values[positions, j]
+        return layer.tobytes()
+
+    def territory_totals(self, positions):
+        """Soma e contagem de presença por categoria para um conjunto de posições"""
+        if len(positions) == 0:
+            return np.zeros(len(self.categories)), np.zeros(len(self.categories), dtype=np.int64)
+        return self.values[positions].sum(axis=0), self.present[positions].sum(axis=0)
+
+
+class AggregateTable:
+    """Linhas de agregação regional (Brasil, regiões, UFs, meso/microrregiões) de uma fonte
+
+    Só linhas sem código de município entram como agregações; municípios cujo nome cai na
+    heurística de palavras de região ficam à parte (flagged), sem serem tratados como agregados.
+    """
+
+    def __init__(self, dataset):
+        with_data = dataset.present.any(axis=1) if dataset.present.shape[1] else np.zeros(len(dataset.flags), dtype=bool)
+        self.dataset = dataset
+        municipality = (dataset.flags & MUNICIPALITY_CODE) != 0
+        self.positions = np.flatnonzero(with_data & ~municipality)
+        self.codes = [dataset.index.codes[position] for position in self.positions.tolist()]
+        self.kinds = [aggregate_kind(code) for code in self.codes]
+        self.lookup = {code: i for i, code in enumerate(self.codes)}
+        self.flagged_positions = np.flatnonzero(with_data & municipality & (dataset.flags != ALL_VALID))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return str(code) in self.lookup
+
+    def records(self, category, kind=None):
+        """Registros {código: registro} das agregações presentes em uma categoria"""
+        dataset = self.dataset
+        j = dataset.category_index[category]
+        selected = [(position, row_kind) for position, row_kind in zip(self.positions.tolist(), self.kinds)
+                    if dataset.present[position, j] and (kind is None or row_kind == kind)]
+        positions = np.array([position for position, _ in selected], dtype=np.int64)
+        result = dataset.records(category, positions)
+        for (position, row_kind) in selected:
+            result[dataset.index.codes[position]]['kind'] = row_kind
+        return result
+
+    def flagged_records(self, category):
+        """Registros {código: registro} dos municípios sinalizados pela heurística de nomes, com os critérios ('flags')"""
+        dataset = self.dataset
+        j = dataset.category_index[category]
+        positions = self.flagged_positions[dataset.present[self.flagged_positions, j]]
+        result = dataset.records(category, positions)
+        for position in positions.tolist():
+            result[dataset.index.codes[position]]['flags'] = name_flags(int(dataset.flags[position]))
+        return result
+
+
+class DatasetEngine:
+    """Conjunto das fontes estáticas sobre um índice de municípios compartilhado"""
+
+    def __init__(self, index, sources, last_modified=None, graph=None):
+        self.index = index          # MunicipalityRegistry compartilhado por todas as fontes
+        self.sources = sources
+        self.last_modified = last_modified  # data da última alteração dos arquivos de origem (UTC)
+        self.graph = graph          # MunicipalityGraph do snapshot (None se não foi gerado)
+
+    def __getitem__(self, source):
+        return self.sources[source]
+
+    def __contains__(self, source):
+        return source in self.sources
+
+    def resolve(self, codes):
+        """Posições válidas (conhecidas) de uma lista de códigos, na ordem recebida"""
+        positions = self.index.resolve(codes)
+        return positions[positions >= 0]
+
+    @classmethod
+    def load(cls, data_dir='data'):
+        """Carrega o snapshot binário se estiver atualizado; caso contrário, os arquivos JSON"""
+        snapshot_dir = os.path.join(data_dir, SNAPSHOT_DIR)
+        reason = snapshot_status(data_dir)
+        # Duas tentativas: um build concorrente pode apagar a geração anterior durante a leitura,
+        # e na segunda o link já aponta para a nova
+        for attempt in range(2 if reason is None else 0):
+            try:
+                engine = cls.from_snapshot(snapshot_dir)
+                print(f"Loaded static data snapshot from {snapshot_dir}")
+                if engine.graph is not None and engine.graph.is_stale():
+                    print("Grafo de vizinhança desatualizado em relação ao GeoJSON; rode build_snapshot.py")
+                return engine
+            except FileNotFoundError as e:
+                reason = f"erro ao abrir snapshot: {e}"
+            except Exception as e:
+                reason = f"erro ao abrir snapshot: {e}"
+                break
+        print(f"Snapshot indisponível ({reason}), carregando arquivos JSON")
+        return cls.from_json(data_dir)
+
+    @classmethod
+    def from_json(cls, data_dir='data'):
+        """Carrega todos os arquivos JSON estáticos e monta as matrizes colunares"""
+        raw_sources = {}
+        for source, (filename, _, label) in DATA_SOURCES.items():
+            try:
+                with open(os.path.join(data_dir, filename), 'r', encoding='utf-8') as f:
+                    raw_sources[source] = json.load(f)
+                print(f"Loaded {label} data with {len(raw_sources[source])} categories")
+            except Exception as e:
+                print(f"Error loading {label} data: {e}")
+                raw_sources[source] = {}
+
+        registry = _build_registry(raw_sources, data_dir)
+
+        sources = {}
+        for source, (_, value_field, _) in DATA_SOURCES.items():
+            sources[source] = _build_dataset(source, raw_sources.pop(source), value_field, registry)
+        return cls(registry, sources, last_modified_from(source_fingerprints(data_dir)))
+
+    @classmethod
+    def from_snapshot(cls, snapshot_dir):
+        """Abre um snapshot binário com mmap (somente leitura)"""
+        # data/snapshot é um link trocado a cada build: resolvê-lo uma vez garante que
+        # todos os arquivos venham da mesma geração
+        snapshot_dir = os.path.realpath(snapshot_dir)
+        with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"versão de snapshot {manifest.get('version')} incompatível")
+
+        def array(filename):
+            return np.load(os.path.join(snapshot_dir, filename), mmap_mode='r', allow_pickle=False)
+
+        registry = MunicipalityRegistry(
+            array('registry.codes.npy').tolist(),
+            names=array('registry.names.npy'), states=array('registry.states.npy'),
+            mesoregions=array('registry.mesoregions.npy'), microregions=array('registry.microregions.npy'),
+            flags=array('registry.flags.npy'), version=manifest['registry_version'])
+        sources = {}
+        for source, meta in manifest['sources'].items():
+            sources[source] = ColumnarDataset(
+                source, meta['value_field'], registry, meta['categories'],
+                array(f'{source}.values.npy'), array(f'{source}.present.npy'),
+                np.array(meta['integral'], dtype=bool), meta['units'], version=meta['version'])
+        graph = MunicipalityGraph.load(snapshot_dir, manifest['graph']) if 'graph' in manifest else None
+        return cls(registry, sources, last_modified_from(manifest['source_files']), graph=graph)
+
+    def to_snapshot(self, snapshot_dir, source_files=None):
+        """Grava as matrizes como arquivos .npy e um manifest com categorias, unidades e origem"""
+        os.makedirs(snapshot_dir, exist_ok=True)
+        registry = self.index
+        np.save(os.path.join(snapshot_dir, 'registry.codes.npy'), np.array(registry.codes, dtype=str))
+        for field in ('names', 'states', 'mesoregions', 'microregions'):
+            np.save(os.path.join(snapshot_dir, f'registry.{field}.npy'), np.array(getattr(registry, field), dtype=str))
+        np.save(os.path.join(snapshot_dir, 'registry.flags.npy'), np.ascontiguousarray(registry.flags))
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'municipalities': len(registry),
+            'registry_version': registry.version,
+            'source_files': source_files or {},
+            'sources': {}
+        }
+        for source, dataset in self.sources.items():
+            np.save(os.path.join(snapshot_dir, f'{source}.values.npy'), np.ascontiguousarray(dataset.values))
+            np.save(os.path.join(snapshot_dir, f'{source}.present.npy'), np.ascontiguousarray(dataset.present))
+            manifest['sources'][source] = {
+                'value_field': dataset.value_field,
+                'categories': dataset.categories,
+                'integral': [bool(flag) for flag in dataset.integral],
+                'units': dataset.units,
+                'version': dataset.version
+            }
+        if self.graph is not None:
+            manifest['graph'] = self.graph.save(snapshot_dir)
+        # Manifest por último: um snapshot sem manifest nunca é considerado válido
+        with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+
+def source_fingerprints(data_dir='data'):
+    """Tamanho e mtime de cada arquivo JSON de origem, para detectar snapshots desatualizados"""
+    fingerprints = {}
+    for filename in [filename for filename, _, _ in DATA_SOURCES.values()] + [REGIONS_FILE]:
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprints[filename] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+
+def last_modified_from(fingerprints):
+    """Maior mtime entre os arquivos de origem, como datetime UTC (None se não houver arquivos)"""
+    if not fingerprints:
+        return None
+    latest = max(mtime_ns for _, mtime_ns in fingerprints.values())
+    return datetime.fromtimestamp(latest / 1e9, tz=timezone.utc).replace(microsecond=0)
+
+
+def snapshot_status(data_dir='data'):
+    """None se o snapshot existe e corresponde aos JSON atuais; senão, o motivo"""
+    manifest_path = os.path.join(data_dir, SNAPSHOT_DIR, SNAPSHOT_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return "snapshot não encontrado"
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except Exception as e:
+        return f"manifest inválido: {e}"
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        return f"versão {manifest.get('version')} != {SNAPSHOT_VERSION}"
+    if manifest.get('source_files') != source_fingerprints(data_dir):
+        return "arquivos JSON alterados desde o build"
+    return None
+
+
+def _build_registry(raw_sources, data_dir):
+    """Monta o cadastro canônico a partir da união dos códigos de todas as fontes
+
+    O primeiro nome/UF não vazio encontrado (na ordem de DATA_SOURCES) vale para o
+    município; as strings são internadas para existir uma única cópia por valor.
+    """
+    all_codes = set()
+    for raw in raw_sources.values():
+        for category_data in raw.values():
+            all_codes.update(str(code) for code in category_data.keys())
+    codes = sorted(all_codes)
+    positions = {code: i for i, code in enumerate(codes)}
+
+    names = [''] * len(codes)
+    states = [''] * len(codes)
+    for raw in raw_sources.values():
+        for category_data in raw.values():
+            for code, record in category_data.items():
+                i = positions[str(code)]
+                if not names[i] and record.get('municipality_name'):
+                    names[i] = sys.intern(record['municipality_name'])
+                if not states[i] and record.get('state_code'):
+                    states[i] = sys.intern(record['state_code'])
+
+    # UF pelo prefixo do código quando nenhuma fonte informa
+    for i, code in enumerate(codes):
+        if not states[i] and len(code) == 7:
+            states[i] = UF_BY_CODE.get(code[:2], '')
+
+    mesoregions = [''] * len(codes)
+    microregions = [''] * len(codes)
+    regions_path = os.path.join(data_dir, REGIONS_FILE)
+    if os.path.exists(regions_path):
+        try:
+            with open(regions_path, 'r', encoding='utf-8') as f:
+                regions = json.load(f)
+            for code, info in regions.items():
+                i = positions.get(str(code))
+                if i is not None:
+                    mesoregions[i] = sys.intern(info.get('mesorregiao', '') or '')
+                    microregions[i] = sys.intern(info.get('microrregiao', '') or '')
+            print(f"Loaded meso/microrregiões for {len(regions)} municipalities")
+        except Exception as e:
+            print(f"Error loading {REGIONS_FILE}: {e}")
+
+    return MunicipalityRegistry(codes,
+                                names=np.array(names, dtype=object),
+                                states=np.array(states, dtype=object),
+                                mesoregions=np.array(mesoregions, dtype=object),
+                                microregions=np.array(microregions, dtype=object))
+
+
+def _build_dataset(name, raw, value_field, index):
+    """Converte {categoria: {código: registro}} em um ColumnarDataset"""
+    n_municipalities = len(index)
+    categories = list(raw.keys())
+    values = np.zeros((n_municipalities, len(categories)), dtype=np.float64)
+    present = np.zeros((n_municipalities, len(categories)), dtype=bool)
+    integral = np.ones(len(categories), dtype=bool)
+    units = [None] * len(categories)
+    positions = index.positions
+
+    for j, category in enumerate(categories):
+        for code, record in raw[category].items():
+            i = positions[str(code)]
+            value = record.get(value_field, 0) or 0
+            if not isinstance(value, int) or isinstance(value, bool):
+                integral[j] = False
+            try:
+                values[i, j] = float(value)
+            except (TypeError, ValueError):
+                values[i, j] = 0.0
+            present[i, j] = True
+            if units[j] is None and 'unit' in record:
+                units[j] = record['unit']
+
+    return ColumnarDataset(name, value_field, index, categories, values, present,
+                           integral, units)
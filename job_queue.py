@@ -0,0 +1,214 @@
+"""
+Fila de tarefas em segundo plano para exportações e análises pesadas
+
+As tarefas rodam em um pool de threads próprio (fora das threads que atendem
+requisições) dentro de um contexto da aplicação. Estado, progresso e resultado
+ficam em disco (JOBS_DIR/<id>.json e <id>.result), então qualquer processo do
+gunicorn responde à consulta de uma tarefa criada por outro. Resultados
+concluídos há mais de `ttl` segundos são apagados na próxima limpeza; tarefas
+que nunca terminaram também, contando desde a criação.
+
+Cada tarefa guarda o processo que a executa (host, pid e instante de início do
+processo). Uma tarefa ainda 'queued'/'running' cujo processo morreu ou foi
+reiniciado (pid inexistente ou reaproveitado) é marcada como 'failed' ao ser
+consultada.
+
+Uma tarefa é uma função que recebe `progress(fração, mensagem=None)` e devolve
+um dict (resultado JSON) ou (BytesIO/bytes, nome do arquivo); o mimetype do
+arquivo vem da extensão do nome.
+"""
+import json
+import mimetypes
+import os
+import secrets
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+FINISHED_STATES = ('done', 'failed')
+
+# Intervalo mínimo entre limpezas de resultados expirados (segundos)
+CLEANUP_INTERVAL = 60
+
+
+def process_started(pid):
+    """Instante de início do processo (ticks desde o boot, de /proc; None se indisponível)"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # O nome do processo (2º campo) pode ter espaços: os campos seguintes vêm depois do último ')'
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def process_alive(pid, started):
+    """O processo pid existe e é o mesmo que registrou a tarefa (não um pid reaproveitado)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    current = process_started(pid)
+    return started is None or current is None or current == started
+
+
+def current_worker():
+    pid = os.getpid()
+    return {'host': socket.gethostname(), 'pid': pid, 'started': process_started(pid)}
+
+
+class JobQueue:
+    """Pool de workers com estado das tarefas em arquivos JSON"""
+
+    def __init__(self, directory, workers=2, ttl=24 * 3600, context=None):
+        # Caminho absoluto: send_file resolve caminhos relativos a partir da pasta da aplicação
+        self.directory = os.path.abspath(directory)
+        self.ttl = ttl
+        self.context = context
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.lock = threading.Lock()
+        self.last_cleanup = 0.0
+        self.worker = current_worker()
+        self.active = set()     # tarefas enfileiradas/em execução neste JobQueue
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.directory, f'{job_id}.{suffix}')
+
+    def _write(self, job):
+        # Escrita atômica: quem consulta nunca lê um JSON pela metade
+        path = self._path(job['id'], 'json')
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(temporary, path)
+
+    def get(self, job_id):
+        """Estado da tarefa (dict) ou None se não existe/expirou; tarefas órfãs voltam como 'failed'"""
+        if not job_id.replace('-', '').replace('_', '').isalnum():
+            return None
+        try:
+            with open(self._path(job_id, 'json'), 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job['status'] not in FINISHED_STATES and self._orphaned(job):
+            job.update(status='failed', error='Tarefa interrompida: o processo que a executava foi encerrado',
+                       finished_at=time.time())
+            self._write(job)
+        return job
+
+    def _orphaned(self, job):
+        """Tarefa inacabada cujo processo não existe mais (só dá para saber no mesmo host)"""
+        worker = job.get('worker')
+        if not worker or worker['host'] != self.worker['host']:
+            return False
+        if worker['pid'] == self.worker['pid'] and worker['started'] == self.worker['started']:
+            with self.lock:
+                return job['id'] not in self.active
+        return not process_alive(worker['pid'], worker['started'])
+
+    def result_path(self, job_id):
+        return self._path(job_id, 'result')
+
+    def submit(self, kind, function, owner=None, params=None):
+        """Enfileira a tarefa e retorna seu estado inicial"""
+        self.cleanup()
+        job = {
+            'id': secrets.token_urlsafe(12),
+            'kind': kind,
+            'owner': owner,
+            'params': params or {},
+            'status': 'queued',
+            'worker': self.worker,
+            'progress': 0.0,
+            'message': None,
+            'error': None,
+            'result': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None
+        }
+        with self.lock:
+            self.active.add(job['id'])
+        self._write(job)
+        self.executor.submit(self._run, dict(job), function)
+        return job
+
+    def _run(self, job, function):
+        job.update(status='running', started_at=time.time())
+        self._write(job)
+
+        def progress(fraction, message=None):
+            job['progress'] = round(min(max(float(fraction), 0.0), 1.0), 4)
+            if message is not None:
+                job['message'] = message
+            self._write(job)
+
+        try:
+            if self.context is not None:
+                with self.context():
+                    result = function(progress)
+            else:
+                result = function(progress)
+            job['result'] = self._store(job['id'], result)
+            job.update(status='done', progress=1.0)
+        except Exception as e:
+            print(f"Erro na tarefa {job['id']} ({job['kind']}): {str(e)}")
+            traceback.print_exc()
+            job.update(status='failed', error=str(e))
+        job['finished_at'] = time.time()
+        self._write(job)
+        with self.lock:
+            self.active.discard(job['id'])
+
+    def _store(self, job_id, result):
+        """Grava o resultado em disco e retorna a descrição dele para o estado da tarefa"""
+        path = self.result_path(job_id)
+        if isinstance(result, dict):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            return {'type': 'json', 'mimetype': 'application/json', 'size': os.path.getsize(path)}
+
+        output, filename = result
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        data = output.getvalue() if hasattr(output, 'getvalue') else output
+        with open(path, 'wb') as f:
+            f.write(data)
+        return {'type': 'file', 'filename': filename, 'mimetype': mimetype, 'size': len(data)}
+
+    def cleanup(self, force=False):
+        """Apaga tarefas concluídas há mais de ttl segundos, ou criadas há mais de ttl e nunca concluídas
+
+        Roda no máximo uma vez por CLEANUP_INTERVAL (force ignora o intervalo).
+        """
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_cleanup < CLEANUP_INTERVAL:
+                return 0
+            self.last_cleanup = now
+
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            job_id = name[:-len('.json')]
+            job = self.get(job_id)
+            if job is None:
+                continue
+            if job['status'] in FINISHED_STATES:
+                age = now - job['finished_at']
+            else:
+                age = now - job['created_at']
+            if age <= self.ttl:
+                continue
+            for suffix in ('result', 'json'):
+                try:
+                    os.remove(self._path(job_id, suffix))
+                except FileNotFoundError:
+                    pass
+            removed += 1
+        return removed
@@ -0,0 +1,191 @@
+"""
+Grafo de vizinhança dos municípios (quem faz divisa com quem) a partir do GeoJSON
+
+Gerado offline por build_snapshot.py a partir do GeoJSON combinado por
+combine_geojson.py e gravado junto com o snapshot: listas de adjacência em CSR
+(indptr/indices) sobre as posições do cadastro e um centroide aproximado de cada
+município. Dois municípios são vizinhos quando compartilham ao menos um vértice
+da malha (contiguidade "queen"; a malha do IBGE repete os vértices das divisas).
+
+Vizinhos, contiguidade e componentes conexas de um território são buscas em
+largura vetorizadas sobre esses arrays.
+"""
+import json
+import os
+
+import numpy as np
+
+# GeoJSON com todos os municípios, gerado por combine_geojson.py
+GEOJSON_FILE = os.path.join('static', 'data', 'brazil_municipalities_all.geojson')
+
+# Propriedades com o código IBGE, na mesma ordem de preferência do map.js
+CODE_PROPERTIES = ('GEOCODIGO', 'CD_MUN', 'cd_geocmu', 'geocodigo', 'CD_GEOCMU')
+
+# Casas decimais usadas para identificar vértices iguais (~0,1 m)
+VERTEX_DECIMALS = 6
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def file_fingerprint(path):
+    """[tamanho, mtime_ns] de um arquivo (None se não existe)"""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def feature_code(properties):
+    for key in CODE_PROPERTIES:
+        if properties.get(key):
+            return str(properties[key])
+    return ''
+
+
+def polygon_rings(geometry):
+    """Anéis (listas de [lon, lat]) de um Polygon ou MultiPolygon"""
+    if not geometry:
+        return []
+    if geometry.get('type') == 'Polygon':
+        return geometry['coordinates']
+    if geometry.get('type') == 'MultiPolygon':
+        return [ring for polygon in geometry['coordinates'] for ring in polygon]
+    return []
+
+
+def gather_neighbours(indptr, indices, rows):
+    """Concatenação das listas de adjacência das linhas informadas (sem laço Python)"""
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.array([], dtype=indices.dtype)
+    offsets = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+    return indices[offsets + np.arange(total)]
+
+
+class MunicipalityGraph:
+    """Adjacência (CSR) e centroides (lon, lat) indexados pelas posições do cadastro"""
+
+    ARRAYS = ('indptr', 'indices', 'centroids')
+
+    def __init__(self, indptr, indices, centroids, source_file=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.centroids = centroids
+        self.source_file = source_file
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def edges(self):
+        return len(self.indices) // 2
+
+    def neighbours(self, position):
+        """Posições dos municípios que fazem divisa com o da posição informada"""
+        return self.indices[self.indptr[position]:self.indptr[position + 1]]
+
+    def expand(self, mask):
+        """Máscara dos municípios vizinhos de algum município da máscara (fora dela)"""
+        result = np.zeros(len(self), dtype=bool)
+        result[gather_neighbours(self.indptr, self.indices, np.flatnonzero(mask))] = True
+        return result & ~mask
+
+    def components(self, positions):
+        """Componentes conexas do território (listas de posições, da maior para a menor)"""
+        remaining = np.zeros(len(self), dtype=bool)
+        remaining[positions] = True
+        components = []
+        while remaining.any():
+            frontier = np.flatnonzero(remaining)[:1]
+            remaining[frontier] = False
+            component = [frontier]
+            while len(frontier):
+                reached = gather_neighbours(self.indptr, self.indices, frontier)
+                frontier = np.unique(reached[remaining[reached]])
+                remaining[frontier] = False
+                component.append(frontier)
+            components.append(np.sort(np.concatenate(component)))
+        return sorted(components, key=len, reverse=True)
+
+    def distances_km(self, origins, targets=None):
+        """Menor distância (haversine entre centroides) de cada alvo até algum dos municípios de origem"""
+        lon, lat = np.radians(self.centroids[:, 0]), np.radians(self.centroids[:, 1])
+        targets = np.arange(len(self)) if targets is None else targets
+        nearest = np.full(len(targets), np.inf)
+        for start in range(0, len(origins), 256):
+            block = origins[start:start + 256]
+            dlat = lat[targets][None, :] - lat[block][:, None]
+            dlon = lon[targets][None, :] - lon[block][:, None]
+            a = np.sin(dlat / 2) ** 2 + np.cos(lat[block])[:, None] * np.cos(lat[targets])[None, :] * np.sin(dlon / 2) ** 2
+            with np.errstate(invalid='ignore'):
+                distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+            nearest = np.fmin(nearest, np.nanmin(distances, axis=0, initial=np.inf))
+        return nearest
+
+    def save(self, snapshot_dir):
+        """Grava os arrays no diretório do snapshot; retorna os metadados para o manifest"""
+        for name in self.ARRAYS:
+            np.save(os.path.join(snapshot_dir, f'graph.{name}.npy'), np.ascontiguousarray(getattr(self, name)))
+        return {'municipalities': len(self), 'edges': self.edges, 'source_file': self.source_file}
+
+    @classmethod
+    def load(cls, snapshot_dir, meta):
+        arrays = [np.load(os.path.join(snapshot_dir, f'graph.{name}.npy'), mmap_mode='r', allow_pickle=False)
+                  for name in cls.ARRAYS]
+        return cls(*arrays, source_file=meta.get('source_file'))
+
+    def is_stale(self, geojson_path=GEOJSON_FILE):
+        """True se o GeoJSON existe e mudou desde a geração do grafo"""
+        current = file_fingerprint(geojson_path)
+        return current is not None and current != self.source_file
+
+
+def build_graph(registry, geojson_path=GEOJSON_FILE):
+    """Deriva o grafo de vizinhança do GeoJSON combinado (municípios fora do cadastro são ignorados)"""
+    with open(geojson_path, 'r', encoding='utf-8') as f:
+        features = json.load(f).get('features', [])
+
+    n = len(registry)
+    # Códigos de 6 dígitos (sem o dígito verificador) ainda aparecem em algumas malhas
+    by_prefix = {code[:6]: i for i, code in enumerate(registry.codes) if len(code) == 7}
+    centroids = np.full((n, 2), np.nan)
+    owners, vertices = [], []
+    for feature in features:
+        code = feature_code(feature.get('properties') or {})
+        position = registry.position(code)
+        if position < 0 and len(code) == 6:
+            position = by_prefix.get(code, -1)
+        # Anéis sem o vértice de fechamento (repetição do primeiro), para não pesar no centroide
+        rings = [np.asarray(ring[:-1] if len(ring) > 1 and ring[0] == ring[-1] else ring, dtype=np.float64)[:, :2]
+                 for ring in polygon_rings(feature.get('geometry')) if len(ring)]
+        if position < 0 or not rings:
+            continue
+        coordinates = np.concatenate(rings)
+        centroids[position] = coordinates.mean(axis=0)
+        vertices.append(np.round(coordinates * 10 ** VERTEX_DECIMALS).astype(np.int64))
+        owners.append(np.full(len(coordinates), position, dtype=np.int64))
+
+    if vertices:
+        # (vértice, município) únicos, ordenados por vértice: municípios do mesmo vértice ficam lado a lado
+        rows = np.unique(np.column_stack([np.concatenate(vertices), np.concatenate(owners)]), axis=0)
+        sources, targets = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+        for offset in range(1, len(rows)):
+            same = (rows[offset:, 0] == rows[:-offset, 0]) & (rows[offset:, 1] == rows[:-offset, 1])
+            if not same.any():
+                break
+            sources.append(rows[:-offset, 2][same])
+            targets.append(rows[offset:, 2][same])
+        pairs = np.sort(np.column_stack([np.concatenate(sources), np.concatenate(targets)]), axis=1)
+        edges = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+    else:
+        edges = np.empty((0, 2), dtype=np.int64)
+
+    # Lista simétrica em CSR, vizinhos em ordem de posição
+    heads = np.concatenate([edges[:, 0], edges[:, 1]])
+    tails = np.concatenate([edges[:, 1], edges[:, 0]])
+    order = np.lexsort((tails, heads))
+    indptr = np.r_[0, np.cumsum(np.bincount(heads, minlength=n))].astype(np.int64)
+    return MunicipalityGraph(indptr, tails[order].astype(np.int32), centroids,
+                             source_file=file_fingerprint(geojson_path))
@@ -0,0 +1,139 @@
+"""
+Índice de busca de municípios (sem acentos) sobre o cadastro canônico
+
+Ordenação dos resultados: nome começa com a busca > alguma palavra do nome começa
+com a busca > busca aparece no meio do nome > busca é a sigla da UF. Empates são
+desfeitos pelo peso do município (população estimada pela base de escolaridade ou,
+na falta dela, área colhida total) e depois pelo nome.
+"""
+import bisect
+import heapq
+import re
+import unicodedata
+
+import numpy as np
+
+RANK_PREFIX = 0
+RANK_TOKEN = 1
+RANK_SUBSTRING = 2
+RANK_STATE = 3
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+def fold(text):
+    """Minúsculas, sem acentos e com pontuação trocada por espaço ("São João d'Oeste" -> "sao joao d oeste")"""
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return _NON_ALNUM.sub(' ', without_accents.lower()).strip()
+
+
+def _ngrams(text, size):
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class MunicipalitySearchIndex:
+    """Índices de prefixo, de palavras e de n-gramas sobre os nomes dos municípios válidos"""
+
+    def __init__(self, engine):
+        registry = engine.index
+        self.registry = registry
+        positions = np.flatnonzero(registry.valid_mask(check_keywords=False, check_excluded_names=False))
+        self.positions = positions.tolist()
+        self.folded = {position: fold(registry.names[position]) for position in self.positions}
+        self.states = {position: str(registry.states[position]) for position in self.positions}
+        self.weights = self._weights(engine)
+
+        # Nome completo ordenado (busca por prefixo com bisect)
+        self.sorted_names = sorted((name, position) for position, name in self.folded.items())
+        self.sorted_keys = [name for name, _ in self.sorted_names]
+
+        # Palavras ordenadas (prefixo de palavra) e n-gramas de 2 e 3 letras (substring)
+        token_positions = {}
+        self.ngrams = {}
+        for position, name in self.folded.items():
+            for token in set(name.split()):
+                token_positions.setdefault(token, set()).add(position)
+            compact = name.replace(' ', '')
+            for size in (2, 3):
+                for gram in _ngrams(compact, size):
+                    self.ngrams.setdefault(gram, set()).add(position)
+        self.tokens = sorted(token_positions)
+        self.token_positions = token_positions
+
+        self.by_state = {}
+        for position, state in self.states.items():
+            self.by_state.setdefault(state.lower(), set()).add(position)
+
+    def _weights(self, engine):
+        """Peso para desempate: população (soma da escolaridade) ou área colhida total"""
+        for source in ('escolaridade', 'crops'):
+            if source in engine and len(engine[source]):
+                totals = np.asarray(engine[source].values).sum(axis=1)
+                if totals.any():
+                    return {position: float(totals[position]) for position in self.positions}
+        return {position: 0.0 for position in self.positions}
+
+    def _prefix_matches(self, query):
+        start = bisect.bisect_left(self.sorted_keys, query)
+        end = bisect.bisect_left(self.sorted_keys, query + '\uffff')
+        return {position for _, position in self.sorted_names[start:end]}
+
+    def _token_prefix_matches(self, token):
+        start = bisect.bisect_left(self.tokens, token)
+        end = bisect.bisect_left(self.tokens, token + '\uffff')
+        matches = set()
+        for candidate in self.tokens[start:end]:
+            matches |= self.token_positions[candidate]
+        return matches
+
+    def _substring_matches(self, query):
+        compact = query.replace(' ', '')
+        size = 3 if len(compact) >= 3 else 2
+        grams = _ngrams(compact, size)
+        if not grams:
+            return set()
+        candidates = set.intersection(*(self.ngrams.get(gram, set()) for gram in grams))
+        return {position for position in candidates if query in self.folded[position]}
+
+    def search(self, query, state=None, limit=20, offset=0):
+        """Retorna (resultados da página, total de correspondências)"""
+        folded_query = fold(query)
+        if not folded_query:
+            return [], 0
+
+        ranks = {}
+
+        def add(positions, rank):
+            for position in positions:
+                if rank < ranks.get(position, RANK_STATE + 1):
+                    ranks[position] = rank
+
+        add(self._prefix_matches(folded_query), RANK_PREFIX)
+        query_tokens = folded_query.split()
+        token_matches = self._token_prefix_matches(query_tokens[0])
+        for token in query_tokens[1:]:
+            token_matches &= self._token_prefix_matches(token)
+        add(token_matches, RANK_TOKEN)
+        add(self._substring_matches(folded_query), RANK_SUBSTRING)
+        add(self.by_state.get(folded_query.replace(' ', ''), ()), RANK_STATE)
+
+        if state:
+            allowed = self.by_state.get(state.lower(), set())
+            ranks = {position: rank for position, rank in ranks.items() if position in allowed}
+
+        total = len(ranks)
+        page = heapq.nsmallest(offset + limit, ranks.items(),
+                               key=lambda item: (item[1], -self.weights[item[0]], self.folded[item[0]]))
+        results = []
+        for position, rank in page[offset:]:
+            name = str(self.registry.names[position])
+            state_code = self.states[position] or 'XX'
+            results.append({
+                'code': self.registry.codes[position],
+                'name': name,
+                'state': state_code,
+                'full_name': f"{name} ({state_code})",
+                'rank': rank
+            })
+        return results, total
@@ -0,0 +1,212 @@
+"""
+Pontuação de potencial de muitos territórios de uma vez
+
+Os territórios viram uma matriz esparsa de pertinência (entidades × municípios do
+cadastro, em CSR, com a multiplicidade de cada código) e todos os componentes da
+matriz de cálculo de analyze_revenda_potential saem de um único produto dessa
+matriz com colunas pré-calculadas por município: área de culturas, receita,
+despesa, indicadores de valor positivo de cada categoria e a UF de cada município
+(a UF predominante do território é a referência da normalização por percentil).
+
+O mesmo vale para o ganho de incluir um município: as somas de todos os
+candidatos são as do território mais a linha de cada um, avaliadas de uma vez.
+Os pontos saem do modelo de pontuação configurado (scoring_model.ScoringModel).
+"""
+import numpy as np
+
+from territory_analyzer import TOTAL_CATEGORIES
+
+# Fontes contadas como "categorias com algum valor positivo" (numerador dos percentuais de uso)
+USAGE_SOURCES = (
+    ('crops', ()),
+    ('fertilizers', TOTAL_CATEGORIES),
+    ('agrotoxico', ()),
+    ('consultoria', ())
+)
+
+
+class MembershipMatrix:
+    """Matriz esparsa territórios × municípios (CSR); data = nº de vezes que o código aparece no território"""
+
+    def __init__(self, registry, territories):
+        indptr = [0]
+        indices = []
+        data = []
+        self.n_codes = np.array([len(codes) for codes in territories], dtype=np.int64)
+        for codes in territories:
+            positions = registry.resolve(codes)
+            columns, counts = np.unique(positions[positions >= 0], return_counts=True)
+            indices.append(columns)
+            data.append(counts)
+            indptr.append(indptr[-1] + len(columns))
+        self.shape = (len(territories), len(registry))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.concatenate(indices) if indices else np.array([], dtype=np.int64)
+        self.data = np.concatenate(data).astype(np.float64) if data else np.array([], dtype=np.float64)
+
+    @classmethod
+    def from_csr(cls, indptr, indices, shape):
+        """Territórios já em CSR (posições ordenadas por linha, cada município no máximo uma vez)"""
+        membership = cls.__new__(cls)
+        membership.shape = shape
+        membership.indptr = np.asarray(indptr, dtype=np.int64)
+        membership.indices = np.asarray(indices, dtype=np.int64)
+        membership.n_codes = np.diff(membership.indptr)
+        membership.data = np.ones(len(membership.indices))
+        return membership
+
+    def dot(self, matrix):
+        """Produto (territórios × municípios) @ (municípios × k)"""
+        out = np.zeros((self.shape[0], matrix.shape[1]))
+        nonempty = np.flatnonzero(np.diff(self.indptr))
+        if len(nonempty):
+            products = matrix[self.indices] * self.data[:, None]
+            out[nonempty] = np.add.reduceat(products, self.indptr[nonempty], axis=0)
+        return out
+
+
+class PotentialFeatures:
+    """Colunas por município usadas na pontuação, montadas uma vez por carga dos dados"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        columns = [engine['crops'].values.sum(axis=1),
+                   engine['receita'].values.sum(axis=1),
+                   engine['despesa'].values.sum(axis=1)]
+        self.usage_slices = {}
+        start = len(columns)
+        for source, excluded in USAGE_SOURCES:
+            dataset = engine[source]
+            selected = [j for j, category in enumerate(dataset.categories) if category not in excluded]
+            positive = dataset.values[:, selected] > 0
+            columns.extend(positive.T.astype(np.float64))
+            self.usage_slices[source] = slice(start, start + len(selected))
+            start += len(selected)
+
+        # Uma coluna por UF (ids em ordem alfabética; municípios sem UF ficam com -1)
+        self.state_names, state_ids = np.unique(np.asarray(engine.index.states, dtype=str), return_inverse=True)
+        self.state_names = self.state_names.tolist()
+        self.state_ids = state_ids.astype(np.int64)
+        if '' in self.state_names:
+            unknown = self.state_names.index('')
+            self.state_ids[self.state_ids == unknown] = -1
+        self.state_slice = slice(start, start + len(self.state_names))
+        known = self.state_ids >= 0
+        for state in range(len(self.state_names)):
+            columns.append(((self.state_ids == state) & known).astype(np.float64))
+        self.matrix = np.column_stack(columns) if columns else np.empty((len(engine.index), 0))
+
+    def totals(self, source, values):
+        """Arredonda somas de fontes só com categorias inteiras, como SourceProfile.total()"""
+        dataset = self.engine[source]
+        integral = bool(dataset.integral.all()) if len(dataset.integral) else True
+        return np.round(values) if integral else values
+
+    def dominant_state(self, codes):
+        """Id da UF com mais códigos no território (com repetições; -1 se nenhum tem UF)"""
+        positions = self.engine.index.resolve(codes)
+        states = self.state_ids[positions[positions >= 0]]
+        counts = np.bincount(states[states >= 0], minlength=len(self.state_names))
+        return int(np.argmax(counts)) if counts.any() else -1
+
+    def raw_components(self, membership):
+        """Valores brutos de cada território (as mesmas grandezas de analyze_revenda_potential)"""
+        return self.raw_from_sums(membership.dot(self.matrix), membership.n_codes)
+
+    def raw_from_sums(self, sums, n_codes):
+        """Valores brutos a partir das somas das colunas (uma linha por território) e do nº de códigos"""
+        divisor = np.maximum(n_codes, 1)
+        share = lambda source: np.minimum(
+            (sums[:, self.usage_slices[source]] > 0).sum(axis=1) / divisor * 100, 100)
+
+        crops_total = self.totals('crops', sums[:, 0])
+        states = sums[:, self.state_slice]
+        dominant = np.argmax(states, axis=1) if states.shape[1] else np.zeros(len(sums), dtype=np.int64)
+        return {
+            'municipios': n_codes,
+            'diversity': (sums[:, self.usage_slices['crops']] > 0).sum(axis=1),
+            'crops_total': crops_total,
+            'avg_productivity': crops_total / divisor,
+            'receita': self.totals('receita', sums[:, 1]),
+            'despesa': self.totals('despesa', sums[:, 2]),
+            'fertilizers_usage': share('fertilizers'),
+            'consultoria_usage': share('consultoria'),
+            'agrotoxicos_usage': share('agrotoxico'),
+            'state': np.where(states.max(axis=1, initial=0) > 0, dominant, -1)
+        }
+
+
+def expansion_gains(features, model, codes, allowed=None):
+    """Pontuação do território com cada município que ainda não está nele incluído
+
+    Candidatos são os municípios do cadastro (nunca linhas agregadas); allowed (máscara sobre o
+    cadastro) os restringe. Todos são avaliados de uma vez:
+    as somas de cada candidato são as do território mais a linha do município.
+    Retorna (posições dos candidatos, pontuação atual, pontuações com cada candidato).
+    """
+    registry = features.engine.index
+    membership = MembershipMatrix(registry, [codes])
+    current_sums = membership.dot(features.matrix)
+    current = model.evaluate(features.raw_from_sums(current_sums, membership.n_codes))
+
+    # Só municípios: linhas agregadas (Brasil, UF, meso/microrregião) têm os totais de regiões inteiras
+    candidates = registry.valid_mask(check_keywords=False, check_excluded_names=False).copy()
+    if allowed is not None:
+        candidates &= allowed
+    candidates[membership.indices] = False
+    positions = np.flatnonzero(candidates)
+    n_codes = np.full(len(positions), membership.n_codes[0] + 1)
+    after = model.evaluate(features.raw_from_sums(current_sums + features.matrix[positions], n_codes))
+    return positions, {key: float(current[key][0]) for key in model.component_names + ['base_score', 'final_score']}, after
+
+
+def top_expansions(features, model, codes, k, allowed=None):
+    """Os k candidatos de maior ganho no potentialScore, com o ganho de cada componente"""
+    positions, current, after = expansion_gains(features, model, codes, allowed)
+    gains = after['final_score'] - current['final_score']
+    # Maior ganho primeiro; empates pela posição no cadastro
+    chosen = np.lexsort((positions, -gains))[:k]
+
+    registry = features.engine.index
+    return current, [{
+        'code': registry.codes[positions[i]],
+        'name': str(registry.names[positions[i]]),
+        'state': str(registry.states[positions[i]]),
+        'potentialScore': float(after['final_score'][i]),
+        'gain': float(gains[i]),
+        'component_gains': {component: float(after[component][i] - current[component])
+                            for component in model.component_names}
+    } for i in chosen.tolist()]
+
+
+def leaderboard(features, model, entities):
+    """Entidades ({'type', 'id', 'nome', 'codes', ...}) ordenadas por potentialScore, com os componentes"""
+    membership = MembershipMatrix(features.engine.index, [entity['codes'] for entity in entities])
+    raw = features.raw_components(membership)
+    scores = model.evaluate(raw)
+
+    # Ordem decrescente estável: empates mantêm a ordem de entrada
+    order = np.argsort(-scores['final_score'], kind='stable')
+    ranked = []
+    for rank, i in enumerate(order.tolist(), start=1):
+        entity = entities[i]
+        ranked.append({
+            'rank': rank,
+            'type': entity['type'],
+            'id': entity['id'],
+            'nome': entity['nome'],
+            'potentialScore': float(scores['final_score'][i]),
+            'breakdown': {component: float(scores[component][i]) for component in model.component_names},
+            'raw': {
+                'municipios': int(raw['municipios'][i]),
+                'cropsDiversity': int(raw['diversity'][i]),
+                'avgProductivity': float(raw['avg_productivity'][i]),
+                'receita': float(raw['receita'][i]),
+                'despesa': float(raw['despesa'][i]),
+                'saldo': float(raw['receita'][i] - raw['despesa'][i]),
+                'fertilizersUsage': float(raw['fertilizers_usage'][i]),
+                'technicalAssistance': float(raw['consultoria_usage'][i]),
+                'agrotoxicosUsage': float(raw['agrotoxicos_usage'][i])
+            }
+        })
+    return ranked
@@ -0,0 +1,101 @@
+"""
+Rankings pré-calculados por (fonte, categoria), nacionais e por UF
+
+Cada categoria guarda a ordem decrescente dos municípios válidos (desempate pela
+posição no cadastro, como o sort estável usado nos endpoints) e a posição de cada
+município no ranking nacional e no da sua UF. Top-N, ranking e percentil de um
+município saem sem reordenar a base.
+"""
+import numpy as np
+
+# Critérios de município válido por fonte (check_keywords, check_excluded_names),
+# os mesmos usados pelos endpoints e exportações de cada base
+VALID_MUNICIPALITY_CRITERIA = {
+    'crops': (True, True),
+    'fertilizers': (True, False)
+}
+DEFAULT_CRITERIA = (False, False)
+
+
+def percentile(value, sorted_values):
+    """Percentual de municípios com valor menor ou igual (sorted_values em ordem decrescente)"""
+    if not len(sorted_values):
+        return None
+    greater = np.searchsorted(-sorted_values, -value, side='left')
+    return float(100.0 * (len(sorted_values) - greater) / len(sorted_values))
+
+
+class CategoryRanking:
+    """Ordem decrescente de uma categoria e posição de cada município (nacional e na UF)"""
+
+    def __init__(self, dataset, category, valid, state_ids, n_states):
+        j = dataset.category_index[category]
+        rows = np.flatnonzero(dataset.present[:, j] & valid)
+        column = dataset.values[:, j]
+        self.order = rows[np.argsort(-column[rows], kind='stable')]
+        self.sorted_values = column[self.order]
+
+        self.rank = np.full(len(column), -1, dtype=np.int32)
+        self.rank[self.order] = np.arange(len(self.order), dtype=np.int32)
+
+        # Ordem por UF: sort estável por UF preserva a ordem por valor dentro de cada uma
+        by_state = self.order[np.argsort(state_ids[self.order], kind='stable')]
+        bounds = np.searchsorted(state_ids[by_state], np.arange(n_states + 1))
+        self.state_order = [by_state[bounds[s]:bounds[s + 1]] for s in range(n_states)]
+        self.state_rank = np.full(len(column), -1, dtype=np.int32)
+        for positions in self.state_order:
+            self.state_rank[positions] = np.arange(len(positions), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.order)
+
+
+class RankingIndex:
+    """Rankings de todas as categorias de todas as fontes, calculados na carga"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        registry = engine.index
+        self.state_names, state_ids = np.unique(np.asarray(registry.states, dtype=str), return_inverse=True)
+        self.state_names = self.state_names.tolist()
+        self.state_ids = state_ids.astype(np.int32)
+        self.state_index = {state: s for s, state in enumerate(self.state_names)}
+
+        self.rankings = {}
+        for source, dataset in engine.sources.items():
+            valid = dataset.valid_mask(*VALID_MUNICIPALITY_CRITERIA.get(source, DEFAULT_CRITERIA))
+            for category in dataset.categories:
+                self.rankings[(source, category)] = CategoryRanking(
+                    dataset, category, valid, self.state_ids, len(self.state_names))
+
+    def __contains__(self, key):
+        return key in self.rankings
+
+    def ordered(self, source, category, state=None):
+        """Posições dos municípios válidos em ordem decrescente de valor (opcionalmente de uma UF)"""
+        ranking = self.rankings[(source, category)]
+        if not state:
+            return ranking.order
+        s = self.state_index.get(state)
+        return ranking.state_order[s] if s is not None else ranking.order[:0]
+
+    def top(self, source, category, n, state=None):
+        """As n primeiras posições do ranking (nacional ou da UF)"""
+        return self.ordered(source, category, state)[:n]
+
+    def municipality(self, source, category, position):
+        """Posição no ranking nacional e da UF e percentis de um município (None se fora do ranking)"""
+        ranking = self.rankings[(source, category)]
+        rank = int(ranking.rank[position])
+        if rank < 0:
+            return None
+        state_positions = ranking.state_order[self.state_ids[position]]
+        value = ranking.sorted_values[rank]
+        return {
+            'rank': rank + 1,
+            'total': len(ranking),
+            'percentile': percentile(value, ranking.sorted_values),
+            'state_rank': int(ranking.state_rank[position]) + 1,
+            'state_total': len(state_positions),
+            'state_percentile': percentile(value, ranking.sorted_values[ranking.rank[state_positions]])
+        }
@@ -0,0 +1,115 @@
+"""
+Cache de respostas JSON (ou binárias) pré-serializadas e pré-comprimidas (gzip e, se disponível, brotli)
+
+Cada entrada é identificada por uma chave que inclui a versão do dataset, então uma
+nova versão dos dados nunca reaproveita bytes antigos. O total de bytes guardados é
+limitado; ao estourar o limite, as entradas menos usadas recentemente são descartadas.
+"""
+import gzip
+import json
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:  # encoder padrão como fallback
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # sem brotli, apenas gzip
+    brotli = None
+
+
+def dumps(payload):
+    """Serializa como o jsonify do Flask (chaves ordenadas, sem espaços), em bytes UTF-8"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+class CompressedResponseCache:
+    """LRU de corpos JSON em bytes (identidade, gzip e brotli) com limite de memória"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _encode(self, payload):
+        body = payload if isinstance(payload, bytes) else dumps(payload)
+        entry = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            entry['br'] = brotli.compress(body, quality=9)
+        return entry
+
+    def get(self, key, build_payload):
+        """Entrada da chave, serializando (bytes são usados como estão) e comprimindo o payload apenas na primeira vez"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._encode(build_payload())
+        entry_size = sum(len(body) for body in entry.values())
+
+        with self.lock:
+            self.misses += 1
+            if key not in self.entries and entry_size <= self.max_bytes:
+                self.entries[key] = entry
+                self.size += entry_size
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= sum(len(body) for body in evicted.values())
+                    self.evictions += 1
+        return entry
+
+    def respond(self, key, build_payload, status=200, mimetype='application/json'):
+        """Response com a melhor codificação aceita pelo cliente (br > gzip > identidade)"""
+        entry = self.get(key, build_payload)
+        accepted = request.accept_encodings
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in entry and accepted[candidate]:
+                encoding = candidate
+                break
+
+        response = Response(entry[encoding], status=status, mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def stats(self):
+        """Uso de memória e eficiência do cache"""
+        with self.lock:
+            identity = sum(len(entry['identity']) for entry in self.entries.values())
+            compressed = {
+                encoding: sum(len(entry[encoding]) for entry in self.entries.values() if encoding in entry)
+                for encoding in ('gzip', 'br')
+            }
+            requests_total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / requests_total if requests_total else 0,
+                'identity_bytes': identity,
+                'gzip_bytes': compressed['gzip'],
+                'br_bytes': compressed['br'],
+                'gzip_ratio': identity / compressed['gzip'] if compressed['gzip'] else None,
+                'br_ratio': identity / compressed['br'] if compressed['br'] else None,
+                'encoder': 'orjson' if orjson is not None else 'json',
+                'brotli': brotli is not None
+            }
@@ -4,106 +4,165 @@ import json
 import pandas as pd
 from app import app, db
 import io
+import time
 from auth_supabase import supabase_auth_manager as auth_manager, login_required, admin_required
 from flask_migrate import Migrate
 from models import User, Revenda, Vendedor
 from datetime import datetime
 from openpyxl.styles import PatternFill, Font
 import openpyxl # Import openpyxl
+import numpy as np
+from functools import wraps
+from werkzeug.http import is_resource_modified
+from urllib.parse import quote
+from dataset_engine import DatasetEngine, content_hash
+from municipality_search import MunicipalitySearchIndex
+from rankings import RankingIndex
+from summaries import StatisticalSummaries
+from state_aggregates import LEVELS, StateAggregator
+from comparison import compare_series
+from potential_batch import PotentialFeatures, leaderboard, top_expansions
+from scoring_model import SCORING_MODELS_FILE, ScoringModels
+from score_distributions import ScoreDistributions
+from territory_analyzer import TOTAL_CATEGORIES, TerritoryAnalysisCache, TerritoryDrafts, TerritoryProfile
+from territory_bitsets import TerritoryBitsets, jaccard_matrix, overlap_counts, overlap_potential
+from territory_partition import (BALANCE_COMPONENTS, PartitionProblem, PartitionState, optimize,
+                                 partition_weights, subgraph)
+from response_cache import CompressedResponseCache
+from job_queue import JobQueue
 
 # Initialize Migration
 migrate = Migrate(app, db)
 
 
 
-# Load crop data
-def load_crop_data():
-    try:
-        with open('data/crop_data_static.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        print("Arquivo crop_data_static.json não encontrado")
-        return {}
-    except Exception as e:
-        print(f"Erro ao carregar dados: {e}")
-        return {}
-
-# Load fertilizer data
-def load_fertilizer_data():
-    try:
-        with open('data/fertilizer_data_static_corrigido.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        print("Arquivo fertilizer_data_static_corrigido.json não encontrado")
-        return {}
-    except Exception as e:
-        print(f"Erro ao carregar dados de fertilizantes: {e}")
-        return {}
-
-# Load static data files
-try:
-    with open('data/crop_data_static.json', 'r', encoding='utf-8') as f:
-        CROP_DATA = json.load(f)
-    print(f"Loaded crop data with {len(CROP_DATA)} crops")
-except Exception as e:
-    print(f"Error loading crop data: {e}")
-    CROP_DATA = {}
-
-try:
-    with open('data/fertilizer_data_static_corrigido.json', 'r', encoding='utf-8') as f:
-        FERTILIZER_DATA = json.load(f)
-    print(f"Loaded fertilizer data with {len(FERTILIZER_DATA)} categories")
-except Exception as e:
-    print(f"Error loading fertilizer data: {e}")
-    FERTILIZER_DATA = {}
-
-try:
-    with open('data/agrotoxico_data_static.json', 'r', encoding='utf-8') as f:
-        AGROTOXICO_DATA = json.load(f)
-    print(f"Loaded agrotoxico data with {len(AGROTOXICO_DATA)} categories")
-except Exception as e:
-    print(f"Error loading agrotoxico data: {e}")
-    AGROTOXICO_DATA = {}
-
-try:
-    with open('data/consultoria_tecnica_data_static.json', 'r', encoding='utf-8') as f:
-        CONSULTORIA_DATA = json.load(f)
-    print(f"Loaded consultoria tecnica data with {len(CONSULTORIA_DATA)} categories")
-except Exception as e:
-    print(f"Error loading consultoria tecnica data: {e}")
-    CONSULTORIA_DATA = {}
-
-try:
-    with open('data/corretivos_data_static.json', 'r', encoding='utf-8') as f:
-        CORRETIVOS_DATA = json.load(f)
-    print(f"Loaded corretivos data with {len(CORRETIVOS_DATA)} categories")
-except Exception as e:
-    print(f"Error loading corretivos data: {e}")
-    CORRETIVOS_DATA = {}
-
-try:
-    with open('data/despesa_data_static.json', 'r', encoding='utf-8') as f:
-        DESPESA_DATA = json.load(f)
-    print(f"Loaded despesa data with {len(DESPESA_DATA)} categories")
-except Exception as e:
-    print(f"Error loading despesa data: {e}")
-    DESPESA_DATA = {}
-
-try:
-    with open('data/escolaridade_data_static.json', 'r', encoding='utf-8') as f:
-        ESCOLARIDADE_DATA = json.load(f)
-    print(f"Loaded escolaridade data with {len(ESCOLARIDADE_DATA)} categories")
-except Exception as e:
-    print(f"Error loading escolaridade data: {e}")
-    ESCOLARIDADE_DATA = {}
-
-try:
-    with open('data/receita_data_static.json', 'r', encoding='utf-8') as f:
-        RECEITA_DATA = json.load(f)
-    print(f"Loaded receita data with {len(RECEITA_DATA)} categories")
-except Exception as e:
-    print(f"Error loading receita data: {e}")
-    RECEITA_DATA = {}
+# Load static data files (snapshot binário com mmap; JSON como fallback)
+DATASETS = DatasetEngine.load('data')
+MUNICIPALITY_SEARCH = MunicipalitySearchIndex(DATASETS)
+RANKINGS = RankingIndex(DATASETS)
+SUMMARIES = StatisticalSummaries(DATASETS, RANKINGS)
+STATE_AGGREGATES = StateAggregator(DATASETS, RANKINGS)
+
+# Análises de território (potencial e análise comercial) por conjunto de municípios
+TERRITORY_CACHE = TerritoryAnalysisCache(DATASETS, max_entries=int(os.environ.get('TERRITORY_CACHE_MAX_ENTRIES', '256')))
+
+# Colunas por município para pontuar muitos territórios de uma vez (/api/analise-potencial/batch)
+POTENTIAL_FEATURES = PotentialFeatures(DATASETS)
+
+# Territórios de referência (nacionais e por UF) da normalização por percentil, sorteados na primeira pontuação
+SCORE_DISTRIBUTIONS = ScoreDistributions(POTENTIAL_FEATURES)
+
+# Modelos de pontuação de potencial (pesos/normalizações versionados em data/scoring_models.json)
+SCORING_MODELS = ScoringModels(os.environ.get('SCORING_MODELS_FILE', SCORING_MODELS_FILE),
+                               active=os.environ.get('SCORING_MODEL'), distributions=SCORE_DISTRIBUTIONS)
+
+# Versão do grafo de vizinhança do snapshot (ETag das consultas de vizinhos)
+GRAPH_VERSION = content_hash(np.asarray(DATASETS.graph.indptr), np.asarray(DATASETS.graph.indices)) \
+    if DATASETS.graph is not None else None
+
+# Territórios de revendas/vendedores como bitsets sobre o cadastro (sobreposição entre parceiros)
+TERRITORY_BITSETS = TerritoryBitsets(DATASETS.index)
+
+# Territórios em edição, com agregados atualizados a cada município incluído/removido
+TERRITORY_DRAFTS = TerritoryDrafts(DATASETS, max_entries=int(os.environ.get('TERRITORY_DRAFTS_MAX_ENTRIES', '64')))
+
+# Corpos JSON pré-serializados/pré-comprimidos das respostas por categoria (limite em MB)
+RESPONSE_CACHE = CompressedResponseCache(max_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_MB', '64')) * 1024 * 1024)
+
+# Exportações e análises pesadas em segundo plano (?async=1), com resultados em disco por JOB_RESULT_TTL_HOURS
+JOB_QUEUE = JobQueue(os.environ.get('JOBS_DIR', os.path.join('instance', 'jobs')),
+                     workers=int(os.environ.get('JOB_WORKERS', '2')),
+                     ttl=int(os.environ.get('JOB_RESULT_TTL_HOURS', '24')) * 3600,
+                     context=app.app_context)
+
+# Respostas das bases estáticas só mudam quando os arquivos de dados mudam:
+# o navegador reutiliza a cópia local por até 1h e depois revalida com ETag
+DATASET_CACHE_CONTROL = 'public, max-age=3600, must-revalidate'
+
+def conditional_etag_response(etag, build_response, last_modified=None, cache_control=DATASET_CACHE_CONTROL):
+    """Responde 304 se o cliente já tem a versão etag; senão monta a resposta e a marca com ETag/Last-Modified"""
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response('', 304)
+    else:
+        response = make_response(build_response())
+        if response.status_code != 200:
+            return response
+    # ETag fraca quando o corpo está comprimido (mesma versão, outra codificação)
+    response.set_etag(etag, weak='Content-Encoding' in response.headers)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def conditional_response(current_etag):
+    """Marca a resposta com a ETag atual (e Last-Modified dos dados) e responde 304 se o cliente já tem essa versão
+
+    current_etag recebe os mesmos argumentos da view; se retornar None a view responde sem cache condicional.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = current_etag(*args, **kwargs)
+            if etag is None:
+                return view(*args, **kwargs)
+            return conditional_etag_response(etag, lambda: view(*args, **kwargs), DATASETS.last_modified)
+        return wrapper
+    return decorator
+
+def conditional_dataset_response(*sources):
+    """ETag/Last-Modified pelas versões das fontes (ver conditional_response)"""
+    return conditional_response(lambda *args, **kwargs: content_hash(*[DATASETS[source].version for source in sources]))
+
+def cached_dataset_response(source, key, build_payload):
+    """Resposta servida do cache de bytes comprimidos, por versão do dataset"""
+    return RESPONSE_CACHE.respond((source, DATASETS[source].version) + tuple(key), build_payload)
+
+def layer_format():
+    """Formato pedido para camadas do mapa: ?format=columnar|records e ?fields=campo1,campo2"""
+    layout = 'columnar' if request.args.get('format') == 'columnar' else 'records'
+    fields = request.args.get('fields')
+    if fields:
+        fields = tuple(sorted({field.strip() for field in fields.split(',') if field.strip()}))
+    return layout, fields or None
+
+def layer_data(dataset, category, rows=None, value_field=None, default_unit=None):
+    """Dados de uma camada no formato pedido: {código: registro} ou arrays paralelos (codes/values/unit)"""
+    layout, fields = layer_format()
+    if layout == 'columnar':
+        return dataset.columnar(category, rows, default_unit=default_unit, fields=fields)
+    return dataset.records(category, rows, value_field=value_field, default_unit=default_unit, fields=fields)
+
+def cached_layer_response(source, key, build_payload):
+    """Como cached_dataset_response, separando as entradas por formato e projeção de campos"""
+    layout, fields = layer_format()
+    payload = (lambda: dict(build_payload(), format='columnar')) if layout == 'columnar' else build_payload
+    return cached_dataset_response(source, tuple(key) + (layout, fields), payload)
+
+def filter_valid_municipalities(dataset, positions, check_keywords=True, check_excluded_names=True):
+    """Mantém apenas posições com códigos IBGE reais de municípios (bitmask calculada na carga)"""
+    return positions[dataset.valid_mask(check_keywords, check_excluded_names)[positions]]
+
+# Campo de valor e unidade padrão por fonte nas camadas do mapa (fertilizantes usam o nome das culturas)
+LAYER_VALUE_OPTIONS = {
+    'fertilizers': {'value_field': 'harvested_area', 'default_unit': 'un'}
+}
+
+def layer_rows(source, category):
+    """Posições servidas numa camada do mapa: culturas e fertilizantes só com municípios válidos, demais bases completas"""
+    dataset = DATASETS[source]
+    rows = dataset.rows(category)
+    if source == 'crops':
+        return filter_valid_municipalities(dataset, rows)
+    if source == 'fertilizers':
+        return filter_valid_municipalities(dataset, rows, check_excluded_names=False)
+    return rows
+
+def municipality_name_and_state(code):
+    """Nome e UF de um município pelo cadastro canônico ('' se o código é desconhecido)"""
+    municipality = DATASETS.index.lookup(code)
+    if municipality is None:
+        return '', ''
+    return municipality['name'], municipality['state']
 
 @app.route('/')
 @login_required
@@ -161,35 +220,27 @@ def get_states():
 @app.route('/api/statistics')
 def get_statistics():
     try:
-        # CROP_DATA structure: {crop_name: {municipality_code: {data}}}
-        total_crops = len(CROP_DATA)
-        total_fertilizer_categories = len(FERTILIZER_DATA)
-        total_agrotoxico_categories = len(AGROTOXICO_DATA)
-        total_consultoria_categories = len(CONSULTORIA_DATA)
-        total_corretivos_categories = len(CORRETIVOS_DATA)
-        total_despesa_categories = len(DESPESA_DATA)
-        total_escolaridade_categories = len(ESCOLARIDADE_DATA)
-        total_receita_categories = len(RECEITA_DATA)
-
-        # Count unique municipalities across all crops
-        all_municipalities = set()
-        for crop_data in CROP_DATA.values():
-            all_municipalities.update(crop_data.keys())
-
-        # Count unique municipalities across all fertilizer categories
-        all_fertilizer_municipalities = set()
-        for fertilizer_data in FERTILIZER_DATA.values():
-            all_fertilizer_municipalities.update(fertilizer_data.keys())
-
-        total_municipalities = len(all_municipalities)
-        total_fertilizer_municipalities = len(all_fertilizer_municipalities)
+        crops = DATASETS['crops']
+        fertilizers = DATASETS['fertilizers']
+
+        total_crops = len(crops)
+        total_fertilizer_categories = len(fertilizers)
+        total_agrotoxico_categories = len(DATASETS['agrotoxico'])
+        total_consultoria_categories = len(DATASETS['consultoria'])
+        total_corretivos_categories = len(DATASETS['corretivos'])
+        total_despesa_categories = len(DATASETS['despesa'])
+        total_escolaridade_categories = len(DATASETS['escolaridade'])
+        total_receita_categories = len(DATASETS['receita'])
+
+        # Municípios únicos com dados em ao menos uma cultura / categoria de fertilizante
+        total_municipalities = len(crops.municipality_rows())
+        total_fertilizer_municipalities = len(fertilizers.municipality_rows())
 
         # Calculate total establishments for fertilizer data
         total_establishments = 0
-        if 'Total Estabelecimentos' in FERTILIZER_DATA:
-            for municipality_data in FERTILIZER_DATA['Total Estabelecimentos'].values():
-                if isinstance(municipality_data, dict) and 'value' in municipality_data:
-                    total_establishments += municipality_data.get('value', 0)
+        if 'Total Estabelecimentos' in fertilizers:
+            total_establishments = fertilizers.as_number(
+                fertilizers.column('Total Estabelecimentos').sum(), ['Total Estabelecimentos'])
 
         return jsonify({
             'success': True,
@@ -220,10 +271,10 @@ def get_statistics():
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/crops')
+@conditional_dataset_response('crops')
 def get_crops():
     try:
-        # CROP_DATA structure: {crop_name: {municipality_code: {data}}}
-        sorted_crops = sorted(list(CROP_DATA.keys()))
+        sorted_crops = sorted(DATASETS['crops'].categories)
         return jsonify({
             'success': True,
             'crops': sorted_crops
@@ -232,10 +283,10 @@ def get_crops():
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/fertilizer-categories')
+@conditional_dataset_response('fertilizers')
 def get_fertilizer_categories():
     try:
-        # FERTILIZER_DATA structure: {category_name: {municipality_code: {data}}}
-        categories = sorted(list(FERTILIZER_DATA.keys()))
+        categories = sorted(DATASETS['fertilizers'].categories)
         return jsonify({
             'success': True,
             'categories': categories
@@ -244,9 +295,10 @@ def get_fertilizer_categories():
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/agrotoxico/categories')
+@conditional_dataset_response('agrotoxico')
 def get_agrotoxico_categories():
     try:
-        categories = list(AGROTOXICO_DATA.keys())
+        categories = list(DATASETS['agrotoxico'].categories)
         return jsonify({
             "success": True,
             "categories": categories,
@@ -259,9 +311,10 @@ def get_agrotoxico_categories():
         }), 500
 
 @app.route('/api/consultoria/categories')
+@conditional_dataset_response('consultoria')
 def get_consultoria_categories():
     try:
-        categories = list(CONSULTORIA_DATA.keys())
+        categories = list(DATASETS['consultoria'].categories)
         return jsonify({
             "success": True,
             "categories": categories,
@@ -274,9 +327,10 @@ def get_consultoria_categories():
         }), 500
 
 @app.route('/api/corretivos/categories')
+@conditional_dataset_response('corretivos')
 def get_corretivos_categories():
     try:
-        categories = list(CORRETIVOS_DATA.keys())
+        categories = list(DATASETS['corretivos'].categories)
         return jsonify({
             "success": True,
             "categories": categories,
@@ -289,9 +343,10 @@ def get_corretivos_categories():
         }), 500
 
 @app.route('/api/despesa/categories')
+@conditional_dataset_response('despesa')
 def get_despesa_categories():
     try:
-        categories = list(DESPESA_DATA.keys())
+        categories = list(DATASETS['despesa'].categories)
         return jsonify({
             "success": True,
             "categories": categories,
@@ -304,9 +359,10 @@ def get_despesa_categories():
         }), 500
 
 @app.route('/api/escolaridade/categories')
+@conditional_dataset_response('escolaridade')
 def get_escolaridade_categories():
     try:
-        categories = list(ESCOLARIDADE_DATA.keys())
+        categories = list(DATASETS['escolaridade'].categories)
         return jsonify({
             "success": True,
             "categories": categories,
@@ -319,9 +375,10 @@ def get_escolaridade_categories():
         }), 500
 
 @app.route('/api/receita/categories')
+@conditional_dataset_response('receita')
 def get_receita_categories():
     try:
-        categories = list(RECEITA_DATA.keys())
+        categories = list(DATASETS['receita'].categories)
         return jsonify({
             "success": True,
             "categories": categories,
@@ -334,44 +391,25 @@ def get_receita_categories():
         }), 500
 
 @app.route('/api/fertilizer-data/<category_name>')
+@conditional_dataset_response('fertilizers')
 def get_fertilizer_data(category_name):
     try:
+        fertilizers = DATASETS['fertilizers']
+
         # Busca exata primeiro
-        if category_name in FERTILIZER_DATA:
-            all_fertilizer_data = FERTILIZER_DATA[category_name]
-
-            # Filtrar apenas municípios válidos (códigos IBGE reais de municípios)
-            fertilizer_municipalities = {}
-            for municipality_code, municipality_data in all_fertilizer_data.items():
-                municipality_code_str = str(municipality_code)
-                municipality_name = municipality_data.get('municipality_name', '').lower()
-
-                # Verificar se é um código de município válido
-                if (len(municipality_code_str) == 7 and 
-                    municipality_code_str.isdigit() and
-                    municipality_code_str[0] in '12345' and  # Códigos reais começam com 1-5
-                    municipality_data.get('municipality_name') and
-                    # Excluir nomes que indicam regiões/agregações
-                    not any(keyword in municipality_name for keyword in [
-                        'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                        'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                        'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                        'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                    ])):
-                    # Padronizar o nome do campo para compatibilidade
-                    fertilizer_data = {
-                        'municipality_name': municipality_data.get('municipality_name'),
-                        'state_code': municipality_data.get('state_code'),
-                        'harvested_area': municipality_data.get('value', 0),  # Mapear 'value' para 'harvested_area'
-                        'unit': municipality_data.get('unit', 'un')
-                    }
-                    fertilizer_municipalities[municipality_code] = fertilizer_data
+        if category_name in fertilizers:
+            def build_payload():
+                # Filtrar apenas municípios válidos (códigos IBGE reais de municípios)
+                rows = layer_rows('fertilizers', category_name)
+
+                # Padronizar o nome do campo para compatibilidade ('value' -> 'harvested_area')
+                return {
+                    'success': True,
+                    'data': layer_data(fertilizers, category_name, rows, **LAYER_VALUE_OPTIONS['fertilizers']),
+                    'data_type': 'fertilizer'
+                }
 
-            return jsonify({
-                'success': True,
-                'data': fertilizer_municipalities,
-                'data_type': 'fertilizer'
-            })
+            return cached_layer_response('fertilizers', (category_name,), build_payload)
 
         return jsonify({'success': False, 'error': 'Categoria de fertilizantes não encontrada'})
 
@@ -384,12 +422,13 @@ def get_fertilizer_data_alt(category):
     return get_fertilizer_data(category)
 
 @app.route('/api/agrotoxico/<category>')
+@conditional_dataset_response('agrotoxico')
 def get_agrotoxico_data(category):
     try:
-        if category in AGROTOXICO_DATA:
-            return jsonify({
+        if category in DATASETS['agrotoxico']:
+            return cached_layer_response('agrotoxico', (category,), lambda: {
                 'success': True,
-                'data': AGROTOXICO_DATA[category],
+                'data': layer_data(DATASETS['agrotoxico'], category),
                 'type': 'agrotoxico'
             })
         else:
@@ -404,12 +443,13 @@ def get_agrotoxico_data(category):
         }), 500
 
 @app.route('/api/consultoria/<category>')
+@conditional_dataset_response('consultoria')
 def get_consultoria_data(category):
     try:
-        if category in CONSULTORIA_DATA:
-            return jsonify({
+        if category in DATASETS['consultoria']:
+            return cached_layer_response('consultoria', (category,), lambda: {
                 'success': True,
-                'data': CONSULTORIA_DATA[category],
+                'data': layer_data(DATASETS['consultoria'], category),
                 'category': category
             })
         else:
@@ -424,12 +464,13 @@ def get_consultoria_data(category):
         }), 500
 
 @app.route('/api/corretivos/<category>')
+@conditional_dataset_response('corretivos')
 def get_corretivos_data(category):
     try:
-        if category in CORRETIVOS_DATA:
-            return jsonify({
+        if category in DATASETS['corretivos']:
+            return cached_layer_response('corretivos', (category,), lambda: {
                 'success': True,
-                'data': CORRETIVOS_DATA[category],
+                'data': layer_data(DATASETS['corretivos'], category),
                 'category': category
             })
         else:
@@ -444,12 +485,13 @@ def get_corretivos_data(category):
         }), 500
 
 @app.route('/api/despesa/<category>')
+@conditional_dataset_response('despesa')
 def get_despesa_data(category):
     try:
-        if category in DESPESA_DATA:
-            return jsonify({
+        if category in DATASETS['despesa']:
+            return cached_layer_response('despesa', (category,), lambda: {
                 'success': True,
-                'data': DESPESA_DATA[category],
+                'data': layer_data(DATASETS['despesa'], category),
                 'type': 'despesa'
             })
         else:
@@ -464,12 +506,13 @@ def get_despesa_data(category):
         }), 500
 
 @app.route('/api/escolaridade/<category>')
+@conditional_dataset_response('escolaridade')
 def get_escolaridade_data(category):
     try:
-        if category in ESCOLARIDADE_DATA:
-            return jsonify({
+        if category in DATASETS['escolaridade']:
+            return cached_layer_response('escolaridade', (category,), lambda: {
                 'success': True,
-                'data': ESCOLARIDADE_DATA[category],
+                'data': layer_data(DATASETS['escolaridade'], category),
                 'category': category
             })
         else:
@@ -484,12 +527,13 @@ def get_escolaridade_data(category):
         }), 500
 
 @app.route('/api/receita/<category>')
+@conditional_dataset_response('receita')
 def get_receita_data(category):
     try:
-        if category in RECEITA_DATA:
-            return jsonify({
+        if category in DATASETS['receita']:
+            return cached_layer_response('receita', (category,), lambda: {
                 'success': True,
-                'data': RECEITA_DATA[category],
+                'data': layer_data(DATASETS['receita'], category),
                 'type': 'receita'
             })
         else:
@@ -503,120 +547,323 @@ def get_receita_data(category):
             'error': str(e)
         }), 500
 
-@app.route('/api/crop-data/<crop_name>')
-def get_crop_data(crop_name):
+@app.route('/api/aggregates/<source>/<category>')
+def get_aggregate_data(source, category):
+    """Linhas de agregação regional (Brasil, regiões, UFs, ...) que os endpoints de municípios descartam
+
+    flagged_municipalities: municípios (código IBGE válido) que os endpoints também descartam pelo nome
+    (palavras de região ou nomes excluídos), com os critérios não atendidos em 'flags'.
+    """
     try:
-        # Busca exata primeiro
-        if crop_name in CROP_DATA:
-            all_crop_data = CROP_DATA[crop_name]
-
-            # Filtrar apenas municípios válidos (códigos IBGE reais de municípios)
-            crop_municipalities = {}
-            for municipality_code, municipality_data in all_crop_data.items():
-                municipality_code_str = str(municipality_code)
-                municipality_name = municipality_data.get('municipality_name', '').lower()
-
-                # Verificar se é um código de município válido
-                # Códigos de município IBGE começam com 1-5 e têm 7 dígitos
-                # Excluir códigos que começam com 0 (são agregações regionais)
-                if (len(municipality_code_str) == 7 and 
-                    municipality_code_str.isdigit() and
-                    municipality_code_str[0] in '12345' and  # Códigos reais começam com 1-5
-                    municipality_data.get('municipality_name') and
-                    # Excluir nomes que indicam regiões/agregações
-                    not any(keyword in municipality_name for keyword in [
-                        'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                        'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                        'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                        'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                    ]) and
-                    # Excluir nomes muito genéricos ou que são claramente regiões
-                    municipality_name not in [
-                        'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
-                        'dourados', 'norte mato-grossense', 'portal da amazônia'
-                    ]):
-                    crop_municipalities[municipality_code] = municipality_data
-
-            # Debug: Encontrar o maior produtor para verificação
-            if crop_municipalities:
-                # Ordenar por área colhida para debug
-                sorted_municipalities = sorted(crop_municipalities.items(), 
-                                             key=lambda x: float(x[1].get('harvested_area', 0)), 
-                                             reverse=True)
-                max_municipality = sorted_municipalities[0]
-                print(f"Debug - Maior produtor de {crop_name} (apenas municípios): {max_municipality[1].get('municipality_name')} ({max_municipality[1].get('state_code')}) - {max_municipality[1].get('harvested_area')} hectares")
-
-                # Mostrar top 5 municípios para verificação
-                print(f"Debug - Top 5 municípios produtores de {crop_name}:")
-                for i, (code, data) in enumerate(sorted_municipalities[:5]):
-                    print(f"  {i+1}. {data.get('municipality_name')} ({data.get('state_code')}): {data.get('harvested_area')} ha - Código: {code}")
+        if source not in DATASETS or category not in DATASETS[source]:
+            return jsonify({
+                'success': False,
+                'error': f'Categoria "{category}" não encontrada em "{source}"'
+            }), 404
+
+        kind = request.args.get('kind')
+        return jsonify({
+            'success': True,
+            'data': DATASETS[source].aggregates.records(category, kind),
+            'flagged_municipalities': DATASETS[source].aggregates.flagged_records(category),
+            'source': source,
+            'category': category
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/admin/response-cache')
+@admin_required
+def get_response_cache_stats():
+    """Uso de memória e taxa de acerto do cache de respostas comprimidas"""
+    try:
+        return jsonify({'success': True, 'cache': RESPONSE_CACHE.stats()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/admin/territory-cache')
+@admin_required
+def get_territory_cache_stats():
+    """Acertos, falhas, descartes e invalidações do cache de análises de território"""
+    try:
+        return jsonify({'success': True, 'cache': TERRITORY_CACHE.stats()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/admin/scoring-models')
+@admin_required
+def get_scoring_models():
+    """Modelos de pontuação configurados, com versão e o modelo ativo"""
+    try:
+        return jsonify({'success': True, 'file': SCORING_MODELS.path, 'models': SCORING_MODELS.describe(),
+                        'distributions': SCORE_DISTRIBUTIONS.describe()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/admin/scoring-models/reload', methods=['POST'])
+@admin_required
+def reload_scoring_models():
+    """Relê data/scoring_models.json sem reiniciar; modelos inválidos mantêm os atuais"""
+    global SCORING_MODELS
+    try:
+        try:
+            models = ScoringModels(SCORING_MODELS.path, active=os.environ.get('SCORING_MODEL'),
+                                   distributions=SCORE_DISTRIBUTIONS)
+        except (OSError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        SCORING_MODELS = models
+        return jsonify({'success': True, 'models': SCORING_MODELS.describe()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/municipios/registry')
+@conditional_response(lambda *args, **kwargs: DATASETS.index.version)
+def get_municipality_registry():
+    """Cadastro de municípios em arrays paralelos (nome/UF/região por código), para o formato colunar das camadas"""
+    try:
+        registry = DATASETS.index
+        return RESPONSE_CACHE.respond(('registry', registry.version), lambda: {
+            'success': True,
+            'version': registry.version,
+            'codes': list(registry.codes),
+            'names': registry.names.tolist(),
+            'states': registry.states.tolist(),
+            'regions': registry.regions.tolist()
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# A ordem dos municípios de uma versão do cadastro nunca muda: pode ficar no cache para sempre
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+@app.route('/api/municipios/order/<version>')
+def get_municipality_order(version):
+    """Códigos IBGE na ordem das camadas binárias, publicados por versão do cadastro"""
+    try:
+        registry = DATASETS.index
+        if version != registry.version:
+            return jsonify({
+                'success': False,
+                'error': 'Versão do cadastro de municípios desatualizada',
+                'version': registry.version
+            }), 404
+
+        response = RESPONSE_CACHE.respond(('order', registry.version), lambda: {
+            'success': True,
+            'version': registry.version,
+            'codes': list(registry.codes)
+        })
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def graph_unavailable():
+    return jsonify({
+        'success': False,
+        'error': 'Grafo de vizinhança indisponível: gere o GeoJSON combinado e rode build_snapshot.py'
+    }), 503
+
+def municipality_refs(positions):
+    """[{'code', 'name', 'state'}] de posições do cadastro"""
+    registry = DATASETS.index
+    return [{'code': registry.codes[position], 'name': str(registry.names[position]),
+             'state': str(registry.states[position])} for position in np.asarray(positions).tolist()]
+
+@app.route('/api/municipios/<code>/vizinhos')
+@conditional_response(lambda code: GRAPH_VERSION)
+def get_municipality_neighbours(code):
+    """Municípios que fazem divisa com o informado"""
+    try:
+        if DATASETS.graph is None:
+            return graph_unavailable()
+        position = DATASETS.index.position(code)
+        if position < 0:
+            return jsonify({'success': False, 'error': f'Município {code} não encontrado'}), 404
+        neighbours = DATASETS.graph.neighbours(position)
+        return jsonify({'success': True, 'code': DATASETS.index.codes[position],
+                        'total': len(neighbours), 'neighbours': municipality_refs(neighbours)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/layer-binary/<source>/<category>')
+@conditional_response(lambda source, category: DATASETS[source].version if source in DATASETS else None)
+def get_binary_layer(source, category):
+    """Camada como Float32Array little-endian alinhado à ordem do cadastro (NaN onde não há dado)"""
+    try:
+        if source not in DATASETS or category not in DATASETS[source]:
+            return jsonify({
+                'success': False,
+                'error': f'Categoria "{category}" não encontrada em "{source}"'
+            }), 404
+
+        dataset = DATASETS[source]
+        registry = DATASETS.index
+        response = RESPONSE_CACHE.respond((source, dataset.version, category, 'float32'),
+                                          lambda: dataset.float32_layer(category, layer_rows(source, category)),
+                                          mimetype='application/octet-stream')
+        response.headers['X-Municipality-Order-Version'] = registry.version
+        response.headers['X-Municipality-Order'] = url_for('get_municipality_order', version=registry.version)
+        unit = dataset.units[dataset.category_index[category]]
+        if unit is not None:
+            response.headers['X-Layer-Unit'] = quote(unit)
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+MAX_BATCH_LAYERS = 20
+MAX_BATCH_TERRITORIES = 20
+
+def revenda_territory(revenda_id):
+    """Nome e códigos dos municípios de uma revenda (Supabase), ou None se ela não existe"""
+    result = auth_manager.get_revenda_by_id(revenda_id)
+    if not result['success']:
+        return None
+
+    revenda = result['data']
+    return revenda.get('nome', f'Revenda {revenda_id}'), parse_municipios_codigos(revenda.get('municipios_codigos') or [])
+
+def batch_layers_payload(layers, territories, layout, fields):
+    """Camadas e territórios do /api/layers; no formato colunar todos indexam uma única lista de códigos"""
+    registry = DATASETS.index
+    layer_rows_list = [layer_rows(source, category) if error is None else None
+                       for source, category, error in layers]
+    territory_positions = [registry.resolve(territory[1]) if territory is not None else None
+                           for _, territory in territories]
+
+    if layout == 'columnar':
+        used = [rows for rows in layer_rows_list if rows is not None]
+        used += [positions[positions >= 0] for positions in territory_positions if positions is not None]
+        shared = np.unique(np.concatenate(used)) if used else np.array([], dtype=np.int64)
+        index_of = lambda positions: np.searchsorted(shared, positions).tolist()
+        payload = {'codes': [registry.codes[position] for position in shared.tolist()],
+                   'registry_version': registry.version}
+    else:
+        payload = {}
+
+    payload['layers'] = []
+    for (source, category, error), rows in zip(layers, layer_rows_list):
+        entry = {'source': source, 'category': category}
+        if error is not None:
+            entry['error'] = error
+        elif layout == 'columnar':
+            dataset = DATASETS[source]
+            unit = dataset.units[dataset.category_index[category]]
+            entry['index'] = index_of(rows)
+            entry['values'] = dataset.python_values(category, rows)
+            entry['unit'] = unit if unit is not None else LAYER_VALUE_OPTIONS.get(source, {}).get('default_unit')
+        else:
+            entry['data'] = DATASETS[source].records(category, rows, fields=fields,
+                                                      **LAYER_VALUE_OPTIONS.get(source, {}))
+        payload['layers'].append(entry)
+
+    payload['territories'] = []
+    for (revenda_id, territory), positions in zip(territories, territory_positions):
+        entry = {'id': revenda_id}
+        if territory is None:
+            entry['error'] = 'Revenda não encontrada'
+        else:
+            name, codes = territory
+            entry['name'] = name
+            known = positions >= 0
+            if layout == 'columnar':
+                entry['index'] = index_of(positions[known])
+                entry['unknown_codes'] = [code for code, ok in zip(codes, known.tolist()) if not ok]
             else:
-                print(f"Debug - Nenhum município válido encontrado para {crop_name}")
+                entry['data'] = {}
+                for code in codes:
+                    municipality_name, state_code = municipality_name_and_state(code)
+                    entry['data'][code] = {
+                        'municipality_name': municipality_name or f"Município {code}",
+                        'state_code': state_code or "XX",
+                        'value': 1,
+                        'unit': 'território'
+                    }
+        payload['territories'].append(entry)
+
+    return payload
 
+@app.route('/api/layers')
+@login_required
+def get_layers_batch():
+    """Várias camadas (?layer=fonte/categoria) e territórios (?territory=id_revenda) em uma única requisição"""
+    try:
+        requested = request.args.getlist('layer')
+        territory_ids = request.args.getlist('territory', type=int)
+        if not requested and not territory_ids:
+            return jsonify({'success': False, 'error': 'Informe ao menos uma camada ou território'}), 400
+        if len(requested) > MAX_BATCH_LAYERS or len(territory_ids) > MAX_BATCH_TERRITORIES:
             return jsonify({
+                'success': False,
+                'error': f'Máximo de {MAX_BATCH_LAYERS} camadas e {MAX_BATCH_TERRITORIES} territórios por requisição'
+            }), 400
+
+        layers = []
+        for item in requested:
+            source, _, category = item.partition('/')
+            error = None
+            if source not in DATASETS or category not in DATASETS[source]:
+                error = f'Categoria "{category}" não encontrada em "{source}"'
+            layers.append((source, category, error))
+        territories = [(revenda_id, revenda_territory(revenda_id)) for revenda_id in territory_ids]
+
+        layout, fields = layer_format()
+        etag = content_hash(
+            DATASETS.index.version, layout, list(fields or ()),
+            [[source, category, DATASETS[source].version if error is None else None]
+             for source, category, error in layers],
+            [[revenda_id, list(territory) if territory is not None else None]
+             for revenda_id, territory in territories]
+        )
+
+        def build_response():
+            return RESPONSE_CACHE.respond(('layers', etag), lambda: dict(
+                batch_layers_payload(layers, territories, layout, fields),
+                success=True, format=layout))
+
+        # Territórios vêm do banco e podem mudar a qualquer momento: sempre revalidar
+        if territories:
+            return conditional_etag_response(etag, build_response, cache_control='private, no-cache')
+        return conditional_etag_response(etag, build_response, DATASETS.last_modified)
+    except Exception as e:
+        print(f"Erro em get_layers_batch: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def valid_crop_rows(crop_name):
+    """Posições de uma cultura apenas para municípios válidos"""
+    return layer_rows('crops', crop_name)
+
+@app.route('/api/crop-data/<crop_name>')
+@conditional_dataset_response('crops')
+def get_crop_data(crop_name):
+    try:
+        crops = DATASETS['crops']
+
+        # Busca exata primeiro
+        if crop_name in crops:
+            return cached_layer_response('crops', (crop_name,), lambda: {
                 'success': True,
-                'data': crop_municipalities
+                'data': layer_data(crops, crop_name, valid_crop_rows(crop_name))
             })
 
         # Busca similar se não encontrar exata
         crop_name_lower = crop_name.lower()
         similar_crops = []
 
-        for available_crop in CROP_DATA.keys():
+        for available_crop in crops.categories:
             if crop_name_lower in available_crop.lower() or available_crop.lower() in crop_name_lower:
                 similar_crops.append(available_crop)
 
         if similar_crops:
             # Usar a primeira cultura similar encontrada
             best_match = similar_crops[0]
-            all_crop_data = CROP_DATA[best_match]
-
-            # Filtrar apenas municípios válidos (códigos IBGE reais de municípios)
-            crop_municipalities = {}
-            for municipality_code, municipality_data in all_crop_data.items():
-                municipality_code_str = str(municipality_code)
-                municipality_name = municipality_data.get('municipality_name', '').lower()
-
-                # Verificar se é um código de município válido
-                # Códigos de município IBGE começam com 1-5 e têm 7 dígitos
-                # Excluir códigos que começam com 0 (são agregações regionais)
-                if (len(municipality_code_str) == 7 and 
-                    municipality_code_str.isdigit() and
-                    municipality_code_str[0] in '12345' and  # Códigos reais começam com 1-5
-                    municipality_data.get('municipality_name') and
-                    # Excluir nomes que indicam regiões/agregações
-                    not any(keyword in municipality_name for keyword in [
-                        'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                        'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                        'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                        'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                    ]) and
-                    # Excluir nomes muito genéricos ou que são claramente regiões
-                    municipality_name not in [
-                        'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
-                        'dourados', 'norte mato-grossense', 'portal da amazônia'
-                    ]):
-                    crop_municipalities[municipality_code] = municipality_data
-
-            # Debug: Encontrar o maior produtor para verificação
-            if crop_municipalities:
-                # Ordenar por área colhida para debug
-                sorted_municipalities = sorted(crop_municipalities.items(), 
-                                             key=lambda x: float(x[1].get('harvested_area', 0)), 
-                                             reverse=True)
-                max_municipality = sorted_municipalities[0]
-                print(f"Debug - Maior produtor de {best_match} (apenas municípios): {max_municipality[1].get('municipality_name')} ({max_municipality[1].get('state_code')}) - {max_municipality[1].get('harvested_area')} hectares")
-
-                # Mostrar top 5 municípios para verificação
-                print(f"Debug - Top 5 municípios produtores de {best_match}:")
-                for i, (code, data) in enumerate(sorted_municipalities[:5]):
-                    print(f"  {i+1}. {data.get('municipality_name')} ({data.get('state_code')}): {data.get('harvested_area')} ha - Código: {code}")
-            else:
-                print(f"Debug - Nenhum município válido encontrado para {best_match}")
 
-            return jsonify({
+            return cached_layer_response('crops', (crop_name, best_match), lambda: {
                 'success': True,
-                'data': crop_municipalities,
+                'data': layer_data(crops, best_match, valid_crop_rows(best_match)),
                 'matched_crop': best_match
             })
 
@@ -631,47 +878,17 @@ def get_crop_data(crop_name):
 @app.route('/api/crop-chart-data/<crop_name>')
 def get_crop_chart_data(crop_name):
     try:
-        if crop_name not in CROP_DATA:
+        crops = DATASETS['crops']
+        if crop_name not in crops:
             return jsonify({'success': False, 'error': 'Cultura não encontrada'})
 
-        crop_municipalities = []
-        for municipality_code, municipality_data in CROP_DATA[crop_name].items():
-            # Filtrar apenas municípios válidos (códigos IBGE reais de municípios)
-            municipality_code_str = str(municipality_code)
-            municipality_name = municipality_data.get('municipality_name', '').lower()
-
-            # Verificar se é um código de município válido
-            # Códigos de município IBGE começam com 1-5 e têm 7 dígitos
-            # Excluir códigos que começam com 0 (são agregações regionais)
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and  # Códigos reais começam com 1-5
-                municipality_data.get('municipality_name') and
-                # Excluir nomes que indicam regiões/agregações
-                not any(keyword in municipality_name for keyword in [
-                    'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                    'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                    'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                    'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                ]) and
-                # Excluir nomes muito genéricos ou que são claramente regiões
-                municipality_name not in [
-                    'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
-                    'dourados', 'norte mato-grossense', 'portal da amazônia'
-                ]):
-                crop_municipalities.append({
-                    'municipality_name': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'state_code': municipality_data.get('state_code', 'XX'),
-                    'harvested_area': municipality_data.get('harvested_area', 0)
-                })
-
-        # Sort by harvested area and take top 20
-        crop_municipalities.sort(key=lambda x: x['harvested_area'], reverse=True)
-        top_20 = crop_municipalities[:20]
+        # Top 20 municípios válidos (códigos IBGE reais de municípios) por área colhida
+        top_20 = RANKINGS.top('crops', crop_name, 20)
 
         chart_data = {
-            'labels': [f"{muni['municipality_name']} ({muni['state_code']})" for muni in top_20],
-            'data': [muni['harvested_area'] for muni in top_20]
+            'labels': [f"{name or 'Desconhecido'} ({state or 'XX'})"
+                       for name, state in zip(crops.names[top_20], crops.states[top_20])],
+            'data': crops.python_values(crop_name, top_20)
         }
 
         return jsonify({
@@ -681,56 +898,67 @@ def get_crop_chart_data(crop_name):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+MAX_TOP_N = 100
+
+@app.route('/api/top/<source>/<category>')
+@conditional_response(lambda source, category: DATASETS[source].version if source in DATASETS else None)
+def get_top_municipalities(source, category):
+    """Top-N municípios de uma categoria (nacional ou ?state=UF) e, com ?code=, ranking e percentil de um município"""
+    try:
+        if (source, category) not in RANKINGS:
+            return jsonify({
+                'success': False,
+                'error': f'Categoria "{category}" não encontrada em "{source}"'
+            }), 404
+
+        n = min(max(request.args.get('n', 10, type=int), 1), MAX_TOP_N)
+        state = request.args.get('state') or None
+        dataset = DATASETS[source]
+        top_rows = RANKINGS.top(source, category, n, state)
+        unit = dataset.units[dataset.category_index[category]]
+
+        result = {
+            'success': True,
+            'source': source,
+            'category': category,
+            'state': state,
+            'unit': unit,
+            'total': len(RANKINGS.ordered(source, category, state)),
+            'top': [{
+                'rank': i + 1,
+                'code': dataset.index.codes[position],
+                'name': name,
+                'state': state_code,
+                'value': value
+            } for i, (position, name, state_code, value) in enumerate(zip(
+                top_rows.tolist(), dataset.names[top_rows].tolist(), dataset.states[top_rows].tolist(),
+                dataset.python_values(category, top_rows)))]
+        }
+
+        code = request.args.get('code')
+        if code:
+            position = DATASETS.index.position(code)
+            ranking = RANKINGS.municipality(source, category, position) if position >= 0 else None
+            if ranking is not None:
+                ranking['code'] = code
+                ranking['value'] = dataset.python_values(category, [position])[0]
+            result['municipality'] = ranking
+
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/analysis/statistical-summary/<crop_name>')
 def get_statistical_summary(crop_name):
     try:
-        if crop_name not in CROP_DATA:
+        if crop_name not in DATASETS['crops']:
             return jsonify({'success': False, 'error': 'Cultura não encontrada'})
 
-        # Filtrar apenas municípios válidos (códigos IBGE reais de municípios)
-        values = []
-        for municipality_code, data in CROP_DATA[crop_name].items():
-            municipality_code_str = str(municipality_code)
-            municipality_name = data.get('municipality_name', '').lower()
-
-            # Verificar se é um código de município válido
-            # Códigos de município IBGE começam com 1-5 e têm 7 dígitos
-            # Excluir códigos que começam com 0 (são agregações regionais)
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and  # Códigos reais começam com 1-5
-                data.get('municipality_name') and
-                # Excluir nomes que indicam regiões/agregações
-                not any(keyword in municipality_name for keyword in [
-                    'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                    'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                    'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                    'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                ]) and
-                # Excluir nomes muito genéricos ou que são claramente regiões
-                municipality_name not in [
-                    'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
-                    'dourados', 'norte mato-grossense', 'portal da amazônia'
-                ]):
-                values.append(data['harvested_area'])
-
-        if not values:
+        # Apenas municípios válidos (códigos IBGE reais de municípios)
+        summary = SUMMARIES.summary('crops', crop_name)
+        if summary is None:
             return jsonify({'success': False, 'error': 'Nenhum município válido encontrado para esta cultura'})
 
-        import statistics
-        summary = {
-            'mean': statistics.mean(values),
-            'median': statistics.median(values),
-            'mode': statistics.mode(values) if len(set(values)) < len(values) else None,
-            'std_dev': statistics.stdev(values) if len(values) > 1 else 0,
-            'min': min(values),
-            'max': max(values),
-            'q1': statistics.quantiles(values, n=4)[0] if len(values) >= 4 else None,
-            'q3': statistics.quantiles(values, n=4)[2] if len(values) >= 4 else None,
-            'total': sum(values),
-            'count': len(values)
-        }
-
         return jsonify({
             'success': True,
             'summary': summary
@@ -738,60 +966,50 @@ def get_statistical_summary(crop_name):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/analysis/statistical-summary/<source>/<category>')
+@conditional_response(lambda source, category: DATASETS[source].version if source in DATASETS else None)
+def get_source_statistical_summary(source, category):
+    """Resumo estatístico de qualquer fonte/categoria, nacional ou de uma UF (?state=)"""
+    try:
+        if (source, category) not in RANKINGS:
+            return jsonify({
+                'success': False,
+                'error': f'Categoria "{category}" não encontrada em "{source}"'
+            }), 404
+
+        state = request.args.get('state') or None
+        summary = SUMMARIES.summary(source, category, state)
+        if summary is None:
+            return jsonify({'success': False, 'error': 'Nenhum município válido encontrado para esta categoria'}), 404
+
+        dataset = DATASETS[source]
+        return jsonify({
+            'success': True,
+            'source': source,
+            'category': category,
+            'state': state,
+            'unit': dataset.units[dataset.category_index[category]],
+            'summary': summary
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/analysis/by-state/<crop_name>')
 def get_analysis_by_state(crop_name):
     try:
-        if crop_name not in CROP_DATA:
+        if crop_name not in DATASETS['crops']:
             return jsonify({'success': False, 'error': 'Cultura não encontrada'})
 
-        states_data = {}
-        for municipality_code, municipality_data in CROP_DATA[crop_name].items():
-            # Filtrar apenas municípios válidos (códigos IBGE reais de municípios)
-            municipality_code_str = str(municipality_code)
-            municipality_name = municipality_data.get('municipality_name', '').lower()
-
-            # Verificar se é um código de município válido
-            # Códigos de município IBGE começam com 1-5 e têm 7 dígitos
-            # Excluir códigos que começam com 0 (são agregações regionais)
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and  # Códigos reais começam com 1-5
-                municipality_data.get('municipality_name') and
-                # Excluir nomes que indicam regiões/agregações
-                not any(keyword in municipality_name for keyword in [
-                    'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                    'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                    'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                    'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                ]) and
-                # Excluir nomes muito genéricos ou que são claramente regiões
-                municipality_name not in [
-                    'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
-                    'dourados', 'norte mato-grossense', 'portal da amazônia'
-                ]):
-
-                state = municipality_data.get('state_code', 'XX')
-                area = municipality_data.get('harvested_area', 0)
-
-                if state not in states_data:
-                    states_data[state] = {
-                        'total_area': 0,
-                        'municipalities_count': 0,
-                        'max_area': 0,
-                        'municipalities': []
-                    }
-
-                states_data[state]['total_area'] += area
-                states_data[states_data[state]['municipalities_count']] += 1
-                states_data[state]['max_area'] = max(states_data[state]['max_area'], area)
-                states_data[state]['municipalities'].append({
-                    'name': municipality_data.get('municipality_name'),
-                    'area': area
-                })
-
-        # Calculate averages
-        for state_data in states_data.values():
-            state_data['average_area'] = state_data['total_area'] / state_data['municipalities_count']
+        # Apenas municípios válidos; a lista de municípios de cada UF fica no endpoint paginado
+        states_data = {
+            state: {
+                'total_area': group['total'],
+                'municipalities_count': group['count'],
+                'max_area': group['max'],
+                'average_area': group['average']
+            }
+            for state, group in STATE_AGGREGATES.aggregate('crops', crop_name).items()
+        }
 
         return jsonify({
             'success': True,
@@ -800,27 +1018,96 @@ def get_analysis_by_state(crop_name):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/analysis/by-state/<source>/<category>')
+@conditional_response(lambda source, category: DATASETS[source].version if source in DATASETS else None)
+def get_source_analysis_by_state(source, category):
+    """Total, contagem, máximo e média por UF (ou ?level=region) de qualquer fonte/categoria"""
+    try:
+        if (source, category) not in RANKINGS:
+            return jsonify({
+                'success': False,
+                'error': f'Categoria "{category}" não encontrada em "{source}"'
+            }), 404
+
+        level = request.args.get('level', 'state')
+        if level not in LEVELS:
+            return jsonify({'success': False, 'error': f'Nível inválido: use {", ".join(LEVELS)}'}), 400
+
+        dataset = DATASETS[source]
+        return jsonify({
+            'success': True,
+            'source': source,
+            'category': category,
+            'level': level,
+            'unit': dataset.units[dataset.category_index[category]],
+            'groups': STATE_AGGREGATES.aggregate(source, category, level)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+MAX_DRILL_DOWN_PAGE = 200
+
+@app.route('/api/analysis/by-state/<source>/<category>/<state>/municipalities')
+@conditional_response(lambda source, category, state: DATASETS[source].version if source in DATASETS else None)
+def get_state_municipalities(source, category, state):
+    """Municípios de uma UF em ordem decrescente de valor, paginados (?page=&per_page=)"""
+    try:
+        if (source, category) not in RANKINGS:
+            return jsonify({
+                'success': False,
+                'error': f'Categoria "{category}" não encontrada em "{source}"'
+            }), 404
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), MAX_DRILL_DOWN_PAGE)
+        ordered = RANKINGS.ordered(source, category, state)
+        rows = ordered[(page - 1) * per_page:page * per_page]
+
+        dataset = DATASETS[source]
+        municipalities = [
+            {'code': dataset.index.codes[position], 'name': name, 'value': value}
+            for position, name, value in zip(rows.tolist(), dataset.names[rows].tolist(),
+                                             dataset.python_values(category, rows))
+        ]
+
+        return jsonify({
+            'success': True,
+            'source': source,
+            'category': category,
+            'state': state,
+            'page': page,
+            'per_page': per_page,
+            'total': len(ordered),
+            'has_more': page * per_page < len(ordered),
+            'municipalities': municipalities
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/analysis/comparison/<crop1>/<crop2>')
 def get_crop_comparison(crop1, crop2):
     try:
-        if crop1 not in CROP_DATA or crop2 not in CROP_DATA:
+        crops = DATASETS['crops']
+        if crop1 not in crops or crop2 not in crops:
             return jsonify({'success': False, 'error': 'Uma ou ambas culturas não encontradas'})
 
         # Get common municipalities
-        common_municipalities = set(CROP_DATA[crop1].keys()) & set(CROP_DATA[crop2].keys())
+        j1 = crops.category_index[crop1]
+        j2 = crops.category_index[crop2]
+        common_rows = np.flatnonzero(crops.present[:, j1] & crops.present[:, j2])
 
-        comparison_data = []
-        for muni_code in common_municipalities:
-            data1 = CROP_DATA[crop1][muni_code]
-            data2 = CROP_DATA[crop2][muni_code]
+        areas1 = crops.python_values(crop1, common_rows)
+        areas2 = crops.python_values(crop2, common_rows)
 
+        comparison_data = []
+        for position, area1, area2 in zip(common_rows.tolist(), areas1, areas2):
             comparison_data.append({
-                'municipality_code': muni_code,
-                'municipality_name': data1.get('municipality_name'),
-                'state_code': data1.get('state_code'),
-                'crop1_area': data1.get('harvested_area', 0),
-                'crop2_area': data2.get('harvested_area', 0),
-                'ratio': data1.get('harvested_area', 0) / max(data2.get('harvested_area', 1), 1)
+                'municipality_code': crops.index.codes[position],
+                'municipality_name': crops.names[position],
+                'state_code': crops.states[position],
+                'crop1_area': area1,
+                'crop2_area': area2,
+                'ratio': area1 / max(area2, 1)
             })
 
         return jsonify({
@@ -828,11 +1115,41 @@ def get_crop_comparison(crop1, crop2):
             'crop1': crop1,
             'crop2': crop2,
             'comparison_data': comparison_data,
-            'common_municipalities': len(common_municipalities)
+            'common_municipalities': len(common_rows)
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+MAX_COMPARISON_SERIES = 20
+
+@app.route('/api/analysis/comparison')
+def get_series_comparison():
+    """Compara N séries (?series=fonte/categoria, repetido) nos municípios comuns, com correlações de Pearson e Spearman"""
+    try:
+        series = []
+        for item in request.args.getlist('series'):
+            source, _, category = item.partition('/')
+            if (source, category) not in RANKINGS:
+                return jsonify({
+                    'success': False,
+                    'error': f'Categoria "{category}" não encontrada em "{source}"'
+                }), 404
+            series.append((source, category))
+
+        if len(series) < 2 or len(series) > MAX_COMPARISON_SERIES:
+            return jsonify({
+                'success': False,
+                'error': f'Informe entre 2 e {MAX_COMPARISON_SERIES} séries'
+            }), 400
+
+        state = request.args.get('state') or None
+        etag = content_hash(state or '', [[source, category, DATASETS[source].version] for source, category in series])
+        return conditional_etag_response(etag, lambda: jsonify(dict(
+            compare_series(DATASETS, RANKINGS, series, state), success=True, state=state)),
+            DATASETS.last_modified)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/brazilian-states')
 def get_brazilian_states():
     """Get list of Brazilian states"""
@@ -874,6 +1191,80 @@ def get_brazilian_states():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def no_progress(fraction, message=None):
+    """Progresso ignorado (execução síncrona, dentro da requisição)"""
+
+def wants_job():
+    return request.args.get('async') == '1'
+
+def job_status(job):
+    """Estado público da tarefa, com as URLs de acompanhamento e do resultado"""
+    timestamp = lambda value: datetime.fromtimestamp(value).isoformat() if value else None
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'params': job['params'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'message': job['message'],
+        'error': job['error'],
+        'result': job['result'],
+        'created_at': timestamp(job['created_at']),
+        'started_at': timestamp(job['started_at']),
+        'finished_at': timestamp(job['finished_at']),
+        'status_url': url_for('get_job_status', job_id=job['id']),
+        'result_url': url_for('get_job_result', job_id=job['id'])
+    }
+
+def submit_job(kind, function, params=None):
+    """Enfileira function(progress) e responde 202 com o id da tarefa"""
+    job = JOB_QUEUE.submit(kind, function, owner=session.get('user_id'), params=params)
+    response = jsonify({'success': True, 'job': job_status(job)})
+    response.status_code = 202
+    response.headers['Location'] = url_for('get_job_status', job_id=job['id'])
+    return response
+
+def visible_job(job_id):
+    """Tarefa do usuário atual (tarefas anônimas são visíveis a quem tiver o id); None caso contrário"""
+    job = JOB_QUEUE.get(job_id)
+    if job is None or (job['owner'] is not None and job['owner'] != session.get('user_id')):
+        return None
+    return job
+
+@app.route('/api/jobs/<job_id>')
+def get_job_status(job_id):
+    """Estado e progresso de uma tarefa em segundo plano"""
+    try:
+        job = visible_job(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'Tarefa não encontrada ou expirada'}), 404
+        return jsonify({'success': True, 'job': job_status(job)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>/result')
+def get_job_result(job_id):
+    """Resultado (arquivo ou JSON) de uma tarefa concluída"""
+    try:
+        job = visible_job(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'Tarefa não encontrada ou expirada'}), 404
+        if job['status'] == 'failed':
+            return jsonify({'success': False, 'error': job['error'], 'job': job_status(job)}), 500
+        if job['status'] != 'done':
+            return jsonify({'success': False, 'error': 'Tarefa ainda não concluída', 'job': job_status(job)}), 409
+
+        result = job['result']
+        if result['type'] == 'file':
+            return send_file(JOB_QUEUE.result_path(job_id), mimetype=result['mimetype'],
+                             as_attachment=True, download_name=result['filename'])
+        return send_file(JOB_QUEUE.result_path(job_id), mimetype=result['mimetype'])
+    except Exception as e:
+        print(f"Erro ao obter resultado da tarefa {job_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/export/crops')
 def export_crops_data():
     """Export complete crop database as Excel file"""
@@ -921,119 +1312,27 @@ def export_complete_data():
         print(f"Erro ao exportar dados: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def category_export_frame(dataset, category, rows):
+    """DataFrame (código, município, UF, valor) de uma categoria, na ordem das posições dadas"""
+    return pd.DataFrame({
+        'Código IBGE': [dataset.index.codes[position] for position in rows.tolist()],
+        'Município': dataset.names[rows],
+        'UF': dataset.states[rows],
+        'Valor': dataset.python_values(category, rows)
+    })
+
 @app.route('/api/export/complete-fertilizer-data')
 def export_complete_fertilizer_data():
-    """Export complete fertilizer database as Excel file"""
+    """Export complete fertilizer database as Excel file (?async=1: tarefa em segundo plano)"""
     try:
-        # Preparar todos os dados de fertilizantes para exportação
-        all_fertilizer_data = []
-
-        for category_name, category_data in FERTILIZER_DATA.items():
-            for municipality_code, municipality_data in category_data.items():
-                # Filtrar apenas municípios válidos
-                municipality_code_str = str(municipality_code)
-                municipality_name = municipality_data.get('municipality_name', '').lower()
-
-                if (len(municipality_code_str) == 7 and 
-                    municipality_code_str.isdigit() and
-                    municipality_code_str[0] in '12345' and
-                    municipality_data.get('municipality_name') and
-                    not any(keyword in municipality_name for keyword in [
-                        'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                        'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                        'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                        'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                    ])):
-
-                    all_fertilizer_data.append({
-                        'Código IBGE': municipality_code,
-                        'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                        'UF': municipality_data.get('state_code', 'XX'),
-                        'Categoria': category_name,
-                        'Valor': municipality_data.get('value', 0),
-                        'Unidade': 'estabelecimentos',
-                        'Ano': 2023
-                    })
-
-        # Ordenar por categoria e depois por valor
-        all_fertilizer_data.sort(key=lambda x: (x['Categoria'], -x['Valor']))
-
-        # Criar DataFrame principal
-        df_main = pd.DataFrame(all_fertilizer_data)
-
-        # Criar resumo por categoria
-        category_summary = df_main.groupby('Categoria').agg({
-            'Valor': ['sum', 'count', 'mean', 'max', 'min']
-        }).round(2)
-        category_summary.columns = ['Valor Total', 'Nº Municípios', 'Valor Médio', 'Valor Máximo', 'Valor Mínimo']
-        category_summary = category_summary.sort_values('Valor Total', ascending=False)
-        category_summary.reset_index(inplace=True)
-
-        # Criar resumo por estado
-        state_summary = df_main.groupby('UF').agg({
-            'Valor': ['sum', 'count', 'mean']
-        }).round(2)
-        state_summary.columns = ['Valor Total', 'Nº Municípios', 'Valor Médio']
-        state_summary = state_summary.sort_values('Valor Total', ascending=False)
-        state_summary.reset_index(inplace=True)
-
-        # Criar dados de resumo geral
-        total_categories = df_main['Categoria'].nunique()
-        total_municipalities = df_main['Código IBGE'].nunique()
-        total_records = len(df_main)
-        total_value = df_main['Valor'].sum()
-        avg_value = df_main['Valor'].mean()
-
-        general_summary = pd.DataFrame([
-            ['Estatística', 'Valor'],
-            ['Base de Dados', 'Fertilizantes - Censo Agropecuário 2017'],
-            ['Ano de Referência', 2023],
-            ['Total de Categorias', total_categories],
-            ['Total de Municípios', total_municipalities],
-            ['Total de Registros', total_records],
-            ['Valor Total Geral', f'{total_value:,.0f}'],
-            ['Valor Médio Geral', f'{avg_value:,.2f}'],
-            ['Data da Exportação', pd.Timestamp.now().strftime('%d/%m/%Y %H:%M:%S')]
-        ])
-
-        # Criar arquivo Excel
-        output = io.BytesIO()
-
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Planilha principal com todos os dados
-            df_main.to_excel(writer, sheet_name='Dados Completos', index=False)
-
-            # Planilha de resumo geral
-            general_summary.to_excel(writer, sheet_name='Resumo Geral', index=False, header=False)
-
-            # Planilha de resumo por categoria
-            category_summary.to_excel(writer, sheet_name='Resumo por Categoria', index=False)
-
-            # Planilha de resumo por estado
-            state_summary.to_excel(writer, sheet_name='Resumo por Estado', index=False)
-
-            # Criar planilhas separadas para cada categoria (máximo 10 categorias principais)
-            top_categories = category_summary.head(10)
-            for _, category_row in top_categories.iterrows():
-                category_name = category_row['Categoria']
-                safe_name = category_name.replace('/', '_').replace('\\', '_').replace(':', '_')[:30]
-
-                category_df = df_main[df_main['Categoria'] == category_name].copy()
-                category_df = category_df.sort_values('Valor', ascending=False)
+        if wants_job():
+            return submit_job('complete-fertilizer-data', complete_fertilizer_workbook)
 
-                try:
-                    category_df.to_excel(writer, sheet_name=safe_name, index=False)
-                except Exception as e:
-                    print(f"Erro ao criar planilha para categoria {category_name}: {e}")
-
-        output.seek(0)
-
-        # Nome do arquivo
-        filename = f'base_completa_fertilizantes_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+        output, filename = complete_fertilizer_workbook()
 
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=XLSX_MIMETYPE,
             as_attachment=True,
             download_name=filename
         )
@@ -1042,53 +1341,117 @@ def export_complete_fertilizer_data():
         print(f"Erro ao exportar base completa de fertilizantes: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def complete_fertilizer_workbook(progress=no_progress):
+    """(planilha Excel, nome do arquivo) da base completa de fertilizantes com resumos"""
+    fertilizers = DATASETS['fertilizers']
+
+    # Preparar todos os dados de fertilizantes para exportação
+    category_frames = []
+    categories = sorted(fertilizers.categories)
+    for done, category_name in enumerate(categories):
+        progress(0.6 * done / max(len(categories), 1), f'Categoria {category_name}')
+        # Apenas municípios válidos, ordenados por valor
+        rows = RANKINGS.ordered('fertilizers', category_name)
+        category_frame = category_export_frame(fertilizers, category_name, rows)
+        category_frame.insert(3, 'Categoria', category_name)
+        category_frame['Unidade'] = 'estabelecimentos'
+        category_frame['Ano'] = 2023
+        category_frames.append(category_frame)
+
+    # Ordenado por categoria e depois por valor
+    df_main = pd.concat(category_frames, ignore_index=True) if category_frames else pd.DataFrame(
+        columns=['Código IBGE', 'Município', 'UF', 'Categoria', 'Valor', 'Unidade', 'Ano'])
+
+    # Criar resumo por categoria
+    category_summary = df_main.groupby('Categoria').agg({
+        'Valor': ['sum', 'count', 'mean', 'max', 'min']
+    }).round(2)
+    category_summary.columns = ['Valor Total', 'Nº Municípios', 'Valor Médio', 'Valor Máximo', 'Valor Mínimo']
+    category_summary = category_summary.sort_values('Valor Total', ascending=False)
+    category_summary.reset_index(inplace=True)
+
+    # Criar resumo por estado
+    state_summary = df_main.groupby('UF').agg({
+        'Valor': ['sum', 'count', 'mean']
+    }).round(2)
+    state_summary.columns = ['Valor Total', 'Nº Municípios', 'Valor Médio']
+    state_summary = state_summary.sort_values('Valor Total', ascending=False)
+    state_summary.reset_index(inplace=True)
+
+    # Criar dados de resumo geral
+    total_categories = df_main['Categoria'].nunique()
+    total_municipalities = df_main['Código IBGE'].nunique()
+    total_records = len(df_main)
+    total_value = df_main['Valor'].sum()
+    avg_value = df_main['Valor'].mean()
+
+    general_summary = pd.DataFrame([
+        ['Estatística', 'Valor'],
+        ['Base de Dados', 'Fertilizantes - Censo Agropecuário 2017'],
+        ['Ano de Referência', 2023],
+        ['Total de Categorias', total_categories],
+        ['Total de Municípios', total_municipalities],
+        ['Total de Registros', total_records],
+        ['Valor Total Geral', f'{total_value:,.0f}'],
+        ['Valor Médio Geral', f'{avg_value:,.2f}'],
+        ['Data da Exportação', pd.Timestamp.now().strftime('%d/%m/%Y %H:%M:%S')]
+    ])
+
+    # Criar arquivo Excel
+    progress(0.6, 'Gerando planilhas')
+    output = io.BytesIO()
+
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        # Planilha principal com todos os dados
+        df_main.to_excel(writer, sheet_name='Dados Completos', index=False)
+
+        # Planilha de resumo geral
+        general_summary.to_excel(writer, sheet_name='Resumo Geral', index=False, header=False)
+
+        # Planilha de resumo por categoria
+        category_summary.to_excel(writer, sheet_name='Resumo por Categoria', index=False)
+
+        # Planilha de resumo por estado
+        state_summary.to_excel(writer, sheet_name='Resumo por Estado', index=False)
+
+        # Criar planilhas separadas para cada categoria (máximo 10 categorias principais)
+        top_categories = category_summary.head(10)
+        for _, category_row in top_categories.iterrows():
+            category_name = category_row['Categoria']
+            safe_name = category_name.replace('/', '_').replace('\\', '_').replace(':', '_')[:30]
+
+            category_df = df_main[df_main['Categoria'] == category_name].copy()
+            category_df = category_df.sort_values('Valor', ascending=False)
+
+            try:
+                category_df.to_excel(writer, sheet_name=safe_name, index=False)
+            except Exception as e:
+                print(f"Erro ao criar planilha para categoria {category_name}: {e}")
+
+    output.seek(0)
+
+    # Nome do arquivo
+    filename = f'base_completa_fertilizantes_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+
+    return output, filename
+
 @app.route('/api/export/fertilizer-analysis/<category_name>')
 def export_fertilizer_analysis(category_name):
     """Export fertilizer analysis data as Excel file"""
     try:
         # Obter parâmetro de estado opcional
         state_filter = request.args.get('state')
+        fertilizers = DATASETS['fertilizers']
 
-        if category_name not in FERTILIZER_DATA:
+        if category_name not in fertilizers:
             return jsonify({'success': False, 'error': 'Categoria de fertilizantes não encontrada'}), 404
 
-        # Preparar dados para exportação
-        analysis_data = []
-        for municipality_code, municipality_data in FERTILIZER_DATA[category_name].items():
-            # Filtrar apenas municípios válidos
-            municipality_code_str = str(municipality_code)
-            municipality_name = municipality_data.get('municipality_name', '').lower()
-
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and
-                municipality_data.get('municipality_name') and
-                not any(keyword in municipality_name for keyword in [
-                    'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                    'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                    'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                    'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                ])):
-
-                # Aplicar filtro de estado se especificado
-                if state_filter and municipality_data.get('state_code') != state_filter:
-                    continue
-
-                analysis_data.append({
-                    'Código IBGE': municipality_code,
-                    'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'UF': municipality_data.get('state_code', 'XX'),
-                    'Categoria': category_name,
-                    'Valor': municipality_data.get('value', 0),
-                    'Unidade': 'estabelecimentos',
-                    'Ano': 2023
-                })
-
-        # Ordenar por valor (maior para menor)
-        analysis_data.sort(key=lambda x: x['Valor'], reverse=True)
-
-        # Criar DataFrame
-        df = pd.DataFrame(analysis_data)
+        # Preparar dados para exportação (apenas municípios válidos, ordenados por valor)
+        rows = RANKINGS.ordered('fertilizers', category_name, state_filter)
+        df = category_export_frame(fertilizers, category_name, rows)
+        df.insert(3, 'Categoria', category_name)
+        df['Unidade'] = 'estabelecimentos'
+        df['Ano'] = 2023
 
         # Calcular estatísticas resumidas
         total_value = df['Valor'].sum()
@@ -1163,50 +1526,17 @@ def export_crop_analysis(crop_name):
     try:
         # Obter parâmetro de estado opcional
         state_filter = request.args.get('state')
+        crops = DATASETS['crops']
 
-        if crop_name not in CROP_DATA:
+        if crop_name not in crops:
             return jsonify({'success': False, 'error': 'Cultura não encontrada'}), 404
 
-        # Preparar dados para exportação
-        analysis_data = []
-        for municipality_code, municipality_data in CROP_DATA[crop_name].items():
-            # Filtrar apenas municípios válidos
-            municipality_code_str = str(municipality_code)
-            municipality_name = municipality_data.get('municipality_name', '').lower()
-
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and
-                municipality_data.get('municipality_name') and
-                not any(keyword in municipality_name for keyword in [
-                    'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                    'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                    'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                    'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                ]) and
-                municipality_name not in [
-                    'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
-                    'dourados', 'norte mato-grossense', 'portal da amazônia'
-                ]):
-
-                # Aplicar filtro de estado se especificado
-                if state_filter and municipality_data.get('state_code') != state_filter:
-                    continue
-
-                analysis_data.append({
-                    'Código IBGE': municipality_code,
-                    'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'UF': municipality_data.get('state_code', 'XX'),
-                    'Cultura': crop_name,
-                    'Área Colhida (hectares)': municipality_data.get('harvested_area', 0),
-                    'Ano': 2023
-                })
-
-        # Ordenar por área colhida (maior para menor)
-        analysis_data.sort(key=lambda x: x['Área Colhida (hectares)'], reverse=True)
-
-        # Criar DataFrame
-        df = pd.DataFrame(analysis_data)
+        # Preparar dados para exportação (apenas municípios válidos, ordenados por área colhida)
+        rows = RANKINGS.ordered('crops', crop_name, state_filter)
+        df = category_export_frame(crops, crop_name, rows)
+        df = df.rename(columns={'Valor': 'Área Colhida (hectares)'})
+        df.insert(3, 'Cultura', crop_name)
+        df['Ano'] = 2023
 
         # Calcular estatísticas resumidas
         total_area = df['Área Colhida (hectares)'].sum()
@@ -1275,57 +1605,44 @@ def export_crop_analysis(crop_name):
         print(f"Erro ao exportar análise: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def export_category_analysis(source, category, label, not_found_message, default_unit='un'):
+    """Exporta a análise de uma categoria de fonte simples (agrotóxico, consultoria, ...) como Excel"""
+    state_filter = request.args.get('state')
+    dataset = DATASETS[source]
+
+    if category not in dataset:
+        return jsonify({'success': False, 'error': not_found_message}), 404
+
+    # Apenas códigos IBGE de município (7 dígitos iniciando em 1-5), ordenados por valor
+    rows = RANKINGS.ordered(source, category, state_filter)
+    df = category_export_frame(dataset, category, rows)
+    df.insert(3, 'Categoria', category)
+    unit = dataset.units[dataset.category_index[category]]
+    df['Unidade'] = unit if unit is not None else default_unit
+    df['Ano'] = 2023
+
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Dados Detalhados', index=False)
+
+    output.seek(0)
+    safe_category_name = category.replace('/', '_').replace('\\', '_').replace(':', '_')
+    state_suffix = f'_{state_filter}' if state_filter else '_Nacional'
+    filename = f'analise_{label}_{safe_category_name}{state_suffix}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=filename
+    )
+
 @app.route('/api/export/agrotoxico-analysis/<category>')
 def export_agrotoxico_analysis(category):
     """Export agrotóxico analysis data as Excel file"""
     try:
-        state_filter = request.args.get('state')
-
-        if category not in AGROTOXICO_DATA:
-            return jsonify({'success': False, 'error': 'Categoria de agrotóxico não encontrada'}), 404
-
-        analysis_data = []
-        for municipality_code, municipality_data in AGROTOXICO_DATA[category].items():
-            municipality_code_str = str(municipality_code)
-            municipality_name = municipality_data.get('municipality_name', '').lower()
-
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and
-                municipality_data.get('municipality_name')):
-
-                if state_filter and municipality_data.get('state_code') != state_filter:
-                    continue
-
-                analysis_data.append({
-                    'Código IBGE': municipality_code,
-                    'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'UF': municipality_data.get('state_code', 'XX'),
-                    'Categoria': category,
-                    'Valor': municipality_data.get('value', 0),
-                    'Unidade': municipality_data.get('unit', 'un'),
-                    'Ano': 2023
-                })
-
-        analysis_data.sort(key=lambda x: x['Valor'], reverse=True)
-        df = pd.DataFrame(analysis_data)
-
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Dados Detalhados', index=False)
-
-        output.seek(0)
-        safe_category_name = category.replace('/', '_').replace('\\', '_').replace(':', '_')
-        state_suffix = f'_{state_filter}' if state_filter else '_Nacional'
-        filename = f'analise_agrotoxico_{safe_category_name}{state_suffix}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
-
+        return export_category_analysis('agrotoxico', category, 'agrotoxico',
+                                        'Categoria de agrotóxico não encontrada')
     except Exception as e:
         print(f"Erro ao exportar análise de agrotóxico: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1334,52 +1651,8 @@ def export_agrotoxico_analysis(category):
 def export_consultoria_analysis(category):
     """Export consultoria analysis data as Excel file"""
     try:
-        state_filter = request.args.get('state')
-
-        if category not in CONSULTORIA_DATA:
-            return jsonify({'success': False, 'error': 'Categoria de consultoria não encontrada'}), 404
-
-        analysis_data = []
-        for municipality_code, municipality_data in CONSULTORIA_DATA[category].items():
-            municipality_code_str = str(municipality_code)
-
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and
-                municipality_data.get('municipality_name')):
-
-                if state_filter and municipality_data.get('state_code') != state_filter:
-                    continue
-
-                analysis_data.append({
-                    'Código IBGE': municipality_code,
-                    'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'UF': municipality_data.get('state_code', 'XX'),
-                    'Categoria': category,
-                    'Valor': municipality_data.get('value', 0),
-                    'Unidade': municipality_data.get('unit', 'un'),
-                    'Ano': 2023
-                })
-
-        analysis_data.sort(key=lambda x: x['Valor'], reverse=True)
-        df = pd.DataFrame(analysis_data)
-
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Dados Detalhados', index=False)
-
-        output.seek(0)
-        safe_category_name = category.replace('/', '_').replace('\\', '_').replace(':', '_')
-        state_suffix = f'_{state_filter}' if state_filter else '_Nacional'
-        filename = f'analise_consultoria_{safe_category_name}{state_suffix}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
-
+        return export_category_analysis('consultoria', category, 'consultoria',
+                                        'Categoria de consultoria não encontrada')
     except Exception as e:
         print(f"Erro ao exportar análise de consultoria: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1388,52 +1661,8 @@ def export_consultoria_analysis(category):
 def export_corretivos_analysis(category):
     """Export corretivos analysis data as Excel file"""
     try:
-        state_filter = request.args.get('state')
-
-        if category not in CORRETIVOS_DATA:
-            return jsonify({'success': False, 'error': 'Categoria de corretivo não encontrada'}), 404
-
-        analysis_data = []
-        for municipality_code, municipality_data in CORRETIVOS_DATA[category].items():
-            municipality_code_str = str(municipality_code)
-
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and
-                municipality_data.get('municipality_name')):
-
-                if state_filter and municipality_data.get('state_code') != state_filter:
-                    continue
-
-                analysis_data.append({
-                    'Código IBGE': municipality_code,
-                    'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'UF': municipality_data.get('state_code', 'XX'),
-                    'Categoria': category,
-                    'Valor': municipality_data.get('value', 0),
-                    'Unidade': municipality_data.get('unit', 'un'),
-                    'Ano': 2023
-                })
-
-        analysis_data.sort(key=lambda x: x['Valor'], reverse=True)
-        df = pd.DataFrame(analysis_data)
-
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Dados Detalhados', index=False)
-
-        output.seek(0)
-        safe_category_name = category.replace('/', '_').replace('\\', '_').replace(':', '_')
-        state_suffix = f'_{state_filter}' if state_filter else '_Nacional'
-        filename = f'analise_corretivo_{safe_category_name}{state_suffix}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
-
+        return export_category_analysis('corretivos', category, 'corretivo',
+                                        'Categoria de corretivo não encontrada')
     except Exception as e:
         print(f"Erro ao exportar análise de corretivo: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1442,52 +1671,8 @@ def export_corretivos_analysis(category):
 def export_despesa_analysis(category):
     """Export despesa analysis data as Excel file"""
     try:
-        state_filter = request.args.get('state')
-
-        if category not in DESPESA_DATA:
-            return jsonify({'success': False, 'error': 'Categoria de despesa não encontrada'}), 404
-
-        analysis_data = []
-        for municipality_code, municipality_data in DESPESA_DATA[category].items():
-            municipality_code_str = str(municipality_code)
-
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and
-                municipality_data.get('municipality_name')):
-
-                if state_filter and municipality_data.get('state_code') != state_filter:
-                    continue
-
-                analysis_data.append({
-                    'Código IBGE': municipality_code,
-                    'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'UF': municipality_data.get('state_code', 'XX'),
-                    'Categoria': category,
-                    'Valor': municipality_data.get('value', 0),
-                    'Unidade': municipality_data.get('unit', 'R$'),
-                    'Ano': 2023
-                })
-
-        analysis_data.sort(key=lambda x: x['Valor'], reverse=True)
-        df = pd.DataFrame(analysis_data)
-
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Dados Detalhados', index=False)
-
-        output.seek(0)
-        safe_category_name = category.replace('/', '_').replace('\\', '_').replace(':', '_')
-        state_suffix = f'_{state_filter}' if state_filter else '_Nacional'
-        filename = f'analise_despesa_{safe_category_name}{state_suffix}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
-
+        return export_category_analysis('despesa', category, 'despesa',
+                                        'Categoria de despesa não encontrada', default_unit='R$')
     except Exception as e:
         print(f"Erro ao exportar análise de despesa: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1496,282 +1681,253 @@ def export_despesa_analysis(category):
 def export_escolaridade_analysis(category):
     """Export escolaridade analysis data as Excel file"""
     try:
-        state_filter = request.args.get('state')
+        return export_category_analysis('escolaridade', category, 'escolaridade',
+                                        'Categoria de escolaridade não encontrada')
+    except Exception as e:
+        print(f"Erro ao exportar análise de escolaridade: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        if category not in ESCOLARIDADE_DATA:
-            return jsonify({'success': False, 'error': 'Categoria de escolaridade não encontrada'}), 404
-
-        analysis_data = []
-        for municipality_code, municipality_data in ESCOLARIDADE_DATA[category].items():
-            municipality_code_str = str(municipality_code)
-
-            if (len(municipality_code_str) == 7 and 
-                municipality_code_str.isdigit() and
-                municipality_code_str[0] in '12345' and
-                municipality_data.get('municipality_name')):
-
-                if state_filter and municipality_data.get('state_code') != state_filter:
-                    continue
-
-                analysis_data.append({
-                    'Código IBGE': municipality_code,
-                    'Município': municipality_data.get('municipality_name', 'Desconhecido'),
-                    'UF': municipality_data.get('state_code', 'XX'),
-                    'Categoria': category,
-                    'Valor': municipality_data.get('value', 0),
-                    'Unidade': municipality_data.get('unit', 'un'),
-                    'Ano': 2023
-                })
+@app.route('/api/analise-comercial/excel/<int:revenda_id>')
+@login_required
+def export_revenda_commercial_analysis(revenda_id):
+    """Exportar análise comercial completa da revenda em Excel (?async=1: tarefa em segundo plano)"""
+    try:
+        revenda = Revenda.query.get_or_404(revenda_id)
+        municipios_codes = revenda.get_municipios_list()
 
-        analysis_data.sort(key=lambda x: x['Valor'], reverse=True)
-        df = pd.DataFrame(analysis_data)
+        if not municipios_codes:
+            return jsonify({'success': False, 'error': 'Nenhum município encontrado para esta revenda'})
 
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Dados Detalhados', index=False)
+        if wants_job():
+            return submit_job('revenda-commercial-analysis', lambda progress: revenda_commercial_workbook(
+                Revenda.query.get_or_404(revenda_id), progress), params={'revenda_id': revenda_id})
 
-        output.seek(0)
-        safe_category_name = category.replace('/', '_').replace('\\', '_').replace(':', '_')
-        state_suffix = f'_{state_filter}' if state_filter else '_Nacional'
-        filename = f'analise_escolaridade_{safe_category_name}{state_suffix}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+        output, filename = revenda_commercial_workbook(revenda)
 
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=XLSX_MIMETYPE,
             as_attachment=True,
             download_name=filename
         )
 
     except Exception as e:
-        print(f"Erro ao exportar análise de escolaridade: {e}")
+        print(f"Erro ao exportar análise comercial da revenda: {e}")
+        import traceback
+        traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/analise-comercial/excel/<int:revenda_id>')
-@login_required
-def export_revenda_commercial_analysis(revenda_id):
-    """Exportar análise comercial completa da revenda em Excel"""
-    try:
-        revenda = Revenda.query.get_or_404(revenda_id)
-        municipios_codes = revenda.get_municipios_list()
+def revenda_commercial_workbook(revenda, progress=no_progress):
+    """(planilha Excel, nome do arquivo) da análise comercial completa da revenda"""
+    municipios_codes = revenda.get_municipios_list()
+
+    # Obter dados completos da análise
+    progress(0.05, 'Calculando análise comercial')
+    analysis_data = cached_commercial_analysis(municipios_codes, owner=('revenda', revenda.id))
+
+    # Criar arquivo Excel
+    output = io.BytesIO()
+
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        progress(0.2, 'Planilha de Resumo Geral')
+        # 1. Planilha de Resumo Geral
+        resumo_geral_data = [
+            ['Informações da Revenda', ''],
+            ['Nome', revenda.nome],
+            ['CNPJ', revenda.cnpj],
+            ['CNAE', revenda.cnae],
+            ['Cor', revenda.cor],
+            ['Total de Municípios', len(municipios_codes)],
+            ['Data da Análise', pd.Timestamp.now().strftime('%d/%m/%Y %H:%M:%S')],
+            ['', ''],
+            ['Resumo Financeiro', ''],
+            ['Total Receita (R$)', f'{analysis_data["financialData"]["totalReceita"]:,.2f}'],
+            ['Total Despesa (R$)', f'{analysis_data["financialData"]["totalDespesa"]:,.2f}'],
+            ['Saldo (R$)', f'{analysis_data["financialData"]["saldo"]:,.2f}'],
+            ['', ''],
+            ['Resumo Agrícola', ''],
+            ['Total de Culturas', len(analysis_data['cropsData']['crops'])],
+            ['Área Total Cultivada (ha)', f'{sum([c["total_area"] for c in analysis_data["cropsData"]["crops"]]):,.2f}'],
+            ['', ''],
+            ['Resumo de Insumos', ''],
+            ['Categorias de Fertilizantes', len(analysis_data['fertilizerData']['categories'])],
+            ['Categorias de Agrotóxicos', len(analysis_data['agrotoxicoData']['categories'])],
+            ['Categorias de Consultoria', len(analysis_data['consultoriaData']['categories'])],
+            ['Categorias de Corretivos', len(analysis_data['corretivosData']['categories'])],
+            ['Categorias de Escolaridade', len(analysis_data['escolaridadeData']['categories'])]
+        ]
 
-        if not municipios_codes:
-            return jsonify({'success': False, 'error': 'Nenhum município encontrado para esta revenda'})
+        resumo_df = pd.DataFrame(resumo_geral_data, columns=['Item', 'Valor'])
+        resumo_df.to_excel(writer, sheet_name='Resumo Geral', index=False)
+
+        progress(0.29, 'Planilha Financeira Detalhada')
+        # 2. Planilha Financeira Detalhada
+        financial_detail_data = []
+        for municipio in analysis_data['financialData']['municipios']:
+            financial_detail_data.append({
+                'Código IBGE': municipio['code'],
+                'Município': municipio['name'],
+                'UF': municipio['state'],
+                'Receita (R$)': municipio['receita'],
+                'Despesa (R$)': municipio['despesa'],
+                'Saldo (R$)': municipio['saldo'],
+                'Margem (%)': (municipio['saldo'] / max(municipio['receita'], 1) * 100) if municipio['receita'] > 0 else 0
+            })
 
-        # Obter dados completos da análise
-        analysis_data = calculate_revenda_analysis(municipios_codes)
+        if financial_detail_data:
+            financial_df = pd.DataFrame(financial_detail_data)
+            financial_df = financial_df.sort_values('Saldo (R$)', ascending=False)
+            financial_df.to_excel(writer, sheet_name='Análise Financeira', index=False)
+
+        progress(0.38, 'Planilha de Culturas Detalhada')
+        # 3. Planilha de Culturas Detalhada
+        crops_detail_data = []
+        total_crop_area = sum([c['total_area'] for c in analysis_data['cropsData']['crops']])
+
+        for crop in analysis_data['cropsData']['crops']:
+            participation = (crop['total_area'] / total_crop_area * 100) if total_crop_area > 0 else 0
+            avg_area_per_municipality = crop['total_area'] / max(crop['municipalities_count'], 1)
+
+            crops_detail_data.append({
+                'Cultura': crop['name'],
+                'Área Total (ha)': crop['total_area'],
+                'Nº Municípios': crop['municipalities_count'],
+                'Área Média por Município (ha)': avg_area_per_municipality,
+                'Participação (%)': participation,
+                'Ranking': crops_detail_data.__len__() + 1
+            })
 
-        # Criar arquivo Excel
-        output = io.BytesIO()
+        if crops_detail_data:
+            crops_df = pd.DataFrame(crops_detail_data)
+            crops_df.to_excel(writer, sheet_name='Culturas Detalhado', index=False)
 
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # 1. Planilha de Resumo Geral
-            resumo_geral_data = [
-                ['Informações da Revenda', ''],
-                ['Nome', revenda.nome],
-                ['CNPJ', revenda.cnpj],
-                ['CNAE', revenda.cnae],
-                ['Cor', revenda.cor],
-                ['Total de Municípios', len(municipios_codes)],
-                ['Data da Análise', pd.Timestamp.now().strftime('%d/%m/%Y %H:%M:%S')],
-                ['', ''],
-                ['Resumo Financeiro', ''],
-                ['Total Receita (R$)', f'{analysis_data["financialData"]["totalReceita"]:,.2f}'],
-                ['Total Despesa (R$)', f'{analysis_data["financialData"]["totalDespesa"]:,.2f}'],
-                ['Saldo (R$)', f'{analysis_data["financialData"]["saldo"]:,.2f}'],
-                ['', ''],
-                ['Resumo Agrícola', ''],
-                ['Total de Culturas', len(analysis_data['cropsData']['crops'])],
-                ['Área Total Cultivada (ha)', f'{sum([c["total_area"] for c in analysis_data["cropsData"]["crops"]]):,.2f}'],
-                ['', ''],
-                ['Resumo de Insumos', ''],
-                ['Categorias de Fertilizantes', len(analysis_data['fertilizerData']['categories'])],
-                ['Categorias de Agrotóxicos', len(analysis_data['agrotoxicoData']['categories'])],
-                ['Categorias de Consultoria', len(analysis_data['consultoriaData']['categories'])],
-                ['Categorias de Corretivos', len(analysis_data['corretivosData']['categories'])],
-                ['Categorias de Escolaridade', len(analysis_data['escolaridadeData']['categories'])]
-            ]
+        progress(0.47, 'Planilha de Fertilizantes Detalhada')
+        # 4. Planilha de Fertilizantes Detalhada
+        fertilizer_detail_data = []
+        total_fertilizer = sum([c['total'] for c in analysis_data['fertilizerData']['categories']])
 
-            resumo_df = pd.DataFrame(resumo_geral_data, columns=['Item', 'Valor'])
-            resumo_df.to_excel(writer, sheet_name='Resumo Geral', index=False)
-
-            # 2. Planilha Financeira Detalhada
-            financial_detail_data = []
-            for municipio in analysis_data['financialData']['municipios']:
-                financial_detail_data.append({
-                    'Código IBGE': municipio['code'],
-                    'Município': municipio['name'],
-                    'UF': municipio['state'],
-                    'Receita (R$)': municipio['receita'],
-                    'Despesa (R$)': municipio['despesa'],
-                    'Saldo (R$)': municipio['saldo'],
-                    'Margem (%)': (municipio['saldo'] / max(municipio['receita'], 1) * 100) if municipio['receita'] > 0 else 0
-                })
+        for category in analysis_data['fertilizerData']['categories']:
+            participation = (category['total'] / total_fertilizer * 100) if total_fertilizer > 0 else 0
 
-            if financial_detail_data:
-                financial_df = pd.DataFrame(financial_detail_data)
-                financial_df = financial_df.sort_values('Saldo (R$)', ascending=False)
-                financial_df.to_excel(writer, sheet_name='Análise Financeira', index=False)
-
-            # 3. Planilha de Culturas Detalhada
-            crops_detail_data = []
-            total_crop_area = sum([c['total_area'] for c in analysis_data['cropsData']['crops']])
-
-            for crop in analysis_data['cropsData']['crops']:
-                participation = (crop['total_area'] / total_crop_area * 100) if total_crop_area > 0 else 0
-                avg_area_per_municipality = crop['total_area'] / max(crop['municipalities_count'], 1)
-
-                crops_detail_data.append({
-                    'Cultura': crop['name'],
-                    'Área Total (ha)': crop['total_area'],
-                    'Nº Municípios': crop['municipalities_count'],
-                    'Área Média por Município (ha)': avg_area_per_municipality,
-                    'Participação (%)': participation,
-                    'Ranking': crops_detail_data.__len__() + 1
-                })
+            fertilizer_detail_data.append({
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation,
+                'Ranking': len(fertilizer_detail_data) + 1
+            })
 
-            if crops_detail_data:
-                crops_df = pd.DataFrame(crops_detail_data)
-                crops_df.to_excel(writer, sheet_name='Culturas Detalhado', index=False)
+        if fertilizer_detail_data:
+            fertilizer_df = pd.DataFrame(fertilizer_detail_data)
+            fertilizer_df.to_excel(writer, sheet_name='Fertilizantes', index=False)
 
-            # 4. Planilha de Fertilizantes Detalhada
-            fertilizer_detail_data = []
-            total_fertilizer = sum([c['total'] for c in analysis_data['fertilizerData']['categories']])
+        progress(0.56, 'Planilha de Agrotóxicos Detalhada')
+        # 5. Planilha de Agrotóxicos Detalhada
+        agrotoxico_detail_data = []
+        total_agrotoxico = sum([c['total'] for c in analysis_data['agrotoxicoData']['categories']])
 
-            for category in analysis_data['fertilizerData']['categories']:
-                participation = (category['total'] / total_fertilizer * 100) if total_fertilizer > 0 else 0
+        for category in analysis_data['agrotoxicoData']['categories']:
+            participation = (category['total'] / total_agrotoxico * 100) if total_agrotoxico > 0 else 0
 
-                fertilizer_detail_data.append({
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation,
-                    'Ranking': len(fertilizer_detail_data) + 1
-                })
+            agrotoxico_detail_data.append({
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation,
+                'Ranking': len(agrotoxico_detail_data) + 1
+            })
 
-            if fertilizer_detail_data:
-                fertilizer_df = pd.DataFrame(fertilizer_detail_data)
-                fertilizer_df.to_excel(writer, sheet_name='Fertilizantes', index=False)
+        if agrotoxico_detail_data:
+            agrotoxico_df = pd.DataFrame(agrotoxico_detail_data)
+            agrotoxico_df.to_excel(writer, sheet_name='Agrotóxicos', index=False)
 
-            # 5. Planilha de Agrotóxicos Detalhada
-            agrotoxico_detail_data = []
-            total_agrotoxico = sum([c['total'] for c in analysis_data['agrotoxicoData']['categories']])
+        progress(0.64, 'Planilha de Consultoria Detalhada')
+        # 6. Planilha de Consultoria Detalhada
+        consultoria_detail_data = []
+        total_consultoria = sum([c['total'] for c in analysis_data['consultoriaData']['categories']])
 
-            for category in analysis_data['agrotoxicoData']['categories']:
-                participation = (category['total'] / total_agrotoxico * 100) if total_agrotoxico > 0 else 0
+        for category in analysis_data['consultoriaData']['categories']:
+            participation = (category['total'] / total_consultoria * 100) if total_consultoria > 0 else 0
 
-                agrotoxico_detail_data.append({
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation,
-                    'Ranking': len(agrotoxico_detail_data) + 1
-                })
+            consultoria_detail_data.append({
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation,
+                'Ranking': len(consultoria_detail_data) + 1
+            })
 
-            if agrotoxico_detail_data:
-                agrotoxico_df = pd.DataFrame(agrotoxico_detail_data)
-                agrotoxico_df.to_excel(writer, sheet_name='Agrotóxicos', index=False)
+        if consultoria_detail_data:
+            consultoria_df = pd.DataFrame(consultoria_detail_data)
+            consultoria_df.to_excel(writer, sheet_name='Consultoria Técnica', index=False)
 
-            # 6. Planilha de Consultoria Detalhada
-            consultoria_detail_data = []
-            total_consultoria = sum([c['total'] for c in analysis_data['consultoriaData']['categories']])
+        progress(0.73, 'Planilha de Corretivos Detalhada')
+        # 7. Planilha de Corretivos Detalhada
+        corretivos_detail_data = []
+        total_corretivos = sum([c['total'] for c in analysis_data['corretivosData']['categories']])
 
-            for category in analysis_data['consultoriaData']['categories']:
-                participation = (category['total'] / total_consultoria * 100) if total_consultoria > 0 else 0
+        for category in analysis_data['corretivosData']['categories']:
+            participation = (category['total'] / total_corretivos * 100) if total_corretivos > 0 else 0
 
-                consultoria_detail_data.append({
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation,
-                    'Ranking': len(consultoria_detail_data) + 1
-                })
+            corretivos_detail_data.append({
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation,
+                'Ranking': len(corretivos_detail_data) + 1
+            })
 
-            if consultoria_detail_data:
-                consultoria_df = pd.DataFrame(consultoria_detail_data)
-                consultoria_df.to_excel(writer, sheet_name='Consultoria Técnica', index=False)
+        if corretivos_detail_data:
+            corretivos_df = pd.DataFrame(corretivos_detail_data)
+            corretivos_df.to_excel(writer, sheet_name='Corretivos', index=False)
 
-            # 7. Planilha de Corretivos Detalhada
-            corretivos_detail_data = []
-            total_corretivos = sum([c['total'] for c in analysis_data['corretivosData']['categories']])
+        progress(0.82, 'Planilha de Escolaridade Detalhada')
+        # 8. Planilha de Escolaridade Detalhada
+        escolaridade_detail_data = []
+        total_escolaridade = sum([c['total'] for c in analysis_data['escolaridadeData']['categories']])
 
-            for category in analysis_data['corretivosData']['categories']:
-                participation = (category['total'] / total_corretivos * 100) if total_corretivos > 0 else 0
+        for category in analysis_data['escolaridadeData']['categories']:
+            participation = (category['total'] / total_escolaridade * 100) if total_escolaridade > 0 else 0
 
-                corretivos_detail_data.append({
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation,
-                    'Ranking': len(corretivos_detail_data) + 1
-                })
+            escolaridade_detail_data.append({
+                'Categoria': category['name'],
+                'Total Pessoas': category['total'],
+                'Participação (%)': participation,
+                'Ranking': len(escolaridade_detail_data) + 1
+            })
 
-            if corretivos_detail_data:
-                corretivos_df = pd.DataFrame(corretivos_detail_data)
-                corretivos_df.to_excel(writer, sheet_name='Corretivos', index=False)
+        if escolaridade_detail_data:
+            escolaridade_df = pd.DataFrame(escolaridade_detail_data)
+            escolaridade_df.to_excel(writer, sheet_name='Escolaridade', index=False)
 
-            # 8. Planilha de Escolaridade Detalhada
-            escolaridade_detail_data = []
-            total_escolaridade = sum([c['total'] for c in analysis_data['escolaridadeData']['categories']])
+        progress(0.91, 'Planilha de Municípios da Revenda')
+        # 9. Planilha de Municípios da Revenda
+        municipios_detail_data = []
 
-            for category in analysis_data['escolaridadeData']['categories']:
-                participation = (category['total'] / total_escolaridade * 100) if total_escolaridade > 0 else 0
+        # Buscar dados dos municípios
+        for municipio_code in municipios_codes:
+            municipio_code_str = str(municipio_code)
 
-                escolaridade_detail_data.append({
-                    'Categoria': category['name'],
-                    'Total Pessoas': category['total'],
-                    'Participação (%)': participation,
-                    'Ranking': len(escolaridade_detail_data) + 1
-                })
+            # Buscar nome e estado no cadastro de municípios
+            municipio_name, state_code = municipality_name_and_state(municipio_code_str)
 
-            if escolaridade_detail_data:
-                escolaridade_df = pd.DataFrame(escolaridade_detail_data)
-                escolaridade_df.to_excel(writer, sheet_name='Escolaridade', index=False)
-
-            # 9. Planilha de Municípios da Revenda
-            municipios_detail_data = []
-
-            # Buscar dados dos municípios
-            for municipio_code in municipios_codes:
-                municipio_code_str = str(municipio_code)
-                municipio_name = ""
-                state_code = ""
-
-                # Buscar dados em qualquer fonte para obter nome e estado
-                for crop_data_entry in CROP_DATA.values():
-                    if municipio_code_str in crop_data_entry:
-                        municipio_data = crop_data_entry[municipio_code_str]
-                        municipio_name = municipio_data.get('municipality_name', '')
-                        state_code = municipio_data.get('state_code', '')
-                        break
-
-                if notmunicipio_name:
-                    municipio_name = f"Município {municipio_code}"
-                    state_code = "XX"
-
-                municipios_detail_data.append({
-                    'Código IBGE': municipio_code,
-                    'Nome do Município': municipio_name,
-                    'UF': state_code
-                })
+            if not municipio_name:
+                municipio_name = f"Município {municipio_code}"
+                state_code = "XX"
 
-            municipios_df = pd.DataFrame(municipios_detail_data)
-            municipios_df = municipios_df.sort_values(['UF', 'Nome do Município'])
-            municipios_df.to_excel(writer, sheet_name='Municípios da Revenda', index=False)
+            municipios_detail_data.append({
+                'Código IBGE': municipio_code,
+                'Nome do Município': municipio_name,
+                'UF': state_code
+            })
 
-        output.seek(0)
+        municipios_df = pd.DataFrame(municipios_detail_data)
+        municipios_df = municipios_df.sort_values(['UF', 'Nome do Município'])
+        municipios_df.to_excel(writer, sheet_name='Municípios da Revenda', index=False)
 
-        # Nome do arquivo
-        safe_name = revenda.nome.replace(' ', '_').replace('/', '_').replace('\\', '_')
-        filename = f'analise_comercial_{safe_name}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+    output.seek(0)
 
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+    # Nome do arquivo
+    safe_name = revenda.nome.replace(' ', '_').replace('/', '_').replace('\\', '_')
+    filename = f'analise_comercial_{safe_name}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
-    except Exception as e:
-        print(f"Erro ao exportar análise comercial da revenda: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
+    return output, filename
 
 # Rota duplicada removida aqui para evitar o erro AssertionError
 # @app.route('/api/analise-comercial-vendedor/excel/<int:vendedor_id>')
@@ -2005,7 +2161,7 @@ def export_revenda_commercial_analysis(revenda_id):
 @app.route('/api/analise-comercial-vendedor/excel/<int:vendedor_id>')
 @login_required
 def export_vendedor_commercial_analysis(vendedor_id):
-    """Exportar análise comercial completa do vendedor em Excel"""
+    """Exportar análise comercial completa do vendedor em Excel (?async=1: tarefa em segundo plano)"""
     try:
         vendedor = Vendedor.query.get_or_404(vendedor_id)
         municipios_codes = vendedor.get_municipios_list()
@@ -2013,225 +2169,259 @@ def export_vendedor_commercial_analysis(vendedor_id):
         if not municipios_codes:
             return jsonify({'success': False, 'error': 'Nenhum município encontrado para este vendedor'})
 
-        # Obter dados completos da análise
-        analysis_data = calculate_revenda_analysis(municipios_codes)
+        if wants_job():
+            return submit_job('vendedor-commercial-analysis', lambda progress: vendedor_commercial_workbook(
+                Vendedor.query.get_or_404(vendedor_id), progress), params={'vendedor_id': vendedor_id})
 
-        # Criar arquivo Excel
-        output = io.BytesIO()
+        output, filename = vendedor_commercial_workbook(vendedor)
 
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # 1. Planilha de Resumo Geral
-            resumo_geral_data = [
-                ['Informações do Vendedor', ''],
-                ['Nome', vendedor.nome],
-                ['E-mail', vendedor.email],
-                ['Telefone', vendedor.telefone],
-                ['CPF', vendedor.cpf],
-                ['Cor', vendedor.cor],
-                ['Total de Municípios', len(municipios_codes)],
-                ['Data da Análise', pd.Timestamp.now().strftime('%d/%m/%Y %H:%M:%S')],
-                ['', ''],
-                ['Resumo Financeiro', ''],
-                ['Total Receita (R$)', f'{analysis_data["financialData"]["totalReceita"]:,.2f}'],
-                ['Total Despesa (R$)', f'{analysis_data["financialData"]["totalDespesa"]:,.2f}'],
-                ['Saldo (R$)', f'{analysis_data["financialData"]["saldo"]:,.2f}'],
-                ['', ''],
-                ['Resumo Agrícola', ''],
-                ['Total de Culturas', len(analysis_data['cropsData']['crops'])],
-                ['Área Total Cultivada (ha)', f'{sum([c["total_area"] for c in analysis_data["cropsData"]["crops"]]):,.2f}'],
-                ['', ''],
-                ['Resumo de Insumos', ''],
-                ['Categorias de Fertilizantes', len(analysis_data['fertilizerData']['categories'])],
-                ['Categorias de Agrotóxicos', len(analysis_data['agrotoxicoData']['categories'])],
-                ['Categorias de Consultoria', len(analysis_data['consultoriaData']['categories'])],
-                ['Categorias de Corretivos', len(analysis_data['corretivosData']['categories'])],
-                ['Categorias de Escolaridade', len(analysis_data['escolaridadeData']['categories'])]
-            ]
+        return send_file(
+            output,
+            mimetype=XLSX_MIMETYPE,
+            as_attachment=True,
+            download_name=filename
+        )
 
-            resumo_df = pd.DataFrame(resumo_geral_data, columns=['Item', 'Valor'])
-            resumo_df.to_excel(writer, sheet_name='Resumo Geral', index=False)
-
-            # 2. Planilha Financeira Detalhada
-            financial_detail_data = []
-            for municipio in analysis_data['financialData']['municipios']:
-                financial_detail_data.append({
-                    'Código IBGE': municipio['code'],
-                    'Município': municipio['name'],
-                    'UF': municipio['state'],
-                    'Receita (R$)': municipio['receita'],
-                    'Despesa (R$)': municipio['despesa'],
-                    'Saldo (R$)': municipio['saldo'],
-                    'Margem (%)': (municipio['saldo'] / max(municipio['receita'], 1) * 100) if municipio['receita'] > 0 else 0
-                })
+    except Exception as e:
+        print(f"Erro ao exportar análise comercial da revenda: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-            if financial_detail_data:
-                financial_df = pd.DataFrame(financial_detail_data)
-                financial_df = financial_df.sort_values('Saldo (R$)', ascending=False)
-                financial_df.to_excel(writer, sheet_name='Análise Financeira', index=False)
-
-            # 3. Planilha de Culturas Detalhada
-            crops_detail_data = []
-            total_crop_area = sum([c['total_area'] for c in analysis_data['cropsData']['crops']])
-
-            for i, crop in enumerate(analysis_data['cropsData']['crops']):
-                participation = (crop['total_area'] / total_crop_area * 100) if total_crop_area > 0 else 0
-                avg_area_per_municipality = crop['total_area'] / max(crop['municipalities_count'], 1)
-
-                crops_detail_data.append({
-                    'Ranking': i + 1,
-                    'Cultura': crop['name'],
-                    'Área Total (ha)': crop['total_area'],
-                    'Nº Municípios': crop['municipalities_count'],
-                    'Área Média por Município (ha)': avg_area_per_municipality,
-                    'Participação (%)': participation
-                })
+def vendedor_commercial_workbook(vendedor, progress=no_progress):
+    """(planilha Excel, nome do arquivo) da análise comercial completa do vendedor"""
+    municipios_codes = vendedor.get_municipios_list()
+
+    # Obter dados completos da análise
+    progress(0.05, 'Calculando análise comercial')
+    analysis_data = cached_commercial_analysis(municipios_codes, owner=('vendedor', vendedor.id))
+
+    # Criar arquivo Excel
+    output = io.BytesIO()
+
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        progress(0.2, 'Planilha de Resumo Geral')
+        # 1. Planilha de Resumo Geral
+        resumo_geral_data = [
+            ['Informações do Vendedor', ''],
+            ['Nome', vendedor.nome],
+            ['E-mail', vendedor.email],
+            ['Telefone', vendedor.telefone],
+            ['CPF', vendedor.cpf],
+            ['Cor', vendedor.cor],
+            ['Total de Municípios', len(municipios_codes)],
+            ['Data da Análise', pd.Timestamp.now().strftime('%d/%m/%Y %H:%M:%S')],
+            ['', ''],
+            ['Resumo Financeiro', ''],
+            ['Total Receita (R$)', f'{analysis_data["financialData"]["totalReceita"]:,.2f}'],
+            ['Total Despesa (R$)', f'{analysis_data["financialData"]["totalDespesa"]:,.2f}'],
+            ['Saldo (R$)', f'{analysis_data["financialData"]["saldo"]:,.2f}'],
+            ['', ''],
+            ['Resumo Agrícola', ''],
+            ['Total de Culturas', len(analysis_data['cropsData']['crops'])],
+            ['Área Total Cultivada (ha)', f'{sum([c["total_area"] for c in analysis_data["cropsData"]["crops"]]):,.2f}'],
+            ['', ''],
+            ['Resumo de Insumos', ''],
+            ['Categorias de Fertilizantes', len(analysis_data['fertilizerData']['categories'])],
+            ['Categorias de Agrotóxicos', len(analysis_data['agrotoxicoData']['categories'])],
+            ['Categorias de Consultoria', len(analysis_data['consultoriaData']['categories'])],
+            ['Categorias de Corretivos', len(analysis_data['corretivosData']['categories'])],
+            ['Categorias de Escolaridade', len(analysis_data['escolaridadeData']['categories'])]
+        ]
 
-            if crops_detail_data:
-                crops_df = pd.DataFrame(crops_detail_data)
-                crops_df.to_excel(writer, sheet_name='Culturas Detalhado', index=False)
+        resumo_df = pd.DataFrame(resumo_geral_data, columns=['Item', 'Valor'])
+        resumo_df.to_excel(writer, sheet_name='Resumo Geral', index=False)
+
+        progress(0.29, 'Planilha Financeira Detalhada')
+        # 2. Planilha Financeira Detalhada
+        financial_detail_data = []
+        for municipio in analysis_data['financialData']['municipios']:
+            financial_detail_data.append({
+                'Código IBGE': municipio['code'],
+                'Município': municipio['name'],
+                'UF': municipio['state'],
+                'Receita (R$)': municipio['receita'],
+                'Despesa (R$)': municipio['despesa'],
+                'Saldo (R$)': municipio['saldo'],
+                'Margem (%)': (municipio['saldo'] / max(municipio['receita'], 1) * 100) if municipio['receita'] > 0 else 0
+            })
 
-            # 4. Planilha de Fertilizantes Detalhada
-            fertilizer_detail_data = []
-            total_fertilizer = sum([c['total'] for c in analysis_data['fertilizerData']['categories']])
+        if financial_detail_data:
+            financial_df = pd.DataFrame(financial_detail_data)
+            financial_df = financial_df.sort_values('Saldo (R$)', ascending=False)
+            financial_df.to_excel(writer, sheet_name='Análise Financeira', index=False)
+
+        progress(0.38, 'Planilha de Culturas Detalhada')
+        # 3. Planilha de Culturas Detalhada
+        crops_detail_data = []
+        total_crop_area = sum([c['total_area'] for c in analysis_data['cropsData']['crops']])
+
+        for i, crop in enumerate(analysis_data['cropsData']['crops']):
+            participation = (crop['total_area'] / total_crop_area * 100) if total_crop_area > 0 else 0
+            avg_area_per_municipality = crop['total_area'] / max(crop['municipalities_count'], 1)
+
+            crops_detail_data.append({
+                'Ranking': i + 1,
+                'Cultura': crop['name'],
+                'Área Total (ha)': crop['total_area'],
+                'Nº Municípios': crop['municipalities_count'],
+                'Área Média por Município (ha)': avg_area_per_municipality,
+                'Participação (%)': participation
+            })
 
-            for i, category in enumerate(analysis_data['fertilizerData']['categories']):
-                participation = (category['total'] / total_fertilizer * 100) if total_fertilizer > 0 else 0
+        if crops_detail_data:
+            crops_df = pd.DataFrame(crops_detail_data)
+            crops_df.to_excel(writer, sheet_name='Culturas Detalhado', index=False)
 
-                fertilizer_detail_data.append({
-                    'Ranking': i + 1,
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation
-                })
+        progress(0.47, 'Planilha de Fertilizantes Detalhada')
+        # 4. Planilha de Fertilizantes Detalhada
+        fertilizer_detail_data = []
+        total_fertilizer = sum([c['total'] for c in analysis_data['fertilizerData']['categories']])
 
-            if fertilizer_detail_data:
-                fertilizer_df = pd.DataFrame(fertilizer_detail_data)
-                fertilizer_df.to_excel(writer, sheet_name='Fertilizantes', index=False)
+        for i, category in enumerate(analysis_data['fertilizerData']['categories']):
+            participation = (category['total'] / total_fertilizer * 100) if total_fertilizer > 0 else 0
 
-            # 5. Planilha de Agrotóxicos Detalhada
-            agrotoxico_detail_data = []
-            total_agrotoxico = sum([c['total'] for c in analysis_data['agrotoxicoData']['categories']])
+            fertilizer_detail_data.append({
+                'Ranking': i + 1,
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation
+            })
 
-            for i, category in enumerate(analysis_data['agrotoxicoData']['categories']):
-                participation = (category['total'] / total_agrotoxico * 100) if total_agrotoxico > 0 else 0
+        if fertilizer_detail_data:
+            fertilizer_df = pd.DataFrame(fertilizer_detail_data)
+            fertilizer_df.to_excel(writer, sheet_name='Fertilizantes', index=False)
 
-                agrotoxico_detail_data.append({
-                    'Ranking': i + 1,
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation
-                })
+        progress(0.56, 'Planilha de Agrotóxicos Detalhada')
+        # 5. Planilha de Agrotóxicos Detalhada
+        agrotoxico_detail_data = []
+        total_agrotoxico = sum([c['total'] for c in analysis_data['agrotoxicoData']['categories']])
 
-            if agrotoxico_detail_data:
-                agrotoxico_df = pd.DataFrame(agrotoxico_detail_data)
-                agrotoxico_df.to_excel(writer, sheet_name='Agrotóxicos', index=False)
+        for i, category in enumerate(analysis_data['agrotoxicoData']['categories']):
+            participation = (category['total'] / total_agrotoxico * 100) if total_agrotoxico > 0 else 0
 
-            # 6. Planilha de Consultoria Detalhada
-            consultoria_detail_data = []
-            total_consultoria = sum([c['total'] for c in analysis_data['consultoriaData']['categories']])
+            agrotoxico_detail_data.append({
+                'Ranking': i + 1,
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation
+            })
 
-            for i, category in enumerate(analysis_data['consultoriaData']['categories']):
-                participation = (category['total'] / total_consultoria * 100) if total_consultoria > 0 else 0
+        if agrotoxico_detail_data:
+            agrotoxico_df = pd.DataFrame(agrotoxico_detail_data)
+            agrotoxico_df.to_excel(writer, sheet_name='Agrotóxicos', index=False)
 
-                consultoria_detail_data.append({
-                    'Ranking': i + 1,
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation
-                })
+        progress(0.64, 'Planilha de Consultoria Detalhada')
+        # 6. Planilha de Consultoria Detalhada
+        consultoria_detail_data = []
+        total_consultoria = sum([c['total'] for c in analysis_data['consultoriaData']['categories']])
 
-            if consultoria_detail_data:
-                consultoria_df = pd.DataFrame(consultoria_detail_data)
-                consultoria_df.to_excel(writer, sheet_name='Consultoria Técnica', index=False)
+        for i, category in enumerate(analysis_data['consultoriaData']['categories']):
+            participation = (category['total'] / total_consultoria * 100) if total_consultoria > 0 else 0
 
-            # 7. Planilha de Corretivos Detalhada
-            corretivos_detail_data = []
-            total_corretivos = sum([c['total'] for c in analysis_data['corretivosData']['categories']])
+            consultoria_detail_data.append({
+                'Ranking': i + 1,
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation
+            })
 
-            for i, category in enumerate(analysis_data['corretivosData']['categories']):
-                participation = (category['total'] / total_corretivos * 100) if total_corretivos > 0 else 0
+        if consultoria_detail_data:
+            consultoria_df = pd.DataFrame(consultoria_detail_data)
+            consultoria_df.to_excel(writer, sheet_name='Consultoria Técnica', index=False)
 
-                corretivos_detail_data.append({
-                    'Ranking': i + 1,
-                    'Categoria': category['name'],
-                    'Total Estabelecimentos': category['total'],
-                    'Participação (%)': participation
-                })
+        progress(0.73, 'Planilha de Corretivos Detalhada')
+        # 7. Planilha de Corretivos Detalhada
+        corretivos_detail_data = []
+        total_corretivos = sum([c['total'] for c in analysis_data['corretivosData']['categories']])
 
-            if corretivos_detail_data:
-                corretivos_df = pd.DataFrame(corretivos_detail_data)
-                corretivos_df.to_excel(writer, sheet_name='Corretivos', index=False)
+        for i, category in enumerate(analysis_data['corretivosData']['categories']):
+            participation = (category['total'] / total_corretivos * 100) if total_corretivos > 0 else 0
 
-            # 8. Planilha de Escolaridade Detalhada
-            escolaridade_detail_data = []
-            total_escolaridade = sum([c['total'] for c in analysis_data['escolaridadeData']['categories']])
+            corretivos_detail_data.append({
+                'Ranking': i + 1,
+                'Categoria': category['name'],
+                'Total Estabelecimentos': category['total'],
+                'Participação (%)': participation
+            })
 
-            for i, category in enumerate(analysis_data['escolaridadeData']['categories']):
-                participation = (category['total'] / total_escolaridade * 100) if total_escolaridade > 0 else 0
+        if corretivos_detail_data:
+            corretivos_df = pd.DataFrame(corretivos_detail_data)
+            corretivos_df.to_excel(writer, sheet_name='Corretivos', index=False)
 
-                escolaridade_detail_data.append({
-                    'Ranking': i + 1,
-                    'Categoria': category['name'],
-                    'Total Pessoas': category['total'],
-                    'Participação (%)': participation
-                })
+        progress(0.82, 'Planilha de Escolaridade Detalhada')
+        # 8. Planilha de Escolaridade Detalhada
+        escolaridade_detail_data = []
+        total_escolaridade = sum([c['total'] for c in analysis_data['escolaridadeData']['categories']])
 
-            if escolaridade_detail_data:
-                escolaridade_df = pd.DataFrame(escolaridade_detail_data)
-                escolaridade_df.to_excel(writer, sheet_name='Escolaridade', index=False)
-
-            # 9. Planilha de Municípios da Revenda
-            municipios_detail_data = []
-
-            # Buscar dados dos municípios
-            for municipio_code in municipios_codes:
-                municipio_code_str = str(municipio_code)
-                municipio_name = ""
-                state_code = ""
-
-                # Buscar dados em qualquer fonte para obter nome e estado
-                for crop_data_entry in CROP_DATA.values():
-                    if municipio_code_str in crop_data_entry:
-                        municipio_data = crop_data_entry[municipio_code_str]
-                        municipio_name = municipio_data.get('municipality_name', '')
-                        state_code = municipio_data.get('state_code', '')
-                        break
-
-                if not municipio_name:
-                    municipio_name = f"Município {municipio_code}"
-                    state_code = "XX"
-
-                municipios_detail_data.append({
-                    'Código IBGE': municipio_code,
-                    'Nome do Município': municipio_name,
-                    'UF': state_code
-                })
+        for i, category in enumerate(analysis_data['escolaridadeData']['categories']):
+            participation = (category['total'] / total_escolaridade * 100) if total_escolaridade > 0 else 0
 
-            municipios_df = pd.DataFrame(municipios_detail_data)
-            municipios_df = municipios_df.sort_values(['UF', 'Nome do Município'])
-            municipios_df.to_excel(writer, sheet_name='Municípios da Revenda', index=False)
+            escolaridade_detail_data.append({
+                'Ranking': i + 1,
+                'Categoria': category['name'],
+                'Total Pessoas': category['total'],
+                'Participação (%)': participation
+            })
 
-        output.seek(0)
+        if escolaridade_detail_data:
+            escolaridade_df = pd.DataFrame(escolaridade_detail_data)
+            escolaridade_df.to_excel(writer, sheet_name='Escolaridade', index=False)
 
-        # Nome do arquivo
-        safe_name = vendedor.nome.replace(' ', '_').replace('/', '_').replace('\\', '_')
-        filename = f'analise_comercial_vendedor_{safe_name}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+        progress(0.91, 'Planilha de Municípios da Revenda')
+        # 9. Planilha de Municípios da Revenda
+        municipios_detail_data = []
 
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+        # Buscar dados dos municípios
+        for municipio_code in municipios_codes:
+            municipio_code_str = str(municipio_code)
 
-    except Exception as e:
-        print(f"Erro ao exportar análise comercial da revenda: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
+            # Buscar nome e estado no cadastro de municípios
+            municipio_name, state_code = municipality_name_and_state(municipio_code_str)
+
+            if not municipio_name:
+                municipio_name = f"Município {municipio_code}"
+                state_code = "XX"
+
+            municipios_detail_data.append({
+                'Código IBGE': municipio_code,
+                'Nome do Município': municipio_name,
+                'UF': state_code
+            })
+
+        municipios_df = pd.DataFrame(municipios_detail_data)
+        municipios_df = municipios_df.sort_values(['UF', 'Nome do Município'])
+        municipios_df.to_excel(writer, sheet_name='Municípios da Revenda', index=False)
+
+    output.seek(0)
+
+    # Nome do arquivo
+    safe_name = vendedor.nome.replace(' ', '_').replace('/', '_').replace('\\', '_')
+    filename = f'analise_comercial_vendedor_{safe_name}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+
+    return output, filename
 
 # Helper function to calculate analysis (updated to remove scoring)
-def calculate_revenda_analysis(municipios_codes):
+def cached_potential_analysis(municipios_codes, owner=None, model=None):
+    """analyze_revenda_potential com cache por território e versão do modelo (owner = ('revenda'|'vendedor', id) para invalidação)"""
+    model = model or SCORING_MODELS.active
+    return TERRITORY_CACHE.get('potential', municipios_codes,
+                               lambda codes: analyze_revenda_potential(codes, model=model),
+                               weights_version=model.version, owner=owner)
+
+def requested_scoring_model():
+    """(modelo de ?model= ou o ativo, None); (None, resposta 400) se o modelo não existe"""
+    try:
+        return SCORING_MODELS.get(request.args.get('model')), None
+    except KeyError as e:
+        return None, (jsonify({'success': False, 'error': str(e.args[0]),
+                               'models': sorted(SCORING_MODELS.models)}), 400)
+
+def cached_commercial_analysis(municipios_codes, owner=None):
+    """calculate_revenda_analysis com cache por território (compartilhado pelas exportações em Excel)"""
+    return TERRITORY_CACHE.get('commercial', municipios_codes, calculate_revenda_analysis, owner=owner)
+
+def calculate_revenda_analysis(municipios_codes, profile=None):
     analysis = {
         'financialData': {'municipios': [], 'totalReceita': 0, 'totalDespesa': 0, 'saldo': 0},
         'cropsData': {'crops': []},
@@ -2243,88 +2433,25 @@ def calculate_revenda_analysis(municipios_codes):
     }
 
     try:
-        # Financial data
-        for municipio_code in municipios_codes:
-            municipio_code_str = str(municipio_code)
-            receita = 0
-            despesa = 0
-            municipio_name = ""
-            municipio_state = ""
-
-            if 'Total' in RECEITA_DATA and municipio_code_str in RECEITA_DATA['Total']:
-                receita_data = RECEITA_DATA['Total'][municipio_code_str]
-                receita = receita_data.get('value', 0)
-                municipio_name = receita_data.get('municipality_name', '')
-                municipio_state = receita_data.get('state_code', '')
-
-            if 'Total' in DESPESA_DATA and municipio_code_str in DESPESA_DATA['Total']:
-                despesa_data = DESPESA_DATA['Total'][municipio_code_str]
-                despesa = despesa_data.get('value', 0)
-                if not municipio_name:
-                    municipio_name = despesa_data.get('municipality_name', '')
-                    municipio_state = despesa_data.get('state_code', '')
-
-            if receita > 0 or despesa > 0:
-                analysis['financialData']['municipios'].append({
-                    'code': municipio_code, # Added for use in JS
-                    'name': municipio_name,
-                    'state': municipio_state,
-                    'receita': receita,
-                    'despesa': despesa,
-                    'saldo': receita - despesa # Added for use in JS
-                })
-                analysis['financialData']['totalReceita'] += receita
-                analysis['financialData']['totalDespesa'] += despesa
+        profile = profile or TerritoryProfile(DATASETS, municipios_codes)
+
+        # Financial data (mantém a ordem e as repetições da lista de códigos)
+        for municipio in profile.financial_municipalities():
+            analysis['financialData']['municipios'].append(municipio)
+            analysis['financialData']['totalReceita'] += municipio['receita']
+            analysis['financialData']['totalDespesa'] += municipio['despesa']
 
         analysis['financialData']['saldo'] = analysis['financialData']['totalReceita'] - analysis['financialData']['totalDespesa']
 
         # Crops data - get ALL cultures found in revenda
-        crop_totals = {}
-        for crop_name, crop_data in CROP_DATA.items():
-            total_area = 0
-            municipalities_count = 0
-
-            for municipio_code in municipios_codes:
-                if str(municipio_code) in crop_data:
-                    total_area += crop_data[str(municipio_code)].get('harvested_area', 0)
-                    municipalities_count += 1
-
-            if total_area > 0:
-                crop_totals[crop_name] = {
-                    'name': crop_name,
-                    'total_area': total_area,
-                    'municipalities_count': municipalities_count
-                }
-
-        analysis['cropsData']['crops'] = sorted(crop_totals.values(), key=lambda x: x['total_area'], reverse=True)
-
-        # Helper function for other data categories
-        def process_category_data(data_dict, analysis_key):
-            category_totals = {}
-            for category_name, category_data in data_dict.items():
-                # Skip specific keys that represent totals or metadata, not actual categories
-                if category_name in ['Total Estabelecimentos', 'Total estabelecimentos', 'TOTAL']:
-                    continue
-
-                total = 0
-                for municipio_code in municipios_codes:
-                    if str(municipio_code) in category_data:
-                        total += category_data[str(municipio_code)].get('value', 0)
-
-                if total > 0:
-                    category_totals[category_name] = {
-                        'name': category_name,
-                        'total': total
-                    }
+        analysis['cropsData']['crops'] = profile.crop_totals()
 
-            analysis[analysis_key]['categories'] = sorted(category_totals.values(), key=lambda x: x['total'], reverse=True)
-
-        # Process all category data
-        process_category_data(FERTILIZER_DATA, 'fertilizerData')
-        process_category_data(AGROTOXICO_DATA, 'agrotoxicoData')
-        process_category_data(CONSULTORIA_DATA, 'consultoriaData')
-        process_category_data(CORRETIVOS_DATA, 'corretivosData')
-        process_category_data(ESCOLARIDADE_DATA, 'escolaridadeData')
+        # Demais fontes (sem as categorias de totalização)
+        analysis['fertilizerData']['categories'] = profile['fertilizers'].category_totals()
+        analysis['agrotoxicoData']['categories'] = profile['agrotoxico'].category_totals()
+        analysis['consultoriaData']['categories'] = profile['consultoria'].category_totals()
+        analysis['corretivosData']['categories'] = profile['corretivos'].category_totals()
+        analysis['escolaridadeData']['categories'] = profile['escolaridade'].category_totals()
 
     except Exception as e:
         print(f"Error in calculate_revenda_analysis: {e}")
@@ -2604,6 +2731,7 @@ def update_revenda(revenda_id):
         result = auth_manager.update_revenda(revenda_id, updates)
 
         if result['success']:
+            TERRITORY_CACHE.invalidate(('revenda', revenda_id))
             return jsonify({
                 'success': True,
                 'message': 'Revenda atualizada com sucesso!'
@@ -2622,6 +2750,7 @@ def delete_revenda(revenda_id):
         result = auth_manager.delete_revenda(revenda_id)
 
         if result['success']:
+            TERRITORY_CACHE.invalidate(('revenda', revenda_id))
             return jsonify({
                 'success': True,
                 'message': 'Revenda removida com sucesso!'
@@ -2640,46 +2769,20 @@ def search_municipios():
         if len(query) < 2:
             return jsonify({'success': False, 'error': 'Query muito curta'}), 400
 
-        # Buscar municípios nos dados de culturas para obter nomes reais
-        municipios_found = []
-        municipios_set = set()  # Para evitar duplicatas
-
-        # Buscar nos dados de culturas
-        for crop_name, crop_data in CROP_DATA.items():
-            for municipality_code, municipality_data in crop_data.items():
-                municipality_code_str = str(municipality_code)
-                municipality_name = municipality_data.get('municipality_name', '').lower()
-                state_code = municipality_data.get('state_code', 'XX')
-
-                # Verificar se é um código de município válido e se contém a query
-                if (len(municipality_code_str) == 7 and 
-                    municipality_code_str.isdigit() and
-                    municipality_code_str[0] in '12345' and
-                    municipality_data.get('municipality_name') and
-                    municipality_code not in municipios_set and
-                    (query in municipality_name or query in state_code.lower())):
-
-                    municipios_found.append({
-                        'code': municipality_code,
-                        'name': municipality_data.get('municipality_name'),
-                        'state': state_code,
-                        'full_name': f"{municipality_data.get('municipality_name')} ({state_code})"
-                    })
-                    municipios_set.add(municipality_code)
-
-                    # Limitar a 50 resultados para performance
-                    if len(municipios_found) >= 50:
-                        break
-
-            if len(municipios_found) >= 50:
-                break
-
-        # Ordenar por nome
-        municipios_found.sort(key=lambda x: x['name'])
+        # Parâmetros opcionais: UF e paginação (padrão: 20 resultados)
+        state = request.args.get('uf') or request.args.get('state')
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        page = max(request.args.get('page', 1, type=int), 1)
+
+        municipios_found, total = MUNICIPALITY_SEARCH.search(query, state=state, limit=limit,
+                                                             offset=(page - 1) * limit)
 
         return jsonify({
             'success': True,
-            'municipios': municipios_found[:20]  # Limitar a 20 resultados
+            'municipios': municipios_found,
+            'total': total,
+            'page': page,
+            'has_more': page * limit < total
         })
 
     except Exception as e:
@@ -2714,8 +2817,12 @@ def get_analise_potencial(revenda_id):
                 print(f"Supabase error: {supabase_error}")
                 return jsonify({'success': False, 'error': 'Revenda não encontrada'}), 404
 
+        model, error = requested_scoring_model()
+        if error:
+            return error
+
         # Obter dados de todas as fontes
-        analysis_result = analyze_revenda_potential(municipios_codes)
+        analysis_result = cached_potential_analysis(municipios_codes, owner=('revenda', revenda_id), model=model)
 
         return jsonify({
             'success': True,
@@ -2757,8 +2864,12 @@ def get_analise_potencial_vendedor(vendedor_id):
                 print(f"Supabase error: {supabase_error}")
                 return jsonify({'success': False, 'error': 'Vendedor não encontrado'}), 404
 
+        model, error = requested_scoring_model()
+        if error:
+            return error
+
         # Obter dados de todas as fontes
-        analysis_result = analyze_revenda_potential(municipios_codes)
+        analysis_result = cached_potential_analysis(municipios_codes, owner=('vendedor', vendedor_id), model=model)
 
         return jsonify({
             'success': True,
@@ -2771,388 +2882,532 @@ def get_analise_potencial_vendedor(vendedor_id):
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def analyze_revenda_potential(municipios_codes):
-    """Analisa o potencial de uma revenda baseado em seus municípios"""
+MAX_BATCH_ENTITIES = 2000
 
-    analysis = {
-        'potentialScore': 0,
-        'totalValue': 0,
-        'cropsDiversity': 0,
-        'avgProductivity': 0,
-        'fertilizersUsage': 0,
-        'agrotoxicosUsage': 0,
-        'technicalAssistance': 0,
-        'recommendations': [],
-        'dataBySource': {},
-        'topCrops': [],
-        'calculationMatrix': {}  # Nova matriz detalhada de cálculo
-    }
+def parse_municipios_codigos(municipios):
+    """Lista de códigos de municipios_codigos (lista ou JSON em texto, como vem do Supabase)"""
+    if isinstance(municipios, str):
+        try:
+            municipios = json.loads(municipios)
+        except ValueError:
+            return []
+    if not isinstance(municipios, list):
+        return []
+    return [str(code) for code in municipios]
+
+def active_territories(kinds=('revenda', 'vendedor')):
+    """[{'type', 'id', 'nome', 'cor', 'codes'}] das revendas e/ou vendedores ativos"""
+    entities = []
+    if 'revenda' in kinds:
+        result = auth_manager.get_revendas()
+        if not result['success']:
+            raise RuntimeError(result['error'])
+        for revenda in result['revendas']:
+            entities.append({'type': 'revenda', 'id': revenda.get('id'), 'nome': revenda.get('nome', ''),
+                             'cor': revenda.get('cor'), 'codes': parse_municipios_codigos(revenda.get('municipios_codigos'))})
+    if 'vendedor' in kinds:
+        result = auth_manager.get_vendedores()
+        if not result['success']:
+            raise RuntimeError(result['error'])
+        for vendedor in result['vendedores']:
+            entities.append({'type': 'vendedor', 'id': vendedor.get('id'), 'nome': vendedor.get('nome', ''),
+                             'cor': vendedor.get('cor'), 'codes': parse_municipios_codigos(vendedor.get('municipios_codigos'))})
+    return entities
 
+@app.route('/api/analise-potencial/batch')
+@login_required
+def get_analise_potencial_batch():
+    """Ranking de potencial de todas as revendas e/ou vendedores ativos (?tipo=revendas|vendedores|todos&limit=&model=&async=1)"""
     try:
-        # Análise de Culturas
-        crops_analysis = analyze_crops_data(municipios_codes)
-        analysis['cropsDiversity'] = crops_analysis['diversity']
-        analysis['avgProductivity'] = crops_analysis['avg_productivity']
-        analysis['topCrops'] = crops_analysis['top_crops']
-        analysis['dataBySource']['crops'] = crops_analysis['total_value']
-
-        # Análise de Fertilizantes
-        fertilizers_analysis = analyze_fertilizers_data(municipios_codes)
-        analysis['fertilizersUsage'] = fertilizers_analysis['usage_percentage']
-        analysis['dataBySource']['fertilizers'] = fertilizers_analysis['total_establishments']
+        tipo = request.args.get('tipo', 'todos')
+        kinds = {'revendas': ('revenda',), 'vendedores': ('vendedor',), 'todos': ('revenda', 'vendedor')}.get(tipo)
+        if kinds is None:
+            return jsonify({'success': False, 'error': 'tipo deve ser revendas, vendedores ou todos'}), 400
+        limit = request.args.get('limit', type=int)
+        model, error = requested_scoring_model()
+        if error:
+            return error
+
+        entities = active_territories(kinds)
+        if len(entities) > MAX_BATCH_ENTITIES:
+            return jsonify({'success': False, 'error': f'Máximo de {MAX_BATCH_ENTITIES} entidades por ranking'}), 400
+
+        def build(progress=no_progress):
+            ranked = leaderboard(POTENTIAL_FEATURES, model, entities)
+            return {
+                'success': True,
+                'model_version': model.version,
+                'total': len(ranked),
+                'leaderboard': ranked[:limit] if limit and limit > 0 else ranked
+            }
 
-        # Análise de Agrotóxicos
-        agrotoxicos_analysis = analyze_agrotoxicos_data(municipios_codes)
-        analysis['agrotoxicosUsage'] = agrotoxicos_analysis['usage_percentage']
-        analysis['dataBySource']['agrotoxicos'] = agrotoxicos_analysis['total_establishments']
+        if wants_job():
+            return submit_job('potential-batch', build, params={'tipo': tipo, 'limit': limit, 'model': model.version})
+        return jsonify(build())
 
-        # Análise de Consultoria Técnica
-        consultoria_analysis = analyze_consultoria_data(municipios_codes)
-        analysis['technicalAssistance'] = consultoria_analysis['coverage_percentage']
-        analysis['dataBySource']['consultoria'] = consultoria_analysis['total_establishments']
+    except Exception as e:
+        print(f"Erro no ranking de potencial: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # Análise de Corretivos
-        corretivos_analysis = analyze_corretivos_data(municipios_codes)
-        analysis['dataBySource']['corretivos'] = corretivos_analysis['total_establishments']
+@app.route('/api/analise-potencial/sobreposicao')
+@login_required
+def get_analise_potencial_sobreposicao():
+    """Sobreposição entre territórios de revendas/vendedores ativos (?tipo=revendas|vendedores|todos&matrix=0|1&limit=&async=1)
 
-        # Análise de Despesas
-        despesas_analysis = analyze_despesas_data(municipios_codes)
-        analysis['dataBySource']['despesas'] = despesas_analysis['total_value']
+    Para cada par com municípios em comum: quantidade, Jaccard e potencial dos municípios compartilhados.
+    """
+    try:
+        tipo = request.args.get('tipo', 'todos')
+        kinds = {'revendas': ('revenda',), 'vendedores': ('vendedor',), 'todos': ('revenda', 'vendedor')}.get(tipo)
+        if kinds is None:
+            return jsonify({'success': False, 'error': 'tipo deve ser revendas, vendedores ou todos'}), 400
+
+        entities = active_territories(kinds)
+        if len(entities) > MAX_BATCH_ENTITIES:
+            return jsonify({'success': False, 'error': f'Máximo de {MAX_BATCH_ENTITIES} entidades por relatório'}), 400
+
+        limit = request.args.get('limit', type=int)
+        with_matrix = request.args.get('matrix', '1') != '0'
+
+        def build(progress=no_progress):
+            bitsets = TERRITORY_BITSETS.matrix(entities)
+            sizes, shared = overlap_counts(bitsets)
+            jaccard = jaccard_matrix(sizes, shared)
+
+            pairs = np.argwhere(np.triu(shared, k=1) > 0)
+            scores, crop_areas, receitas = overlap_potential(TERRITORY_BITSETS, POTENTIAL_FEATURES, SCORING_MODELS.active,
+                                                             bitsets, pairs)
+            conflicts = [{
+                'a': {'type': entities[i]['type'], 'id': entities[i]['id'], 'nome': entities[i]['nome']},
+                'b': {'type': entities[j]['type'], 'id': entities[j]['id'], 'nome': entities[j]['nome']},
+                'shared_municipios': int(shared[i, j]),
+                'jaccard': float(jaccard[i, j]),
+                'shared_potentialScore': float(scores[p]),
+                'shared_crop_area': float(crop_areas[p]),
+                'shared_receita': float(receitas[p])
+            } for p, (i, j) in enumerate(pairs.tolist())]
+            conflicts.sort(key=lambda conflict: conflict['shared_municipios'], reverse=True)
+
+            response = {
+                'success': True,
+                'entities': [{'type': entity['type'], 'id': entity['id'], 'nome': entity['nome'],
+                              'distinct_municipios': int(size)} for entity, size in zip(entities, sizes.tolist())],
+                'total_conflicts': len(conflicts),
+                'conflicts': conflicts[:limit] if limit and limit > 0 else conflicts
+            }
+            if with_matrix:
+                response['shared'] = shared.tolist()
+                response['jaccard'] = jaccard.tolist()
+            return response
 
-        # Análise de Escolaridade
-        escolaridade_analysis = analyze_escolaridade_data(municipios_codes)
-        analysis['dataBySource']['escolaridade'] = escolaridade_analysis['total_people']
+        if wants_job():
+            return submit_job('territory-overlap', build, params={'tipo': tipo, 'matrix': with_matrix, 'limit': limit})
+        return jsonify(build())
 
-        # Análise de Receitas
-        receitas_analysis = analyze_receitas_data(municipios_codes)
-        analysis['dataBySource']['receitas'] = receitas_analysis['total_value']
+    except Exception as e:
+        print(f"Erro na sobreposição de territórios: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # Calcular valor total
-        analysis['totalValue'] = (
-            analysis['dataBySource'].get('crops', 0) * 1000 +  # Estimativa de valor por hectare
-            analysis['dataBySource'].get('despesas', 0) +
-            analysis['dataBySource'].get('receitas', 0)
-        )
+MAX_EXPANSION_RESULTS = 200
+
+def requested_territory():
+    """(códigos, None) do território de ?draft= ou ?tipo=&id=; (None, resposta de erro) se inválido"""
+    draft_id = request.args.get('draft')
+    if draft_id:
+        draft = TERRITORY_DRAFTS.get(draft_id)
+        if draft is None:
+            return None, (jsonify({'success': False, 'error': 'Rascunho não encontrado ou expirado'}), 404)
+        with draft.lock:
+            return draft.codes, None
+
+    kind = request.args.get('tipo', 'revenda')
+    entity_id = request.args.get('id', type=int)
+    if kind not in ('revenda', 'vendedor') or entity_id is None:
+        return None, (jsonify({'success': False, 'error': 'Informe tipo (revenda ou vendedor) e id, ou draft'}), 400)
+    codes = entity_territory(kind, entity_id)
+    if codes is None:
+        return None, (jsonify({'success': False, 'error': f'{kind.capitalize()} não encontrado(a)'}), 404)
+    return codes, None
+
+@app.route('/api/analise-potencial/contiguidade')
+@login_required
+def get_analise_potencial_contiguidade():
+    """Contiguidade do território (?tipo=revenda|vendedor&id= ou ?draft=) e suas componentes conexas"""
+    try:
+        if DATASETS.graph is None:
+            return graph_unavailable()
+        codes, error = requested_territory()
+        if error:
+            return error
+
+        positions = np.unique(DATASETS.resolve(codes))
+        components = DATASETS.graph.components(positions)
+        return jsonify({
+            'success': True,
+            'municipios_count': len(codes),
+            'contiguous': len(components) <= 1,
+            'components_count': len(components),
+            'components': [municipality_refs(component) for component in components],
+            'unknown_codes': sorted({str(code) for code in codes} - {DATASETS.index.codes[p] for p in positions.tolist()})
+        })
 
-        # NOVO ALGORITMO DE CÁLCULO MAIS PRECISO E DETALHADO
-        calculation_matrix = {}
-
-        # 1. Diversidade Agrícola (30% - máximo 30 pontos)
-        diversity_raw = analysis['cropsDiversity']
-        diversity_normalized = min(diversity_raw / 20.0, 1.0)  # Normalizar para 0-1 (20+ culturas = máximo)
-        diversity_score = diversity_normalized * 30
-        calculation_matrix['diversity'] = {
-            'raw_value': diversity_raw,
-            'normalized': diversity_normalized,
-            'weight': 0.30,
-            'max_points': 30,
-            'score': diversity_score,
-            'description': f'{diversity_raw} culturas diferentes encontradas'
-        }
+    except Exception as e:
+        print(f"Erro na análise de contiguidade: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # 2. Performance Financeira (25% - máximo 25 pontos)
-        total_receita = analysis['dataBySource'].get('receitas', 0)
-        total_despesa = analysis['dataBySource'].get('despesas', 0)
-        saldo_financeiro = total_receita - total_despesa
+def entity_territory(kind, entity_id):
+    """Códigos dos municípios de uma revenda/vendedor (banco local, depois Supabase); None se não existe"""
+    model = Revenda if kind == 'revenda' else Vendedor
+    entity = model.query.get(entity_id)
+    if entity:
+        return entity.get_municipios_list()
+    if kind == 'revenda':
+        result = auth_manager.supabase_manager.get_revenda_by_id(entity_id)
+    else:
+        result = auth_manager.supabase_manager.get_vendedor_by_id(entity_id)
+    if not result['success']:
+        return None
+    return parse_municipios_codigos(result['data'].get('municipios_codigos'))
+
+@app.route('/api/analise-potencial/expansao')
+@login_required
+def get_analise_potencial_expansao():
+    """Municípios cuja inclusão mais aumenta o potentialScore (?tipo=revenda|vendedor&id= ou ?draft=)
 
-        # Normalizar saldo financeiro (valores positivos são melhores)
-        if total_receita > 0 or total_despesa > 0:
-            financial_ratio = max(0, saldo_financeiro) / max(total_receita, 1)
-            financial_normalized = min(financial_ratio, 1.0)
-        else:
-            financial_normalized = 0
-
-        financial_score = financial_normalized * 25
-        calculation_matrix['financial'] = {
-            'raw_value': saldo_financeiro,
-            'receita': total_receita,
-            'despesa': total_despesa,
-            'normalized': financial_normalized,
-            'weight': 0.25,
-            'max_points': 25,
-            'score': financial_score,
-            'description': f'Saldo: R$ {saldo_financeiro:,.2f} (Receita: R$ {total_receita:,.2f}, Despesa: R$ {total_despesa:,.2f})'
-        }
+    Filtros de candidatos: k, state, mesoregion, microregion, adjacent=1 (só vizinhos) e radius_km;
+    model= escolhe o modelo de pontuação (padrão: o ativo).
+    """
+    try:
+        codes, error = requested_territory()
+        if error:
+            return error
+
+        k = min(max(request.args.get('k', 20, type=int), 1), MAX_EXPANSION_RESULTS)
+        model, error = requested_scoring_model()
+        if error:
+            return error
+
+        # Restrições de candidatos pelo cadastro (UF, mesorregião, microrregião)
+        registry = DATASETS.index
+        allowed = None
+        for param, labels in (('state', registry.states), ('mesoregion', registry.mesoregions),
+                              ('microregion', registry.microregions)):
+            value = request.args.get(param)
+            if value:
+                mask = np.asarray(labels, dtype=str) == value
+                allowed = mask if allowed is None else allowed & mask
+
+        # Restrições geográficas: só vizinhos do território e/ou até radius_km de algum município dele
+        adjacent = request.args.get('adjacent') == '1'
+        radius_km = request.args.get('radius_km', type=float)
+        if adjacent or radius_km is not None:
+            if DATASETS.graph is None:
+                return graph_unavailable()
+            members = np.unique(DATASETS.resolve(codes))
+            if adjacent:
+                member_mask = np.zeros(len(registry), dtype=bool)
+                member_mask[members] = True
+                mask = DATASETS.graph.expand(member_mask)
+                allowed = mask if allowed is None else allowed & mask
+            if radius_km is not None:
+                mask = DATASETS.graph.distances_km(members) <= radius_km
+                allowed = mask if allowed is None else allowed & mask
+
+        current, candidates = top_expansions(POTENTIAL_FEATURES, model, codes, k, allowed)
+        return jsonify({
+            'success': True,
+            'model_version': model.version,
+            'municipios_count': len(codes),
+            'current': {'potentialScore': current['final_score'],
+                        'breakdown': {component: current[component] for component in model.component_names}},
+            'candidates': candidates
+        })
 
-        # 3. Abrangência Territorial (20% - máximo 20 pontos)
-        num_municipios = len(municipios_codes)
-        territorial_normalized = min(num_municipios / 50.0, 1.0)  # 50+ municípios = máximo
-        territorial_score = territorial_normalized * 20
-        calculation_matrix['territorial'] = {
-            'raw_value': num_municipios,
-            'normalized': territorial_normalized,
-            'weight': 0.20,
-            'max_points': 20,
-            'score': territorial_score,
-            'description': f'{num_municipios} municípios na área de atuação'
-        }
+    except Exception as e:
+        print(f"Erro no assistente de expansão territorial: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # 4. Atividade de Mercado (25% - máximo 25 pontos)
-        # Subcritérios: Fertilizantes (40%), Consultoria (30%), Agrotóxicos (30%)
-        fertilizers_subscore = (analysis['fertilizersUsage'] / 100.0) * 0.4
-        consultoria_subscore = (analysis['technicalAssistance'] / 100.0) * 0.3
-        agrotoxicos_subscore = (analysis['agrotoxicosUsage'] / 100.0) * 0.3
-
-        market_activity_normalized = fertilizers_subscore + consultoria_subscore + agrotoxicos_subscore
-        market_activity_score = market_activity_normalized * 25
-
-        calculation_matrix['market_activity'] = {
-            'raw_values': {
-                'fertilizers': analysis['fertilizersUsage'],
-                'consultoria': analysis['technicalAssistance'],
-                'agrotoxicos': analysis['agrotoxicosUsage']
-            },
-            'subscores': {
-                'fertilizers': fertilizers_subscore,
-                'consultoria': consultoria_subscore,
-                'agrotoxicos': agrotoxicos_subscore
-            },
-            'normalized': market_activity_normalized,
-            'weight': 0.25,
-            'max_points': 25,
-            'score': market_activity_score,
-            'description': f'Fertilizantes: {analysis["fertilizersUsage"]:.1f}%, Consultoria: {analysis["technicalAssistance"]:.1f}%, Agrotóxicos: {analysis["agrotoxicosUsage"]:.1f}%'
-        }
+MAX_PARTITION_PARTS = 50
+MAX_PARTITION_SECONDS = 60
+MAX_PARTITION_RESTARTS = 32
+
+def revenda_coverage(positions):
+    """(revendas ativas que tocam a área, matriz municípios da área × essas revendas)"""
+    revendas = active_territories(('revenda',))
+    if not revendas:
+        return [], np.zeros((len(positions), 0), dtype=bool)
+    membership = TERRITORY_BITSETS.membership(TERRITORY_BITSETS.matrix(revendas))
+    local = np.full(len(DATASETS.index), -1, dtype=np.int64)
+    local[positions] = np.arange(len(positions))
+    rows = np.repeat(np.arange(len(revendas)), np.diff(membership.indptr))
+    inside = local[membership.indices] >= 0
+    touching = np.unique(rows[inside])
+    column = np.full(len(revendas), -1, dtype=np.int64)
+    column[touching] = np.arange(len(touching))
+    coverage = np.zeros((len(positions), len(touching)), dtype=bool)
+    coverage[local[membership.indices[inside]], column[rows[inside]]] = True
+    return [revendas[i] for i in touching.tolist()], coverage
+
+@app.route('/api/vendedores/particionar', methods=['POST'])
+@login_required
+def api_particionar_vendedores():
+    """Divide uma UF (state) ou lista de municípios (municipios_codigos) em n_vendedores territórios contíguos
+
+    Balanceia área de culturas, estabelecimentos com fertilizantes e receita e evita espalhar cada
+    território por muitas revendas. Parâmetros opcionais: seed, time_budget (s), restarts, workers,
+    overlap_weight e considerar_revendas (?async=1: tarefa em segundo plano). Os municipios_codigos
+    de cada parte vão direto para POST /api/vendedores.
+    """
+    try:
+        if DATASETS.graph is None:
+            return graph_unavailable()
+        data = request.get_json(silent=True) or {}
+        registry = DATASETS.index
+
+        # Só municípios: linhas agregadas (UF, meso/microrregião) também têm UF, mas não são vértices do grafo
+        municipalities = registry.valid_mask(check_keywords=False, check_excluded_names=False)
+        state = data.get('state')
+        if state:
+            positions = np.flatnonzero((np.asarray(registry.states, dtype=str) == str(state)) & municipalities)
+        else:
+            positions = np.unique(DATASETS.resolve(parse_municipios_codigos(data.get('municipios_codigos'))))
+            positions = positions[positions >= 0]
+            positions = positions[municipalities[positions]]
+        if not len(positions):
+            return jsonify({'success': False, 'error': 'Informe state ou municipios_codigos com municípios válidos'}), 400
 
-        # Calcular pontuação final
-        final_score = diversity_score + financial_score + territorial_score + market_activity_score
-
-        # Aplicar ajustes baseados na produtividade média
-        productivity_bonus = 0
-        if analysis['avgProductivity'] > 0:
-            # Bonus de até 5 pontos para alta produtividade
-            productivity_normalized = min(analysis['avgProductivity'] / 5000.0, 1.0)  # 5000+ ha/município = máximo
-            productivity_bonus = productivity_normalized * 5
-
-        calculation_matrix['productivity_bonus'] = {
-            'raw_value': analysis['avgProductivity'],
-            'normalized': productivity_normalized if analysis['avgProductivity'] > 0 else 0,
-            'bonus_points': productivity_bonus,
-            'description': f'Produtividade média: {analysis["avgProductivity"]:.1f} ha/município'
-        }
+        try:
+            n_parts = int(data.get('n_vendedores', 0))
+            seed = int(data.get('seed', 0))
+            time_budget = min(max(float(data.get('time_budget', 10)), 0.1), MAX_PARTITION_SECONDS)
+            restarts = min(max(int(data.get('restarts', 8)), 1), MAX_PARTITION_RESTARTS)
+            workers = int(data.get('workers') or os.environ.get('PARTITION_WORKERS', 0)) or None
+            overlap_weight = max(float(data.get('overlap_weight', 0.01)), 0.0)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Parâmetros numéricos inválidos'}), 400
+        if not 1 <= n_parts <= min(MAX_PARTITION_PARTS, len(positions)):
+            return jsonify({'success': False,
+                            'error': f'n_vendedores deve estar entre 1 e {min(MAX_PARTITION_PARTS, len(positions))}'}), 400
+
+        if data.get('considerar_revendas', True):
+            revendas, coverage = revenda_coverage(positions)
+        else:
+            revendas, coverage = [], np.zeros((len(positions), 0), dtype=bool)
+
+        def build(progress=no_progress):
+            weights = partition_weights(DATASETS, positions)
+            indptr, indices = subgraph(DATASETS.graph, positions)
+            problem = PartitionProblem(indptr, indices, weights, coverage, n_parts, overlap_weight)
+
+            started = time.perf_counter()
+            result = optimize(problem, seed=seed, restarts=restarts, workers=workers, time_budget=time_budget)
+            elapsed = time.perf_counter() - started
+
+            state_result = PartitionState(problem, result['assignment'])
+            totals = weights.sum(axis=0)
+            parts = []
+            for part in range(n_parts):
+                members = positions[result['assignment'] == part]
+                local_members = result['assignment'] == part
+                part_totals = weights[local_members].sum(axis=0)
+                components = DATASETS.graph.components(members)
+                parts.append({
+                    'index': part + 1,
+                    'municipios_codigos': [registry.codes[position] for position in members.tolist()],
+                    'municipios_count': len(members),
+                    'totals': {name: float(value) for name, value in zip(BALANCE_COMPONENTS, part_totals)},
+                    'shares': {name: float(value / total) if total > 0 else None
+                               for name, value, total in zip(BALANCE_COMPONENTS, part_totals, totals)},
+                    'contiguous': len(components) <= 1,
+                    'components_count': len(components),
+                    'revendas': [{'id': revendas[j]['id'], 'nome': revendas[j]['nome']}
+                                 for j in np.flatnonzero(state_result.revenda_counts[part]).tolist()]
+                })
 
-        final_score = min(final_score + productivity_bonus, 100)  # Máximo de 100 pontos
-
-        # Resumo da matriz de cálculo
-        calculation_matrix['summary'] = {
-            'base_score': diversity_score + financial_score + territorial_score + market_activity_score,
-            'productivity_bonus': productivity_bonus,
-            'final_score': final_score,
-            'breakdown': {
-                'diversity': diversity_score,
-                'financial': financial_score,
-                'territorial': territorial_score,
-                'market_activity': market_activity_score
+            return {
+                'success': True,
+                'municipios_count': len(positions),
+                'n_vendedores': n_parts,
+                'seed': seed,
+                'restarts': restarts,
+                'best_attempt': result['attempt'],
+                'complete': result['complete'],
+                'elapsed_seconds': elapsed,
+                'objective': result['objective'],
+                'balance_error': state_result.balance_error(),
+                'revenda_conflicts': state_result.conflicts(),
+                'totals': {name: float(value) for name, value in zip(BALANCE_COMPONENTS, totals)},
+                'parts': parts
             }
-        }
-
-        analysis['potentialScore'] = final_score
-        analysis['calculationMatrix'] = calculation_matrix
 
-        # Gerar recomendações baseadas na matriz de cálculo
-        analysis['recommendations'] = generate_enhanced_recommendations(analysis, calculation_matrix)
+        if wants_job():
+            return submit_job('vendedor-partition', build, params={
+                'state': state, 'municipios_count': len(positions), 'n_vendedores': n_parts, 'seed': seed})
+        return jsonify(build())
 
     except Exception as e:
-        print(f"Erro na análise de potencial: {str(e)}")
+        print(f"Erro no particionamento de territórios: {str(e)}")
         import traceback
         traceback.print_exc()
-        # Retornar análise padrão em caso de erro
-        analysis['recommendations'] = ['Erro ao processar dados - análise limitada']
-        analysis['calculationMatrix'] = {'error': str(e)}
-
-    return analysis
-
-def analyze_crops_data(municipios_codes):
-    """Analisa dados de culturas para os municípios"""
-    total_hectares = 0
-    crops_found = set()
-    top_crops = []
+        return jsonify({'success': False, 'error': str(e)}), 500
 
+def draft_analysis_response(draft_id, draft, **extra):
+    """Potencial recalculado a partir dos agregados do rascunho (sem reler o território)"""
+    return jsonify({
+        'success': True,
+        'draft_id': draft_id,
+        'municipios_count': draft.n_codes,
+        'analysis': analyze_revenda_potential(None, profile=draft),
+        **extra
+    })
+
+@app.route('/api/analise-potencial/rascunho', methods=['POST'])
+@login_required
+def create_territory_draft():
+    """Abre um território em edição (body: {"municipios": [códigos]}) e devolve o potencial inicial"""
     try:
-        for crop_name, crop_data in CROP_DATA.items():
-            crop_total = 0
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in crop_data:
-                    area = crop_data[municipio_str].get('harvested_area', 0)
-                    total_hectares += area
-                    crop_total += area
-                    if area > 0:
-                        crops_found.add(crop_name)
-
-            if crop_total > 0:
-                top_crops.append({'name': crop_name, 'value': crop_total})
+        data = request.get_json(silent=True) or {}
+        municipios = data.get('municipios', [])
+        if not isinstance(municipios, list):
+            return jsonify({'success': False, 'error': 'municipios deve ser uma lista de códigos'}), 400
 
-        # Ordenar e pegar top 5 culturas
-        top_crops.sort(key=lambda x: x['value'], reverse=True)
-        top_crops = top_crops[:5]
+        draft_id, draft = TERRITORY_DRAFTS.create(municipios)
+        with draft.lock:
+            return draft_analysis_response(draft_id, draft)
 
     except Exception as e:
-        print(f"Erro na análise de culturas: {str(e)}")
-
-    return {
-        'diversity': len(crops_found),
-        'avg_productivity': total_hectares / max(len(municipios_codes), 1),
-        'total_value': total_hectares,
-        'top_crops': top_crops
-    }
-
-def analyze_fertilizers_data(municipios_codes):
-    """Analisa dados de fertilizantes para os municípios"""
-    total_establishments = 0
-    municipalities_with_data = 0
+        print(f"Erro ao criar rascunho de território: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/analise-potencial/rascunho/<draft_id>', methods=['PATCH'])
+@login_required
+def update_territory_draft(draft_id):
+    """Aplica inclusões/remoções (body: {"add": [...], "remove": [...]}) e devolve o potencial atualizado"""
     try:
-        # Excluir categorias que são totalizações
-        excluded_categories = ['Total Estabelecimentos', 'Total estabelecimentos', 'TOTAL']
+        draft = TERRITORY_DRAFTS.get(draft_id)
+        if draft is None:
+            return jsonify({'success': False, 'error': 'Rascunho não encontrado ou expirado'}), 404
+
+        data = request.get_json(silent=True) or {}
+        added = data.get('add', [])
+        removed = data.get('remove', [])
+        if not isinstance(added, list) or not isinstance(removed, list):
+            return jsonify({'success': False, 'error': 'add e remove devem ser listas de códigos'}), 400
+
+        with draft.lock:
+            for code in added:
+                draft.add(code)
+            not_in_territory = [code for code in removed if not draft.remove(code)]
+            return draft_analysis_response(draft_id, draft, not_in_territory=not_in_territory)
 
-        for category_name, category_data in FERTILIZER_DATA.items():
-            # Pular categorias de totalização
-            if category_name in excluded_categories:
-                continue
-
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in category_data:
-                    value = category_data[municipio_str].get('value', 0)
-                    total_establishments += value
-                    if value > 0:
-                        municipalities_with_data += 1
-                        break  # Conta o município apenas uma vez
     except Exception as e:
-        print(f"Erro na análise de fertilizantes: {str(e)}")
-
-    usage_percentage = (municipalities_with_data / max(len(municipios_codes), 1)) * 100
-
-    return {
-        'total_establishments': total_establishments,
-        'usage_percentage': min(usage_percentage, 100)
-    }
-
-def analyze_agrotoxicos_data(municipios_codes):
-    """Analisa dados de agrotóxicos para os municípios"""
-    total_establishments = 0
-    municipalities_with_data = 0
+        print(f"Erro ao atualizar rascunho de território {draft_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/analise-potencial/rascunho/<draft_id>', methods=['DELETE'])
+@login_required
+def delete_territory_draft(draft_id):
+    """Descarta um território em edição"""
     try:
-        for category_name, category_data in AGROTOXICO_DATA.items():
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in category_data:
-                    value = category_data[municipio_str].get('value', 0)
-                    total_establishments += value
-                    if value > 0:
-                        municipalities_with_data += 1
-                        break
+        return jsonify({'success': True, 'discarded': TERRITORY_DRAFTS.discard(draft_id)})
     except Exception as e:
-        print(f"Erro na análise de agrotóxicos: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-    usage_percentage = (municipalities_with_data / max(len(municipios_codes), 1)) * 100
+def analyze_revenda_potential(municipios_codes, profile=None, model=None):
+    """Analisa o potencial de uma revenda baseado em seus municípios (model: ScoringModel, padrão o ativo)"""
 
-    return {
-        'total_establishments': total_establishments,
-        'usage_percentage': min(usage_percentage, 100)
+    analysis = {
+        'potentialScore': 0,
+        'totalValue': 0,
+        'cropsDiversity': 0,
+        'avgProductivity': 0,
+        'fertilizersUsage': 0,
+        'agrotoxicosUsage': 0,
+        'technicalAssistance': 0,
+        'recommendations': [],
+        'dataBySource': {},
+        'topCrops': [],
+        'calculationMatrix': {}  # Nova matriz detalhada de cálculo
     }
 
-def analyze_consultoria_data(municipios_codes):
-    """Analisa dados de consultoria técnica para os municípios"""
-    total_establishments = 0
-    municipalities_with_data = 0
-
     try:
-        for category_name, category_data in CONSULTORIA_DATA.items():
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in category_data:
-                    value = category_data[municipio_str].get('value', 0)
-                    total_establishments += value
-                    if value > 0:
-                        municipalities_with_data += 1
-                        break
-    except Exception as e:
-        print(f"Erro na análise de consultoria: {str(e)}")
-
-    coverage_percentage = (municipalities_with_data / max(len(municipios_codes), 1)) * 100
-
-    return {
-        'total_establishments': total_establishments,
-        'coverage_percentage': min(coverage_percentage, 100)
-    }
+        # Todas as fontes agregadas de uma vez sobre as posições do território
+        profile = profile or TerritoryProfile(DATASETS, municipios_codes)
 
-def analyze_corretivos_data(municipios_codes):
-    """Analisa dados de corretivos para os municípios"""
-    total_establishments = 0
-
-    try:
-        for category_name, category_data in CORRETIVOS_DATA.items():
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in category_data:
-                    value = category_data[municipio_str].get('value', 0)
-                    total_establishments += value
-    except Exception as e:
-        print(f"Erro na análise de corretivos: {str(e)}")
+        # Análise de Culturas
+        crops_analysis = profile.crops_summary()
+        analysis['cropsDiversity'] = crops_analysis['diversity']
+        analysis['avgProductivity'] = crops_analysis['avg_productivity']
+        analysis['topCrops'] = crops_analysis['top_crops']
+        analysis['dataBySource']['crops'] = crops_analysis['total_value']
 
-    return {
-        'total_establishments': total_establishments
-    }
+        # Análise de Fertilizantes (sem as categorias que são totalizações)
+        total_establishments, municipalities_with_data = profile['fertilizers'].first_hit_totals(TOTAL_CATEGORIES)
+        analysis['fertilizersUsage'] = profile.share(municipalities_with_data)
+        analysis['dataBySource']['fertilizers'] = total_establishments
 
-def analyze_despesas_data(municipios_codes):
-    """Analisa dados de despesas para os municípios"""
-    total_value = 0
+        # Análise de Agrotóxicos
+        total_establishments, municipalities_with_data = profile['agrotoxico'].first_hit_totals()
+        analysis['agrotoxicosUsage'] = profile.share(municipalities_with_data)
+        analysis['dataBySource']['agrotoxicos'] = total_establishments
 
-    try:
-        for category_name, category_data in DESPESA_DATA.items():
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in category_data:
-                    value = category_data[municipio_str].get('value', 0)
-                    total_value += value
-    except Exception as e:
-        print(f"Erro na análise de despesas: {str(e)}")
+        # Análise de Consultoria Técnica
+        total_establishments, municipalities_with_data = profile['consultoria'].first_hit_totals()
+        analysis['technicalAssistance'] = profile.share(municipalities_with_data)
+        analysis['dataBySource']['consultoria'] = total_establishments
 
-    return {
-        'total_value': total_value
-    }
+        # Corretivos, Despesas, Escolaridade e Receitas: soma de todas as categorias
+        analysis['dataBySource']['corretivos'] = profile['corretivos'].total()
+        analysis['dataBySource']['despesas'] = profile['despesa'].total()
+        analysis['dataBySource']['escolaridade'] = profile['escolaridade'].total()
+        analysis['dataBySource']['receitas'] = profile['receita'].total()
 
-def analyze_escolaridade_data(municipios_codes):
-    """Analisa dados de escolaridade para os municípios"""
-    total_people = 0
+        # Calcular valor total
+        analysis['totalValue'] = (
+            analysis['dataBySource'].get('crops', 0) * 1000 +  # Estimativa de valor por hectare
+            analysis['dataBySource'].get('despesas', 0) +
+            analysis['dataBySource'].get('receitas', 0)
+        )
 
-    try:
-        for category_name, category_data in ESCOLARIDADE_DATA.items():
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in category_data:
-                    value = category_data[municipio_str].get('value', 0)
-                    total_people += value
-    except Exception as e:
-        print(f"Erro na análise de escolaridade: {str(e)}")
+        # Pontuação pelo modelo configurado (pesos, normalizações e fórmulas em data/scoring_models.json)
+        model = model or SCORING_MODELS.active
+        calculation_matrix, final_score = model.calculation_matrix({
+            'municipios': profile.n_codes,
+            'diversity': analysis['cropsDiversity'],
+            'crops_total': analysis['dataBySource'].get('crops', 0),
+            'avg_productivity': analysis['avgProductivity'],
+            'receita': analysis['dataBySource'].get('receitas', 0),
+            'despesa': analysis['dataBySource'].get('despesas', 0),
+            'fertilizers_usage': analysis['fertilizersUsage'],
+            'consultoria_usage': analysis['technicalAssistance'],
+            'agrotoxicos_usage': analysis['agrotoxicosUsage'],
+            'state': POTENTIAL_FEATURES.dominant_state(profile.codes)
+        })
 
-    return {
-        'total_people': total_people
-    }
+        analysis['potentialScore'] = final_score
+        analysis['calculationMatrix'] = calculation_matrix
 
-def analyze_receitas_data(municipios_codes):
-    """Analisa dados de receitas para os municípios"""
-    total_value = 0
+        # Gerar recomendações baseadas na matriz de cálculo
+        analysis['recommendations'] = generate_enhanced_recommendations(analysis, calculation_matrix, model.labels())
 
-    try:
-        for category_name, category_data in RECEITA_DATA.items():
-            for municipio_code in municipios_codes:
-                municipio_str = str(municipio_code)
-                if municipio_str in category_data:
-                    value = category_data[municipio_str].get('value', 0)
-                    total_value += value
     except Exception as e:
-        print(f"Erro na análise de receitas: {str(e)}")
+        print(f"Erro na análise de potencial: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        # Retornar análise padrão em caso de erro
+        analysis['recommendations'] = ['Erro ao processar dados - análise limitada']
+        analysis['calculationMatrix'] = {'error': str(e)}
 
-    return {
-        'total_value': total_value
-    }
+    return analysis
 
-def generate_enhanced_recommendations(analysis, calculation_matrix):
-    """Gera recomendações baseadas na análise detalhada"""
+def generate_enhanced_recommendations(analysis, calculation_matrix, labels=None):
+    """Gera recomendações baseadas na análise detalhada (labels: nome de cada componente do modelo)"""
     recommendations = []
 
     try:
@@ -3163,7 +3418,7 @@ def generate_enhanced_recommendations(analysis, calculation_matrix):
         if 'diversity' in matrix:
             diversity_score = matrix['diversity']['score']
             if diversity_score < 10:
-                recommendations.append(f"⚠️ Baixa diversidade ({matrix['diversity']['raw_value']} culturas) - diversifique para reduzir riscos e aumentar {30-diversity_score:.1f} pontos")
+                recommendations.append(f"⚠️ Baixa diversidade ({matrix['diversity']['raw_value']} culturas) - diversifique para reduzir riscos e aumentar {matrix['diversity']['max_points']-diversity_score:.1f} pontos")
             elif diversity_score > 25:
                 recommendations.append(f"✅ Excelente diversidade ({matrix['diversity']['raw_value']} culturas) - mantenha essa estratégia")
 
@@ -3175,7 +3430,7 @@ def generate_enhanced_recommendations(analysis, calculation_matrix):
                 if saldo < 0:
                     recommendations.append(f"⚠️ Saldo financeiro negativo (R$ {saldo:,.2f}) - foque em eficiência e redução de custos")
                 else:
-                    recommendations.append(f"⚠️ Baixa performance financeira - oportunidade de crescimento de até {25-financial_score:.1f} pontos")
+                    recommendations.append(f"⚠️ Baixa performance financeira - oportunidade de crescimento de até {matrix['financial']['max_points']-financial_score:.1f} pontos")
             elif financial_score > 20:
                 recommendations.append(f"✅ Boa saúde financeira (saldo: R$ {saldo:,.2f}) - mantenha o equilíbrio")
 
@@ -3184,7 +3439,7 @@ def generate_enhanced_recommendations(analysis, calculation_matrix):
             territorial_score = matrix['territorial']['score']
             num_municipios = matrix['territorial']['raw_value']
             if territorial_score < 8:
-                recommendations.append(f"📍 Abrangência limitada ({num_municipios} municípios) - considere expansão territorial para ganhar {20-territorial_score:.1f} pontos")
+                recommendations.append(f"📍 Abrangência limitada ({num_municipios} municípios) - considere expansão territorial para ganhar {matrix['territorial']['max_points']-territorial_score:.1f} pontos")
             elif territorial_score > 15:
                 recommendations.append(f"✅ Boa cobertura territorial ({num_municipios} municípios) - aproveite a escala")
 
@@ -3195,15 +3450,15 @@ def generate_enhanced_recommendations(analysis, calculation_matrix):
 
             if market_score < 10:
                 weak_areas = []
-                if raw_values['fertilizers'] < 30:
+                if raw_values.get('fertilizers', 100) < 30:
                     weak_areas.append("fertilizantes")
-                if raw_values['consultoria'] < 25:
+                if raw_values.get('consultoria', 100) < 25:
                     weak_areas.append("consultoria técnica")
-                if raw_values['agrotoxicos'] < 20:
+                if raw_values.get('agrotoxicos', 100) < 20:
                     weak_areas.append("agrotóxicos")
 
                 if weak_areas:
-                    recommendations.append(f"📈 Baixa atividade de mercado em: {', '.join(weak_areas)} - oportunidade de {25-market_score:.1f} pontos")
+                    recommendations.append(f"📈 Baixa atividade de mercado em: {', '.join(weak_areas)} - oportunidade de {matrix['market_activity']['max_points']-market_score:.1f} pontos")
             elif market_score > 20:
                 recommendations.append("✅ Alto nível de atividade de mercado - mercado maduro e ativo")
 
@@ -3231,12 +3486,7 @@ def generate_enhanced_recommendations(analysis, calculation_matrix):
         if 'summary' in matrix:
             breakdown = matrix['summary']['breakdown']
             lowest_component = min(breakdown.items(), key=lambda x: x[1])
-            component_names = {
-                'diversity': 'diversidade de culturas',
-                'financial': 'performance financeira',
-                'territorial': 'abrangência territorial',
-                'market_activity': 'atividade de mercado'
-            }
+            component_names = labels or {}
             recommendations.append(f"🔍 PRIORIDADE: Melhorar {component_names.get(lowest_component[0], lowest_component[0])} ({lowest_component[1]:.1f} pts)")
 
         if not recommendations:
@@ -3300,17 +3550,10 @@ def get_revenda_data(revenda_id):
         for municipio_code in municipios_codigos:
             municipio_code_str = str(municipio_code)
 
-            # Buscar nome do município nos dados de culturas
-            municipality_name = f"Município {municipio_code}" # Default name
-            state_code = "XX" # Default state code
-
-            # Procurar o nome real do município nos dados de culturas
-            for crop_name, crop_data in CROP_DATA.items():
-                if municipio_code_str in crop_data:
-                    municipality_data = crop_data[municipio_code_str]
-                    municipality_name = municipality_data.get('municipality_name', municipality_name)
-                    state_code = municipality_data.get('state_code', state_code)
-                    break
+            # Buscar nome do município no cadastro (O(1))
+            municipality_name, state_code = municipality_name_and_state(municipio_code_str)
+            municipality_name = municipality_name or f"Município {municipio_code}" # Default name
+            state_code = state_code or "XX" # Default state code
 
             territory_data[municipio_code_str] = {
                 'municipality_name': municipality_name,
@@ -3431,48 +3674,15 @@ def download_revendas_template():
 def download_municipios_referencia():
     """Download planilha de referência com todos os códigos IBGE de municípios"""
     try:
-        # Carregar dados dos municípios do arquivo estático
-        crop_data_path = os.path.join(os.path.dirname(__file__), 'data', 'crop_data_static.json')
-
-        municipios_data = []
-
-        if os.path.exists(crop_data_path):
-            with open(crop_data_path, 'r', encoding='utf-8') as f:
-                crop_data = json.load(f)
-
-            # Extrair todos os municípios únicos de todas as culturas
-            all_municipalities = {}
-
-            for crop_name, crop_municipalities in crop_data.items():
-                for municipality_code, municipality_data in crop_municipalities.items():
-                    municipality_code_str = str(municipality_code)
-                    municipality_name = municipality_data.get('municipality_name', '').lower()
-
-                    # Verificar se é um código de município válido
-                    if (len(municipality_code_str) == 7 and 
-                        municipality_code_str.isdigit() and
-                        municipality_code_str[0] in '12345' and
-                        municipality_data.get('municipality_name') and
-                        not any(keyword in municipality_name for keyword in [
-                            'região', 'mesorregião', 'microrregião', 'nordeste', 'norte', 'sul', 
-                            'centro', 'oeste', 'leste', 'sudeste', 'noroeste', 'sudoeste',
-                            'alto ', 'baixo ', 'médio ', '-grossense', 'parecis', 'araguaia',
-                            'pantanal', 'cerrado', 'amazônia', 'caatinga', 'mata atlântica'
-                        ]) and
-                        municipality_name not in [
-                            'alto teles pires', 'sudeste mato-grossense', 'parecis', 'barreiras',
-                            'dourados', 'norte mato-grossense', 'portal da amazônia'
-                        ]):
-
-                        all_municipalities[municipality_code] = {
-                            'codigo_municipio': municipality_code,
-                            'nome_municipio': municipality_data.get('municipality_name', ''),
-                            'uf': municipality_data.get('state_code', '')
-                        }
-
-            # Converter para lista e ordenar
-            municipios_data = list(all_municipalities.values())
-            municipios_data.sort(key=lambda x: (x['uf'], x['nome_municipio']))
+        # Municípios válidos com dados em ao menos uma cultura
+        crops = DATASETS['crops']
+        rows = filter_valid_municipalities(crops, crops.municipality_rows())
+        municipios_data = [{
+            'codigo_municipio': crops.index.codes[position],
+            'nome_municipio': name,
+            'uf': state
+        } for position, name, state in zip(rows.tolist(), crops.names[rows].tolist(), crops.states[rows].tolist())]
+        municipios_data.sort(key=lambda x: (x['uf'], x['nome_municipio']))
 
         # Se não conseguir carregar os dados, usar alguns exemplos
         if not municipios_data:
@@ -3931,6 +4141,7 @@ def update_vendedor(vendedor_id):
         result = auth_manager.update_vendedor(vendedor_id, updates)
 
         if result['success']:
+            TERRITORY_CACHE.invalidate(('vendedor', vendedor_id))
             return jsonify({
                 'success': True,
                 'message': 'Vendedor atualizado com sucesso!'
@@ -3949,6 +4160,7 @@ def delete_vendedor(vendedor_id):
         result = auth_manager.delete_vendedor(vendedor_id)
 
         if result['success']:
+            TERRITORY_CACHE.invalidate(('vendedor', vendedor_id))
             return jsonify({
                 'success': True,
                 'message': 'Vendedor removido com sucesso!'
@@ -0,0 +1,145 @@
+"""
+Distribuições de referência para normalizar a pontuação por percentil
+
+Em vez de dividir cada grandeza por um valor fixo (diversidade/20,
+municípios/50, produtividade/5000), que satura em territórios grandes e some
+nos pequenos, a fórmula `percentile` dos modelos de pontuação usa a posição do
+território entre territórios de referência: a fração deles com valor menor.
+
+As referências são territórios sorteados uma vez por versão dos dados (seed
+fixa, então todos os processos do gunicorn chegam aos mesmos valores): tamanho
+log-uniforme entre 1 e max_size municípios, todos da mesma UF. Os nacionais
+sorteiam a UF proporcionalmente ao nº de municípios; cada UF tem também os
+seus. As grandezas brutas (RAW_INPUTS) de todos saem de PotentialFeatures e
+ficam em arrays ordenados, então cada consulta é uma busca binária.
+"""
+import json
+import threading
+
+import numpy as np
+
+from dataset_engine import content_hash
+from potential_batch import MembershipMatrix
+from scoring_model import RAW_INPUTS
+
+# Territórios sorteados por distribuição (nacional e de cada UF) e tamanho máximo deles
+NATIONAL_SAMPLES = 2000
+STATE_SAMPLES = 200
+MAX_TERRITORY_SIZE = 250
+
+# Territórios por bloco no cálculo das grandezas (limita a memória do produto esparso)
+CHUNK_SIZE = 256
+
+
+class ScoreDistributions:
+    """Valores ordenados de cada grandeza bruta, nacionais e por UF, calculados na primeira consulta"""
+
+    def __init__(self, features, samples=NATIONAL_SAMPLES, state_samples=STATE_SAMPLES,
+                 max_size=MAX_TERRITORY_SIZE, seed=0):
+        self.features = features
+        self.params = {'samples': samples, 'state_samples': state_samples, 'max_size': max_size, 'seed': seed}
+        engine = features.engine
+        self.version = content_hash(*[dataset.version for dataset in engine.sources.values()],
+                                    json.dumps(self.params, sort_keys=True))[:12]
+        self.lock = threading.Lock()
+        self.national = None
+        self.by_state = None
+
+    @property
+    def state_names(self):
+        return self.features.state_names
+
+    @property
+    def built(self):
+        return self.national is not None
+
+    def build(self):
+        """Sorteia os territórios de referência e ordena as grandezas (uma vez)"""
+        with self.lock:
+            if self.built:
+                return
+            registry = self.features.engine.index
+            state_ids = self.features.state_ids
+            pool = registry.valid_mask() & (state_ids >= 0)
+            pools = [np.flatnonzero(pool & (state_ids == state)) for state in range(len(self.state_names))]
+            sizes = np.array([len(positions) for positions in pools], dtype=np.float64)
+            rng = np.random.default_rng(self.params['seed'])
+
+            national = None
+            if sizes.sum() > 0:
+                states = rng.choice(len(pools), size=self.params['samples'], p=sizes / sizes.sum())
+                national = self._distribution(self._sample(pools, states, rng))
+            by_state = []
+            for state, positions in enumerate(pools):
+                if not len(positions):
+                    by_state.append(None)
+                    continue
+                states = np.full(self.params['state_samples'], state)
+                by_state.append(self._distribution(self._sample(pools, states, rng)))
+            self.by_state = by_state
+            self.national = national or {name: np.zeros(0) for name in RAW_INPUTS}
+
+    def _sample(self, pools, states, rng):
+        """Territórios (CSR sobre o cadastro) de tamanho log-uniforme, cada um dentro da sua UF"""
+        sizes = np.rint(np.exp(rng.uniform(0, np.log(self.params['max_size']), len(states)))).astype(np.int64)
+        indptr, indices = [0], []
+        for state, size in zip(states.tolist(), sizes.tolist()):
+            members = np.sort(rng.choice(pools[state], size=min(size, len(pools[state])), replace=False))
+            indices.append(members)
+            indptr.append(indptr[-1] + len(members))
+        return np.array(indptr, dtype=np.int64), np.concatenate(indices)
+
+    def _distribution(self, territories):
+        indptr, indices = territories
+        n_territories = len(indptr) - 1
+        chunks = []
+        for start in range(0, n_territories, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_territories)
+            membership = MembershipMatrix.from_csr(indptr[start:stop + 1] - indptr[start],
+                                                   indices[indptr[start]:indptr[stop]],
+                                                   (stop - start, len(self.features.engine.index)))
+            chunks.append(self.features.raw_components(membership))
+        return {name: np.sort(np.concatenate([np.asarray(chunk[name], dtype=np.float64) for chunk in chunks]))
+                for name in RAW_INPUTS}
+
+    def reference(self, name, state=-1):
+        """Valores ordenados de uma grandeza na UF (id) ou nacionais (UF desconhecida ou sem municípios)"""
+        self.build()
+        if 0 <= state < len(self.by_state) and self.by_state[state] is not None:
+            return self.by_state[state][name]
+        return self.national[name]
+
+    def percentile(self, name, values, states=None):
+        """Fração (0..1) dos territórios de referência com valor menor, nacional ou na UF de cada território"""
+        values = np.asarray(values, dtype=np.float64)
+        if states is None:
+            return rank_fraction(self.reference(name), values)
+        states = np.broadcast_to(np.asarray(states, dtype=np.int64), values.shape)
+        fractions = np.empty(values.shape)
+        for state in np.unique(states).tolist():
+            selected = states == state
+            fractions[selected] = rank_fraction(self.reference(name, state), values[selected])
+        return fractions
+
+    def state_label(self, state):
+        """Nome da referência de uma UF (id) como aparece na calculationMatrix"""
+        self.build()
+        if 0 <= state < len(self.by_state) and self.by_state[state] is not None:
+            return self.state_names[state]
+        return 'Brasil'
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'built': self.built,
+            **self.params,
+            'states': [name for name, distribution in zip(self.state_names, self.by_state or [])
+                       if distribution is not None]
+        }
+
+
+def rank_fraction(sorted_values, values):
+    """Fração de sorted_values (crescente) estritamente menor que cada valor; 0 sem referência"""
+    if not len(sorted_values):
+        return np.zeros(np.shape(values))
+    return np.searchsorted(sorted_values, values, side='left') / len(sorted_values)
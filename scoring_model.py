@@ -0,0 +1,242 @@
+"""
+Modelos de pontuação de potencial versionados (pesos, normalizações e fórmulas em configuração)
+
+Os modelos ficam em data/scoring_models.json. Cada um tem componentes (somados
+no base_score) e bônus (somados depois, com teto `cap`); cada componente usa uma
+das fórmulas abaixo sobre as grandezas brutas do território (RAW_INPUTS) e vale
+normalizado (0..1) × max_points. Um modelo é compilado uma vez em funções
+vetorizadas: a mesma avaliação pontua um território (arrays de tamanho 1) ou
+milhares de uma vez (potential_batch).
+
+A versão do modelo (nome + hash da configuração) entra nas chaves de cache e na
+calculationMatrix, então mudar pesos invalida as análises antigas e é possível
+repontuar com qualquer modelo ainda configurado.
+
+A fórmula `percentile` normaliza pela posição do território entre territórios
+de referência (score_distributions), nacionais ou da UF predominante dele;
+modelos que a usam incluem a versão das distribuições na sua.
+"""
+import json
+import os
+
+import numpy as np
+
+from dataset_engine import content_hash
+
+SCORING_MODELS_FILE = os.path.join('data', 'scoring_models.json')
+
+# Grandezas brutas de um território disponíveis para as fórmulas (as de PotentialFeatures.raw_from_sums)
+RAW_INPUTS = ('municipios', 'diversity', 'crops_total', 'avg_productivity', 'receita', 'despesa',
+              'fertilizers_usage', 'consultoria_usage', 'agrotoxicos_usage')
+
+
+def ratio(raw, spec):
+    """min(valor / normalizer, 1), sem valores negativos"""
+    return np.clip(raw[spec['input']] / spec['normalizer'], 0, 1.0)
+
+
+def margin(raw, spec):
+    """Saldo positivo (receita - custo) como fração da receita; 0 sem movimento financeiro"""
+    revenue, cost = raw[spec['revenue']], raw[spec['cost']]
+    return np.where((revenue > 0) | (cost > 0),
+                    np.minimum(np.maximum(0, revenue - cost) / np.maximum(revenue, 1), 1.0), 0)
+
+
+def weighted(raw, spec):
+    """Soma ponderada de valores divididos por normalizer (pesos dos termos somam 1)"""
+    total = 0
+    for term in spec['terms'].values():
+        total = total + (raw[term['input']] / spec['normalizer']) * term['weight']
+    return total
+
+
+def percentile(raw, spec, distributions):
+    """Fração dos territórios de referência com valor menor (reference: 'national' ou 'state')"""
+    states = raw.get('state') if spec.get('reference') == 'state' else None
+    return distributions.percentile(spec['input'], raw[spec['input']], states)
+
+
+FORMULAS = {'ratio': ratio, 'margin': margin, 'weighted': weighted}
+REFERENCES = ('national', 'state')
+
+
+def spec_inputs(spec):
+    if spec['formula'] == 'margin':
+        return [spec['revenue'], spec['cost']]
+    if spec['formula'] == 'weighted':
+        return [term['input'] for term in spec['terms'].values()]
+    return [spec['input']]
+
+
+def validate_spec(model_name, key, spec, distributions=None):
+    formula = spec.get('formula')
+    if formula == 'percentile':
+        if distributions is None:
+            raise ValueError(f'Modelo {model_name}: {key} usa percentil sem distribuições de referência')
+        if spec.get('reference', 'national') not in REFERENCES:
+            raise ValueError(f"Modelo {model_name}: referência desconhecida em {key}: {spec.get('reference')}")
+    elif formula not in FORMULAS:
+        raise ValueError(f'Modelo {model_name}: fórmula desconhecida em {key}: {formula}')
+    try:
+        inputs = spec_inputs(spec)
+    except KeyError as e:
+        raise ValueError(f'Modelo {model_name}: {key} sem o campo {e}')
+    unknown = [name for name in inputs if name not in RAW_INPUTS]
+    if unknown:
+        raise ValueError(f'Modelo {model_name}: entradas desconhecidas em {key}: {unknown}')
+    if formula in ('ratio', 'weighted') and not spec.get('normalizer', 0) > 0:
+        raise ValueError(f'Modelo {model_name}: normalizer de {key} deve ser positivo')
+    if not spec.get('max_points', 0) > 0:
+        raise ValueError(f'Modelo {model_name}: max_points de {key} deve ser positivo')
+
+
+class ScoringModel:
+    """Modelo compilado: avaliação vetorizada e matriz de cálculo de um território"""
+
+    def __init__(self, name, config, distributions=None):
+        self.name = name
+        self.config = config
+        self.description = config.get('description', '')
+        self.cap = config.get('cap', 100)
+        self.components = list(config.get('components', {}).items())
+        self.bonuses = list(config.get('bonuses', {}).items())
+        if not self.components:
+            raise ValueError(f'Modelo {name} sem componentes')
+        for key, spec in self.components + self.bonuses:
+            validate_spec(name, key, spec, distributions)
+        uses_percentiles = any(spec['formula'] == 'percentile' for _, spec in self.components + self.bonuses)
+        self.distributions = distributions if uses_percentiles else None
+        fingerprint = json.dumps(config, sort_keys=True)
+        if self.distributions is not None:
+            fingerprint += self.distributions.version
+        self.version = f'{name}:{content_hash(fingerprint)[:8]}'
+        self.total_points = sum(spec['max_points'] for _, spec in self.components)
+
+    @property
+    def component_names(self):
+        """Componentes e bônus, na ordem da configuração (chaves do breakdown)"""
+        return [key for key, _ in self.components + self.bonuses]
+
+    def evaluate(self, raw):
+        """Pontos de cada componente/bônus, normalizados, base_score e final_score (arrays, um por território)"""
+        state = raw.get('state')
+        raw = {name: np.asarray(raw[name], dtype=np.float64) for name in RAW_INPUTS if name in raw}
+        if state is not None:
+            raw['state'] = np.asarray(state, dtype=np.int64)
+        scores = {'normalized': {}}
+        base_score = 0
+        for key, spec in self.components:
+            scores['normalized'][key] = self.normalize(spec, raw)
+            scores[key] = scores['normalized'][key] * spec['max_points']
+            base_score = base_score + scores[key]
+        bonus = 0
+        for key, spec in self.bonuses:
+            scores['normalized'][key] = self.normalize(spec, raw)
+            scores[key] = scores['normalized'][key] * spec['max_points']
+            bonus = bonus + scores[key]
+        scores['base_score'] = base_score
+        scores['final_score'] = np.minimum(base_score + bonus, self.cap)
+        return scores
+
+    def normalize(self, spec, raw):
+        """Valor normalizado (0..1) de um componente para cada território"""
+        if spec['formula'] == 'percentile':
+            return percentile(raw, spec, self.distributions)
+        return FORMULAS[spec['formula']](raw, spec)
+
+    def details(self, spec, raw):
+        """Valores brutos de um componente como aparecem na calculationMatrix"""
+        if spec['formula'] == 'percentile':
+            state = raw.get('state', -1) if spec.get('reference') == 'state' else -1
+            return {'raw_value': raw[spec['input']], 'reference': self.distributions.state_label(state)}
+        if spec['formula'] == 'margin':
+            revenue, cost = raw[spec['revenue']], raw[spec['cost']]
+            return {'raw_value': revenue - cost, spec['revenue']: revenue, spec['cost']: cost}
+        if spec['formula'] == 'weighted':
+            return {
+                'raw_values': {alias: raw[term['input']] for alias, term in spec['terms'].items()},
+                'subscores': {alias: (raw[term['input']] / spec['normalizer']) * term['weight']
+                              for alias, term in spec['terms'].items()}
+            }
+        return {'raw_value': raw[spec['input']]}
+
+    def calculation_matrix(self, raw):
+        """calculationMatrix de um território (raw com valores escalares) e a pontuação final"""
+        scores = self.evaluate({name: [value] for name, value in raw.items()})
+        matrix = {}
+        for key, spec in self.components:
+            entry = self.details(spec, raw)
+            entry.update({
+                'normalized': float(scores['normalized'][key][0]),
+                'weight': spec['max_points'] / self.total_points,
+                'max_points': spec['max_points'],
+                'score': float(scores[key][0])
+            })
+            if spec['formula'] == 'percentile':
+                entry['percentile'] = entry['normalized'] * 100
+            entry['description'] = spec.get('description', '').format(**entry, **entry.get('raw_values', {}))
+            matrix[key] = entry
+        for key, spec in self.bonuses:
+            entry = self.details(spec, raw)
+            entry.update({
+                'normalized': float(scores['normalized'][key][0]),
+                'max_points': spec['max_points'],
+                'bonus_points': float(scores[key][0])
+            })
+            if spec['formula'] == 'percentile':
+                entry['percentile'] = entry['normalized'] * 100
+            entry['description'] = spec.get('description', '').format(**entry, **entry.get('raw_values', {}))
+            matrix[key] = entry
+
+        final_score = float(scores['final_score'][0])
+        matrix['summary'] = {
+            'base_score': float(scores['base_score'][0]),
+            **{key: float(scores[key][0]) for key, _ in self.bonuses},
+            'final_score': final_score,
+            'breakdown': {key: float(scores[key][0]) for key, _ in self.components}
+        }
+        matrix['model'] = {'name': self.name, 'version': self.version, 'description': self.description}
+        return matrix, final_score
+
+    def labels(self):
+        return {key: spec.get('label', key) for key, spec in self.components + self.bonuses}
+
+
+class ScoringModels:
+    """Modelos configurados e o ativo (SCORING_MODEL no ambiente ou 'active' do arquivo)"""
+
+    def __init__(self, path=SCORING_MODELS_FILE, active=None, distributions=None):
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        self.path = path
+        self.distributions = distributions
+        self.models = {name: ScoringModel(name, model, distributions) for name, model in config.get('models', {}).items()}
+        self.active_name = active or config.get('active')
+        if self.active_name not in self.models:
+            raise ValueError(f'Modelo de pontuação ativo desconhecido: {self.active_name}')
+
+    @property
+    def active(self):
+        return self.models[self.active_name]
+
+    def get(self, name=None):
+        """Modelo pelo nome (o ativo se None); KeyError se não existe"""
+        if not name:
+            return self.active
+        if name not in self.models:
+            raise KeyError(f'Modelo de pontuação {name} não encontrado')
+        return self.models[name]
+
+    def describe(self):
+        return [{
+            'name': model.name,
+            'version': model.version,
+            'description': model.description,
+            'active': name == self.active_name,
+            'cap': model.cap,
+            'components': {key: spec['max_points'] for key, spec in model.components},
+            'bonuses': {key: spec['max_points'] for key, spec in model.bonuses},
+            'formulas': {key: spec['formula'] + (f":{spec.get('reference', 'national')}"
+                                                 if spec['formula'] == 'percentile' else '')
+                         for key, spec in model.components + model.bonuses}
+        } for name, model in self.models.items()]
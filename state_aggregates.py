@@ -0,0 +1,63 @@
+"""
+Agregação de qualquer fonte/categoria por UF ou por região (bincount sobre o índice de grupos)
+
+Soma, contagem, máximo e média de todos os grupos saem de uma passada vetorizada
+sobre os municípios válidos da categoria (os mesmos dos rankings). Resultados
+ficam em cache por versão do dataset.
+"""
+import threading
+
+import numpy as np
+
+LEVELS = ('state', 'region')
+
+
+class StateAggregator:
+    """Totais por UF/região de cada (fonte, categoria), com cache por versão"""
+
+    def __init__(self, engine, rankings):
+        self.engine = engine
+        self.rankings = rankings
+        registry = engine.index
+        self.groups = {}
+        for level, labels in (('state', registry.states), ('region', registry.regions)):
+            names, ids = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+            self.groups[level] = (names.tolist(), ids.astype(np.int32))
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def aggregate(self, source, category, level='state'):
+        """{grupo: {total, count, max, average}} apenas para grupos com municípios na categoria"""
+        dataset = self.engine[source]
+        key = (source, dataset.version, category, level)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        result = self._compute(dataset, source, category, level)
+        with self.lock:
+            self.cache[key] = result
+        return result
+
+    def _compute(self, dataset, source, category, level):
+        names, group_ids = self.groups[level]
+        positions = self.rankings.ordered(source, category)
+        values = dataset.values[positions, dataset.category_index[category]]
+        ids = group_ids[positions]
+
+        totals = np.bincount(ids, weights=values, minlength=len(names))
+        counts = np.bincount(ids, minlength=len(names))
+        maxima = np.full(len(names), -np.inf)
+        np.maximum.at(maxima, ids, values)
+
+        as_number = lambda value: dataset.as_number(value, [category])
+        # Municípios sem UF/região no cadastro ficam no grupo 'XX'
+        return {
+            names[g] or 'XX': {
+                'total': as_number(totals[g]),
+                'count': int(counts[g]),
+                'max': as_number(maxima[g]),
+                'average': float(totals[g] / counts[g])
+            }
+            for g in np.flatnonzero(counts).tolist()
+        }
@@ -16,6 +16,67 @@ let baseLayers = {};
 let currentBaseLayer = 'osm';
 let mapOpacity = 1.0;
 
+// Cadastro de municípios (nome/UF por código), baixado uma vez e reutilizado por todas as camadas
+let municipalityRegistryPromise = null;
+
+function getMunicipalityRegistry() {
+    if (!municipalityRegistryPromise) {
+        municipalityRegistryPromise = fetch('/api/municipios/registry')
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.error);
+                }
+                const byCode = {};
+                data.codes.forEach((code, i) => {
+                    byCode[code] = { name: data.names[i], state: data.states[i] };
+                });
+                return { version: data.version, byCode: byCode };
+            })
+            .catch(error => {
+                municipalityRegistryPromise = null;
+                throw error;
+            });
+    }
+    return municipalityRegistryPromise;
+}
+
+// Busca uma camada no formato colunar (?format=columnar) e remonta {código: registro}
+// com os nomes do cadastro, no mesmo formato dos endpoints sem ?format
+async function fetchColumnarLayer(url, valueField) {
+    const separator = url.includes('?') ? '&' : '?';
+    const [response, registry] = await Promise.all([
+        fetch(`${url}${separator}format=columnar`),
+        getMunicipalityRegistry()
+    ]);
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+    }
+    const data = await response.json();
+    if (!data.success) {
+        return data;
+    }
+
+    const layer = data.data;
+    return Object.assign({}, data, {
+        data: columnarToRecords(layer.codes, layer.values, layer.unit, valueField, registry)
+    });
+}
+
+function columnarToRecords(codes, values, unit, valueField, registry) {
+    const records = {};
+    codes.forEach((code, i) => {
+        const municipality = registry.byCode[code] || { name: '', state: '' };
+        const record = { municipality_name: municipality.name, state_code: municipality.state };
+        record[valueField] = values[i];
+        if (unit !== null && unit !== undefined) {
+            record.unit = unit;
+        }
+        records[code] = record;
+    });
+    return records;
+}
+
 function initializeMap() {
     // Initialize map centered on Brazil
     map = L.map('map', {
@@ -572,13 +633,7 @@ function loadCropLayer(cropName) {
     }
 
     // Fetch crop data
-    fetch(`/api/crop-data/${encodeURIComponent(cropName)}`)
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP ${response.status}: ${response.statusText}`);
-            }
-            return response.json();
-        })
+    fetchColumnarLayer(`/api/crop-data/${encodeURIComponent(cropName)}`, 'harvested_area')
         .then(data => {
             if (data.success) {
                 currentCropData = data.data;
@@ -2916,28 +2971,10 @@ async function loadReceitasLayerForLayer(layer) {
                 console.log(`Loading receitas layer for layer: ${layer.name}`);
 
                 // Fetch data from the API endpoint for receitas
-                const response = await fetch(`/api/receita/${encodeURIComponent(layer.category)}`);
-                const data = await response.json();
+                const data = await fetchColumnarLayer(`/api/receita/${encodeURIComponent(layer.category)}`, 'value');
 
                 if (data.success) {
-                    const receitasData = data.data;
-                    layer.data = receitasData; // Store the fetched data in the layer object
-                    layer.dataColumn = 'value'; // Assuming 'value' is the data column for receitas
-
-                    // Calculate min/max values for the legend scale
-                    const values = Object.values(receitasData)
-                        .map(item => item.value || item.harvested_area || 0) // Use 'value' or 'harvested_area'
-                        .filter(value => value > 0); // Filter out zero or negative values
-
-                    let minMax = { min: 0, max: 1000 }; // Default min/max
-                    if (values.length > 0) {
-                        minMax.min = Math.min(...values);
-                        minMax.max = Math.max(...values);
-                    }
-
-                    layer.minMax = minMax; // Store calculated min/max
-                    await loadMunicipalityBoundariesForGenericLayer(layer, receitasData, minMax); // Load GeoJSON and create layer
-                    showAnalyticsCard(layer); // Display analytics card for the layer
+                    await showReceitasLayerData(layer, data.data);
                 } else {
                     console.error('Error loading receitas data:', data.error);
                     alert('Erro ao carregar dados de receitas: ' + data.error);
@@ -2948,6 +2985,94 @@ async function loadReceitasLayerForLayer(layer) {
             }
         }
 
+// Store receitas data in the layer, compute the legend scale and draw it
+async function showReceitasLayerData(layer, receitasData) {
+    layer.data = receitasData; // Store the fetched data in the layer object
+    layer.dataColumn = 'value'; // Assuming 'value' is the data column for receitas
+
+    // Calculate min/max values for the legend scale
+    const values = Object.values(receitasData)
+        .map(item => item.value || item.harvested_area || 0) // Use 'value' or 'harvested_area'
+        .filter(value => value > 0); // Filter out zero or negative values
+
+    let minMax = { min: 0, max: 1000 }; // Default min/max
+    if (values.length > 0) {
+        minMax.min = Math.min(...values);
+        minMax.max = Math.max(...values);
+    }
+
+    layer.minMax = minMax; // Store calculated min/max
+    await loadMunicipalityBoundariesForGenericLayer(layer, receitasData, minMax); // Load GeoJSON and create layer
+    showAnalyticsCard(layer); // Display analytics card for the layer
+}
+
+// Store revenda territory data in the layer and draw it
+async function showRevendasLayerData(layer, revendasData) {
+    layer.data = revendasData; // Store the loaded data
+    layer.dataColumn = 'value'; // Use 'value' column for revendas, set to 1 for territory visualization
+
+    // For revendas, use a fixed min/max for coloring (all territories are visually the same)
+    const minMax = { min: 1, max: 1 };
+    layer.minMax = minMax;
+
+    await loadMunicipalityBoundariesForRevendasLayer(layer, revendasData, minMax); // Load GeoJSON and create revenda layer
+    showAnalyticsCard(layer); // Display analytics card
+}
+
+// Load several receitas/revendas layers with a single /api/layers request (e.g. restoring a dashboard)
+async function loadLayersBatch(layers) {
+    const params = new URLSearchParams({ format: 'columnar' });
+    layers.forEach(layer => {
+        if (layer.type === 'receitas') {
+            params.append('layer', `receita/${layer.category}`);
+        } else if (layer.type === 'revendas') {
+            params.append('territory', layer.revendaId);
+        }
+    });
+
+    try {
+        const [response, registry] = await Promise.all([
+            fetch(`/api/layers?${params.toString()}`),
+            getMunicipalityRegistry()
+        ]);
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+        }
+        const data = await response.json();
+        if (!data.success) {
+            throw new Error(data.error || 'Erro ao carregar camadas');
+        }
+
+        const receitasLayers = layers.filter(layer => layer.type === 'receitas');
+        const revendasLayers = layers.filter(layer => layer.type === 'revendas');
+        const codesAt = index => index.map(i => data.codes[i]);
+
+        for (let i = 0; i < receitasLayers.length; i++) {
+            const entry = data.layers[i];
+            if (entry.error) {
+                console.error('Error loading receitas data:', entry.error);
+                continue;
+            }
+            await showReceitasLayerData(receitasLayers[i],
+                columnarToRecords(codesAt(entry.index), entry.values, entry.unit, 'value', registry));
+        }
+
+        for (let i = 0; i < revendasLayers.length; i++) {
+            const entry = data.territories[i];
+            if (entry.error) {
+                console.error('Error loading revenda layer:', entry.error);
+                continue;
+            }
+            const codes = codesAt(entry.index);
+            await showRevendasLayerData(revendasLayers[i],
+                columnarToRecords(codes, codes.map(() => 1), 'território', 'value', registry));
+        }
+    } catch (error) {
+        console.error('Error loading layers batch:', error);
+        alert('Erro ao carregar camadas: ' + error.message);
+    }
+}
+
         // Handler for loading "revendas" layers
         async function loadRevendasLayerForLayer(layer) {
             try {
@@ -2967,15 +3092,7 @@ async function loadReceitasLayerForLayer(layer) {
                 const revendasData = data.data; // The actual territory data for the revenda
                 console.log('Revenda data loaded:', revendasData);
 
-                layer.data = revendasData; // Store the loaded data
-                layer.dataColumn = 'value'; // Use 'value' column for revendas, set to 1 for territory visualization
-
-                // For revendas, use a fixed min/max for coloring (all territories are visually the same)
-                const minMax = { min: 1, max: 1 };
-                layer.minMax = minMax;
-
-                await loadMunicipalityBoundariesForRevendasLayer(layer, revendasData, minMax); // Load GeoJSON and create revenda layer
-                showAnalyticsCard(layer); // Display analytics card
+                await showRevendasLayerData(layer, revendasData);
             } catch (error) {
                 console.error('Error loading revenda layer:', error);
                 alert('Erro ao carregar dados de revendas: ' + error.message);
@@ -2990,6 +3107,7 @@ if (!window.activeLayers) {
 // Export utility functions for global access
 window.loadMunicipalityBoundariesForGenericLayer = loadMunicipalityBoundariesForGenericLayer;
 window.loadLayerByType = loadLayerByType;
+window.loadLayersBatch = loadLayersBatch;
 
 // Add function to close revenda panel
 function closeRevendasPanel() {
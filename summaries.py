@@ -0,0 +1,83 @@
+"""
+Resumos estatísticos vetorizados por (fonte, categoria) e por UF
+
+Os valores vêm já ordenados dos rankings, então mediana, quartis e decis são só
+interpolações sobre posições do array. Os quantis seguem o método 'exclusive' de
+statistics.quantiles (o usado antes no endpoint de culturas). Cada resumo é
+calculado uma vez por versão do dataset e guardado.
+"""
+import threading
+
+import numpy as np
+
+
+def exclusive_quantiles(ascending, n):
+    """Mesmos pontos de corte de statistics.quantiles(data, n=n) (método 'exclusive') sobre dados já ordenados"""
+    ld = len(ascending)
+    m = ld + 1
+    i = np.arange(1, n)
+    j = np.clip(i * m // n, 1, ld - 1)
+    delta = i * m - j * n
+    return ((ascending[j - 1] * (n - delta) + ascending[j] * delta) / n).tolist()
+
+
+def first_mode(values, positions):
+    """Valor mais frequente (empate: o que aparece primeiro na ordem do cadastro); None se não há repetição"""
+    unique, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    if len(unique) == len(values):
+        return None
+    first_position = np.full(len(unique), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_position, inverse, positions)
+    candidates = np.flatnonzero(counts == counts.max())
+    return unique[candidates[np.argmin(first_position[candidates])]]
+
+
+class StatisticalSummaries:
+    """Resumos (contagem, soma, média, mediana, quartis, decis, desvio padrão, mín/máx) com cache por versão"""
+
+    def __init__(self, engine, rankings):
+        self.engine = engine
+        self.rankings = rankings
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def summary(self, source, category, state=None):
+        """Resumo dos municípios válidos da categoria (nacional ou de uma UF); None se não há municípios"""
+        dataset = self.engine[source]
+        key = (source, dataset.version, category, state)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        result = self._compute(dataset, source, category, state)
+        with self.lock:
+            self.cache[key] = result
+        return result
+
+    def _compute(self, dataset, source, category, state):
+        positions = self.rankings.ordered(source, category, state)
+        count = len(positions)
+        if not count:
+            return None
+
+        j = dataset.category_index[category]
+        values = dataset.values[positions, j]
+        ascending = values[::-1]
+        as_number = lambda value: dataset.as_number(value, [category])
+        mode = first_mode(values, positions)
+
+        quartiles = exclusive_quantiles(ascending, 4) if count >= 2 else None
+        return {
+            'count': count,
+            'total': as_number(values.sum()),
+            'mean': float(values.mean()),
+            'median': float(np.median(ascending)),
+            'mode': as_number(mode) if mode is not None else None,
+            'std_dev': float(values.std(ddof=1)) if count > 1 else 0,
+            'min': as_number(ascending[0]),
+            'max': as_number(ascending[-1]),
+            'q1': quartiles[0] if count >= 4 else None,
+            'q3': quartiles[2] if count >= 4 else None,
+            'quartiles': quartiles,
+            'deciles': exclusive_quantiles(ascending, 10) if count >= 2 else None
+        }
@@ -0,0 +1,423 @@
+"""
+Análise de território em uma única passada sobre as matrizes
+
+Os códigos do território são convertidos em posições do cadastro uma única vez e
+cada fonte é lida com um único gather da submatriz (municípios do território ×
+categorias). Todos os agregados usados pela análise de potencial e pela análise
+comercial em Excel (totais, diversidade, cobertura, financeiro por município)
+saem desses arrays.
+
+TerritoryAggregates mantém os mesmos agregados como somas e contagens
+corrente, atualizadas por delta a cada município incluído ou removido: a edição
+de um território custa O(categorias) em vez de refazer a análise inteira.
+
+TerritoryAnalysisCache guarda os resultados por conjunto de municípios (códigos
+ordenados), versão dos dados e versão dos pesos de pontuação.
+"""
+import copy
+import secrets
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from dataset_engine import content_hash
+
+# Categorias que são totalizações, não categorias de fato
+TOTAL_CATEGORIES = ('Total Estabelecimentos', 'Total estabelecimentos', 'TOTAL')
+
+# Marca de "primeiro município positivo" a recalcular após remoção
+STALE = -2
+
+
+def first_hit_sums(values):
+    """Soma de cada coluna até a primeira linha com valor positivo (inclusive), regra herdada dos loops originais com break"""
+    positive = values > 0
+    has_positive = positive.any(axis=0)
+    stop = np.where(has_positive, positive.argmax(axis=0), len(values) - 1)
+    counted = np.arange(len(values))[:, None] <= stop[None, :]
+    return (values * counted).sum(axis=0)
+
+
+class SourceProfile:
+    """Agregados por categoria de uma fonte sobre as posições do território"""
+
+    def __init__(self, dataset, positions):
+        self.dataset = dataset
+        self.empty = len(positions) == 0
+        n_categories = len(dataset.categories)
+        if self.empty:
+            self.totals = np.zeros(n_categories)
+            self.counts = np.zeros(n_categories, dtype=np.int64)
+            self.has_positive = np.zeros(n_categories, dtype=bool)
+            self.first_hit = np.zeros(n_categories)
+            return
+
+        values = dataset.values[positions]
+        self.totals = values.sum(axis=0)
+        self.counts = dataset.present[positions].sum(axis=0)
+        self.has_positive = (values > 0).any(axis=0)
+        self.first_hit = first_hit_sums(values)
+
+    def columns(self, excluded_categories=()):
+        return [j for j, category in enumerate(self.dataset.categories) if category not in excluded_categories]
+
+    def total(self):
+        """Soma de todas as categorias"""
+        return self.dataset.as_number(self.totals.sum())
+
+    def first_hit_totals(self, excluded_categories=()):
+        """(soma até o primeiro valor positivo de cada categoria, nº de categorias com algum valor positivo)"""
+        columns = self.columns(excluded_categories)
+        if self.empty or not columns:
+            return 0, 0
+        categories = [self.dataset.categories[j] for j in columns]
+        return self.dataset.as_number(self.first_hit[columns].sum(), categories), int(self.has_positive[columns].sum())
+
+    def category_totals(self, excluded_categories=TOTAL_CATEGORIES):
+        """[{'name', 'total'}] das categorias com total positivo, em ordem decrescente"""
+        categories = []
+        for j in self.columns(excluded_categories):
+            if self.totals[j] > 0:
+                category = self.dataset.categories[j]
+                categories.append({'name': category, 'total': self.dataset.as_number(self.totals[j], [category])})
+        return sorted(categories, key=lambda x: x['total'], reverse=True)
+
+
+class TerritoryProfile:
+    """Todas as fontes agregadas sobre um território (lista de códigos IBGE, com repetições e códigos desconhecidos)"""
+
+    def __init__(self, engine, municipios_codes):
+        self.engine = engine
+        self.codes = list(municipios_codes)
+        self.all_positions = engine.index.resolve(self.codes)
+        self.known = self.all_positions >= 0
+        self.positions = self.all_positions[self.known]
+        self.n_codes = len(self.codes)
+        self.sources = {source: SourceProfile(dataset, self.positions) for source, dataset in engine.sources.items()}
+
+    def __getitem__(self, source):
+        return self.sources[source]
+
+    def share(self, count):
+        """Percentual sobre o número de códigos informados (limitado a 100)"""
+        return min((count / max(self.n_codes, 1)) * 100, 100)
+
+    def crops_summary(self):
+        """Diversidade, produtividade média, área total e 5 principais culturas"""
+        crops = self.sources['crops']
+        dataset = crops.dataset
+        total_hectares = crops.total()
+        top_crops = [{'name': crop_name, 'value': dataset.as_number(crops.totals[j], [crop_name])}
+                     for j, crop_name in enumerate(dataset.categories) if crops.totals[j] > 0]
+        top_crops.sort(key=lambda x: x['value'], reverse=True)
+        return {
+            'diversity': int(crops.has_positive.sum()),
+            'avg_productivity': total_hectares / max(self.n_codes, 1),
+            'total_value': total_hectares,
+            'top_crops': top_crops[:5]
+        }
+
+    def crop_totals(self):
+        """[{'name', 'total_area', 'municipalities_count'}] de todas as culturas com área, em ordem decrescente"""
+        crops = self.sources['crops']
+        dataset = crops.dataset
+        crop_totals = [{
+            'name': crop_name,
+            'total_area': dataset.as_number(crops.totals[j], [crop_name]),
+            'municipalities_count': int(crops.counts[j])
+        } for j, crop_name in enumerate(dataset.categories) if crops.totals[j] > 0]
+        return sorted(crop_totals, key=lambda x: x['total_area'], reverse=True)
+
+    def _total_column(self, dataset):
+        """(tem 'Total', valor de 'Total' ou 0) por código informado, na ordem e com repetições"""
+        if 'Total' not in dataset:
+            return [False] * len(self.codes), [0] * len(self.codes)
+        safe_positions = np.where(self.known, self.all_positions, 0)
+        has_total = self.known & dataset.present[safe_positions, dataset.category_index['Total']]
+        values = dataset.python_values('Total', safe_positions)
+        has_total = has_total.tolist()
+        return has_total, [value if has else 0 for value, has in zip(values, has_total)]
+
+    def financial_municipalities(self):
+        """Receita/despesa ('Total') de cada código informado com algum valor, na ordem recebida"""
+        receitas = self.engine['receita']
+        despesas = self.engine['despesa']
+        has_receita, receita_values = self._total_column(receitas)
+        has_despesa, despesa_values = self._total_column(despesas)
+
+        municipios = []
+        for i, municipio_code in enumerate(self.codes):
+            receita = receita_values[i]
+            despesa = despesa_values[i]
+            if receita > 0 or despesa > 0:
+                position = self.all_positions[i] if self.known[i] else 0
+                municipio_name = receitas.names[position] if has_receita[i] else ''
+                municipio_state = receitas.states[position] if has_receita[i] else ''
+                if not municipio_name and has_despesa[i]:
+                    municipio_name = despesas.names[position]
+                    municipio_state = despesas.states[position]
+
+                municipios.append({
+                    'code': municipio_code,
+                    'name': municipio_name,
+                    'state': municipio_state,
+                    'receita': receita,
+                    'despesa': despesa,
+                    'saldo': receita - despesa
+                })
+        return municipios
+
+
+def first_positive_rows(rows, values):
+    """Primeira linha (de rows) com valor positivo em cada coluna de values; -1 se nenhuma"""
+    if not len(rows):
+        return np.full(values.shape[1], -1, dtype=np.int64)
+    positive = values > 0
+    return np.where(positive.any(axis=0), rows[positive.argmax(axis=0)], -1)
+
+
+class RunningSource(SourceProfile):
+    """Agregados de uma fonte mantidos por deltas de um município por vez (mesma interface de SourceProfile)"""
+
+    def __init__(self, dataset, territory):
+        self.dataset = dataset
+        self.territory = territory
+        # Colunas com valores negativos: o trecho antes do primeiro positivo pode não somar zero
+        self.signed = np.flatnonzero((dataset.values < 0).any(axis=0))
+        self.rebuild()
+
+    @property
+    def empty(self):
+        return self.territory.n_positions == 0
+
+    @property
+    def has_positive(self):
+        return self.positive_counts > 0
+
+    def rebuild(self):
+        """Recalcula os agregados a partir da multiplicidade de cada município no território"""
+        multiplicity = self.territory.multiplicity
+        members = np.flatnonzero(multiplicity)
+        weights = multiplicity[members]
+        values = self.dataset.values[members]
+        # Soma na mesma ordem do TerritoryProfile (posições ordenadas, com repetições)
+        self.totals = self.dataset.values[np.repeat(members, weights)].sum(axis=0)
+        self.counts = weights @ self.dataset.present[members].astype(np.int64)
+        self.positive_counts = weights @ (values > 0).astype(np.int64)
+        self.nonzero_counts = weights @ (values != 0).astype(np.int64)
+        self.first_positive = first_positive_rows(members, values)
+
+    def apply(self, position, delta):
+        """Soma (delta=1) ou subtrai (delta=-1) a linha de um município; multiplicidade já atualizada"""
+        row = self.dataset.values[position]
+        positive = row > 0
+        self.totals += delta * row
+        self.counts += delta * self.dataset.present[position]
+        self.positive_counts += delta * positive
+        self.nonzero_counts += delta * (row != 0)
+        # Categoria sem nenhum valor não nulo soma exatamente zero (sem resíduo de arredondamento)
+        self.totals[self.nonzero_counts == 0] = 0
+        if delta > 0:
+            earlier = positive & (self.first_positive != STALE) & \
+                ((self.first_positive < 0) | (position < self.first_positive))
+            self.first_positive[earlier] = position
+        elif self.territory.multiplicity[position] == 0:
+            # Só as categorias em que ele era o primeiro positivo precisam de nova busca
+            self.first_positive[self.first_positive == position] = STALE
+
+    @property
+    def first_hit(self):
+        """Mesma regra de first_hit_sums na ordem canônica (posições do cadastro, com repetições)"""
+        multiplicity = self.territory.multiplicity
+        stale = np.flatnonzero(self.first_positive == STALE)
+        if len(stale):
+            members = np.flatnonzero(multiplicity)
+            self.first_positive[stale] = first_positive_rows(members, self.dataset.values[np.ix_(members, stale)])
+
+        # Sem valores negativos, tudo antes do primeiro positivo é zero
+        columns = np.arange(len(self.first_positive))
+        first_hit = np.where(self.first_positive >= 0,
+                             self.dataset.values[np.maximum(self.first_positive, 0), columns], self.totals)
+        if len(self.signed) and not self.empty:
+            members = np.flatnonzero(multiplicity)
+            expanded = np.repeat(members, multiplicity[members])
+            first_hit[self.signed] = first_hit_sums(self.dataset.values[np.ix_(expanded, self.signed)])
+        return first_hit
+
+
+class TerritoryAggregates(TerritoryProfile):
+    """Território editável: agregados atualizados por delta a cada município incluído ou removido
+
+    A ordem de referência é a canônica do TerritoryAnalysisCache (códigos ordenados), que
+    coincide com a ordem das posições no cadastro; os resultados são os mesmos de um
+    TerritoryProfile montado com os códigos ordenados.
+    """
+
+    # Edições entre ressincronizações (descartam o erro acumulado das somas em ponto flutuante)
+    RESYNC_EDITS = 1024
+
+    def __init__(self, engine, municipios_codes=()):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.code_counts = Counter(str(code) for code in municipios_codes)
+        self.n_codes = sum(self.code_counts.values())
+        positions = engine.resolve(list(self.code_counts.elements()))
+        self.multiplicity = np.zeros(len(engine.index), dtype=np.int64)
+        np.add.at(self.multiplicity, positions, 1)
+        self.n_positions = len(positions)
+        self.edits = 0
+        self.sources = {source: RunningSource(dataset, self) for source, dataset in engine.sources.items()}
+
+    @property
+    def codes(self):
+        """Códigos do território em ordem canônica, com repetições"""
+        return sorted(self.code_counts.elements())
+
+    def add(self, code):
+        """Inclui um município (repetições contam, como na lista original)"""
+        code = str(code)
+        self.code_counts[code] += 1
+        self.n_codes += 1
+        self._apply(self.engine.index.position(code), 1)
+
+    def remove(self, code):
+        """Remove uma ocorrência do município; False se ele não está no território"""
+        code = str(code)
+        if not self.code_counts[code]:
+            return False
+        self.code_counts[code] -= 1
+        if not self.code_counts[code]:
+            del self.code_counts[code]
+        self.n_codes -= 1
+        self._apply(self.engine.index.position(code), -1)
+        return True
+
+    def _apply(self, position, delta):
+        if position < 0:
+            return
+        self.multiplicity[position] += delta
+        self.n_positions += delta
+        for source in self.sources.values():
+            source.apply(position, delta)
+        self.edits += 1
+        if self.edits % self.RESYNC_EDITS == 0:
+            self.resync()
+
+    def resync(self):
+        for source in self.sources.values():
+            source.rebuild()
+
+    def financial_municipalities(self):
+        # Lista por município: depende do território inteiro, não há delta a aproveitar
+        return TerritoryProfile(self.engine, self.codes).financial_municipalities()
+
+
+class TerritoryDrafts:
+    """Territórios em edição (LRU limitado), cada um com seus agregados incrementais"""
+
+    def __init__(self, engine, max_entries=64):
+        self.engine = engine
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, municipios_codes):
+        """(id, TerritoryAggregates) de um novo rascunho"""
+        draft_id = secrets.token_urlsafe(12)
+        aggregates = TerritoryAggregates(self.engine, municipios_codes)
+        with self.lock:
+            self.entries[draft_id] = aggregates
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return draft_id, aggregates
+
+    def get(self, draft_id):
+        """Agregados do rascunho (None se não existe ou já foi descartado)"""
+        with self.lock:
+            aggregates = self.entries.get(draft_id)
+            if aggregates is not None:
+                self.entries.move_to_end(draft_id)
+            return aggregates
+
+    def discard(self, draft_id):
+        with self.lock:
+            return self.entries.pop(draft_id, None) is not None
+
+
+class TerritoryAnalysisCache:
+    """LRU de análises de território com contadores e invalidação por dono (revenda/vendedor)"""
+
+    def __init__(self, engine, max_entries=256):
+        self.max_entries = max_entries
+        self.data_version = content_hash(*[dataset.version for dataset in engine.sources.values()])
+        self.entries = OrderedDict()
+        self.owners = {}        # dono -> chaves em cache dos territórios dele
+        self.key_owners = {}    # chave -> donos (o mesmo território pode ser de vários)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def key(self, kind, municipios_codes, weights_version=''):
+        """Chave canônica: o mesmo território em qualquer ordem gera a mesma chave"""
+        return kind, content_hash(sorted(str(code) for code in municipios_codes), self.data_version, weights_version)
+
+    def get(self, kind, municipios_codes, build, weights_version='', owner=None):
+        """Resultado em cache ou build(códigos em ordem canônica); sempre uma cópia, nunca o objeto guardado"""
+        key = self.key(kind, municipios_codes, weights_version)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self._link(owner, key)
+                self.hits += 1
+                return copy.deepcopy(self.entries[key])
+            self.misses += 1
+
+        result = build(sorted(municipios_codes, key=str))
+        with self.lock:
+            self.entries[key] = result
+            self._link(owner, key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self._unlink(evicted)
+                self.evictions += 1
+        return copy.deepcopy(result)
+
+    def _link(self, owner, key):
+        if owner is not None:
+            self.owners.setdefault(owner, set()).add(key)
+            self.key_owners.setdefault(key, set()).add(owner)
+
+    def _unlink(self, key):
+        """Tira a chave do conjunto de cada dono dela, descartando conjuntos vazios"""
+        for owner in self.key_owners.pop(key, ()):
+            keys = self.owners.get(owner)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.owners[owner]
+
+    def invalidate(self, owner):
+        """Descarta as análises dos territórios associados a uma revenda/vendedor editado"""
+        with self.lock:
+            for key in self.owners.pop(owner, ()):
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+                self._unlink(key)
+
+    def stats(self):
+        with self.lock:
+            requests_total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'owners': len(self.owners),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / requests_total if requests_total else 0,
+                'data_version': self.data_version
+            }
@@ -0,0 +1,95 @@
+"""
+Territórios como bitsets de largura fixa sobre o cadastro de municípios
+
+Cada revenda/vendedor vira uma linha de palavras uint64 (um bit por posição do
+cadastro), montada uma vez e reaproveitada enquanto a lista de códigos não muda.
+Interseções são ANDs de palavras e contagens são popcounts, então a matriz de
+sobreposição entre centenas de parceiros sai de operações vetorizadas.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dataset_engine import content_hash
+from potential_batch import MembershipMatrix
+
+# Limite de palavras uint64 comparadas por bloco na matriz de sobreposição
+OVERLAP_BLOCK_WORDS = 1 << 21
+
+
+class TerritoryBitsets:
+    """Bitsets dos territórios por (tipo, id), refeitos só quando a lista de códigos muda"""
+
+    def __init__(self, registry, max_entries=4096):
+        self.registry = registry
+        self.n_words = (len(registry) + 63) // 64
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def build(self, codes):
+        """Bitset (n_words uint64) dos códigos conhecidos; repetições e códigos desconhecidos não contam"""
+        positions = self.registry.resolve(codes)
+        mask = np.zeros(self.n_words * 64, dtype=bool)
+        mask[positions[positions >= 0]] = True
+        return np.packbits(mask, bitorder='little').view('<u8')
+
+    def get(self, key, codes):
+        fingerprint = content_hash(codes)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == fingerprint:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        bitset = self.build(codes)
+        with self.lock:
+            self.entries[key] = (fingerprint, bitset)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return bitset
+
+    def matrix(self, entities):
+        """Bitsets empilhados (entidades × palavras) de [{'type', 'id', 'codes'}]"""
+        if not entities:
+            return np.zeros((0, self.n_words), dtype='<u8')
+        return np.vstack([self.get((entity['type'], entity['id']), entity['codes']) for entity in entities])
+
+    def membership(self, bitsets):
+        """MembershipMatrix (CSR) de bitsets empilhados; só as palavras não nulas são expandidas em bits"""
+        rows, words = np.nonzero(bitsets)
+        bits = np.unpackbits(bitsets[rows, words].astype('<u8').view(np.uint8).reshape(-1, 8),
+                             axis=1, bitorder='little')
+        hit, bit = np.nonzero(bits)
+        counts = np.bincount(rows[hit], minlength=len(bitsets))
+        return MembershipMatrix.from_csr(np.r_[0, np.cumsum(counts)], words[hit] * 64 + bit,
+                                         (len(bitsets), len(self.registry)))
+
+
+def overlap_counts(bitsets):
+    """(municípios de cada território, municípios em comum de cada par) por popcount de ANDs"""
+    n, words = bitsets.shape
+    sizes = np.bitwise_count(bitsets).sum(axis=1, dtype=np.int64)
+    shared = np.zeros((n, n), dtype=np.int64)
+    block = max(1, OVERLAP_BLOCK_WORDS // max(n * words, 1))
+    for start in range(0, n, block):
+        chunk = bitsets[start:start + block]
+        shared[start:start + block] = np.bitwise_count(chunk[:, None, :] & bitsets[None, :, :]).sum(axis=2)
+    return sizes, shared
+
+
+def jaccard_matrix(sizes, shared):
+    """|A ∩ B| / |A ∪ B| de cada par (0 quando os dois territórios estão vazios)"""
+    union = sizes[:, None] + sizes[None, :] - shared
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, shared / np.maximum(union, 1), 0.0)
+
+
+def overlap_potential(store, features, model, bitsets, pairs):
+    """potentialScore, área de culturas e receita só dos municípios em comum de cada par (i, j)"""
+    if not len(pairs):
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    raw = features.raw_components(store.membership(bitsets[pairs[:, 0]] & bitsets[pairs[:, 1]]))
+    return model.evaluate(raw)['final_score'], raw['crops_total'], raw['receita']
@@ -0,0 +1,296 @@
+"""
+Divisão balanceada de uma área em N territórios contíguos (um por vendedor)
+
+A área (uma UF ou uma lista de municípios) vira um subgrafo do grafo de
+vizinhança. Cada tentativa reparte as N sementes entre os pedaços conexos da
+área conforme o peso de cada um, espalha as de cada pedaço (amostragem do ponto
+mais distante em saltos no grafo), cresce os territórios em paralelo dando o
+próximo município vizinho ao território mais leve e depois faz busca local:
+move municípios de fronteira entre territórios vizinhos enquanto o objetivo
+melhora e o território de origem continua conexo.
+
+Objetivo: erro quadrático médio das parcelas de cada componente (área de
+culturas, estabelecimentos com fertilizantes, receita) em relação à parcela
+justa 1/N, mais overlap_weight × nº médio de revendas distintas tocadas por
+território (conflito de canal).
+
+As tentativas usam sementes derivadas de `seed` e rodam em um pool de
+processos; com a mesma seed e o mesmo nº de tentativas o resultado é o mesmo,
+desde que a busca termine dentro do orçamento de tempo (`complete`).
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from municipality_graph import gather_neighbours
+from territory_analyzer import TOTAL_CATEGORIES
+
+# Nomes dos componentes balanceados, na ordem das colunas de pesos
+BALANCE_COMPONENTS = ('crop_area', 'fertilizer_establishments', 'receita')
+
+
+def partition_weights(engine, positions):
+    """Matriz (municípios × componentes) com área de culturas, estabelecimentos com fertilizantes e receita"""
+    fertilizers = engine['fertilizers']
+    total_columns = [fertilizers.category_index[c] for c in TOTAL_CATEGORIES if c in fertilizers.category_index]
+    if total_columns:
+        establishments = fertilizers.values[positions, total_columns[0]]
+    else:
+        establishments = fertilizers.values[positions].sum(axis=1)
+    return np.column_stack([
+        engine['crops'].values[positions].sum(axis=1),
+        establishments,
+        engine['receita'].values[positions].sum(axis=1)
+    ])
+
+
+def subgraph(graph, positions):
+    """Adjacência (CSR local, índices 0..m-1) do grafo restrita às posições informadas"""
+    local = np.full(len(graph), -1, dtype=np.int64)
+    local[positions] = np.arange(len(positions))
+    indptr, indices = [0], []
+    for position in positions.tolist():
+        neighbours = local[graph.neighbours(position)]
+        neighbours = neighbours[neighbours >= 0]
+        indices.append(neighbours)
+        indptr.append(indptr[-1] + len(neighbours))
+    return np.array(indptr, dtype=np.int64), (np.concatenate(indices) if indices else np.array([], dtype=np.int64))
+
+
+class PartitionProblem:
+    """Dados de uma divisão (só arrays, para ir aos processos do pool)"""
+
+    def __init__(self, indptr, indices, weights, revendas, n_parts, overlap_weight=0.01):
+        self.indptr = indptr
+        self.indices = indices
+        totals = weights.sum(axis=0)
+        # Componentes sem nenhum valor na área não entram no balanceamento;
+        # sem nenhum componente, balanceia o nº de municípios
+        self.columns = np.flatnonzero(totals > 0)
+        if len(self.columns):
+            self.shares = weights[:, self.columns] / totals[self.columns]
+        else:
+            self.shares = np.full((len(weights), 1), 1.0 / max(len(weights), 1))
+        self.revendas = revendas            # (municípios × revendas) bool
+        self.n_parts = n_parts
+        self.overlap_weight = overlap_weight
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def neighbours(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def hop_distances(self, sources):
+        """Nº de saltos até a fonte mais próxima (inf se inalcançável)"""
+        distance = np.full(len(self), np.inf)
+        distance[sources] = 0
+        frontier = np.asarray(sources, dtype=np.int64)
+        level = 0
+        while len(frontier):
+            level += 1
+            reached = gather_neighbours(self.indptr, self.indices, frontier)
+            frontier = np.unique(reached[np.isinf(distance[reached])])
+            distance[frontier] = level
+        return distance
+
+    def component_labels(self):
+        """Rótulo (0, 1, ...) do pedaço conexo da área de cada município"""
+        labels = np.full(len(self), -1, dtype=np.int64)
+        label = 0
+        while (labels < 0).any():
+            start = int(np.flatnonzero(labels < 0)[0])
+            labels[np.isfinite(self.hop_distances([start]))] = label
+            label += 1
+        return labels
+
+
+class PartitionState:
+    """Atribuição atual com cargas, contagens de revendas e objetivo mantidos por delta"""
+
+    def __init__(self, problem, assignment):
+        self.problem = problem
+        self.assignment = assignment
+        n_parts = problem.n_parts
+        self.loads = np.zeros((n_parts, problem.shares.shape[1]))
+        np.add.at(self.loads, assignment, problem.shares)
+        self.revenda_counts = np.zeros((n_parts, problem.revendas.shape[1]), dtype=np.int64)
+        np.add.at(self.revenda_counts, assignment, problem.revendas.astype(np.int64))
+        self.sizes = np.bincount(assignment, minlength=n_parts)
+
+    def balance_error(self, loads=None):
+        loads = self.loads if loads is None else loads
+        n_parts, columns = loads.shape
+        return float(((n_parts * loads - 1) ** 2).sum() / max(n_parts * columns, 1))
+
+    def conflicts(self):
+        return int((self.revenda_counts > 0).sum())
+
+    def objective(self):
+        return self.balance_error() + self.problem.overlap_weight * self.conflicts() / self.problem.n_parts
+
+    def move_delta(self, node, source, target):
+        """Variação do objetivo ao mover node de source para target"""
+        problem = self.problem
+        n_parts, columns = self.loads.shape
+        share = problem.shares[node]
+        before = ((n_parts * self.loads[source] - 1) ** 2).sum() + ((n_parts * self.loads[target] - 1) ** 2).sum()
+        after = ((n_parts * (self.loads[source] - share) - 1) ** 2).sum() + \
+            ((n_parts * (self.loads[target] + share) - 1) ** 2).sum()
+        balance = (after - before) / max(n_parts * columns, 1)
+
+        touched = problem.revendas[node]
+        conflict = int((self.revenda_counts[target, touched] == 0).sum()) - \
+            int((self.revenda_counts[source, touched] == 1).sum())
+        return balance + problem.overlap_weight * conflict / n_parts
+
+    def move(self, node, source, target):
+        share = self.problem.shares[node]
+        self.loads[source] -= share
+        self.loads[target] += share
+        touched = self.problem.revendas[node]
+        self.revenda_counts[source, touched] -= 1
+        self.revenda_counts[target, touched] += 1
+        self.sizes[source] -= 1
+        self.sizes[target] += 1
+        self.assignment[node] = target
+
+    def stays_connected(self, node, part):
+        """O território continua com as mesmas peças conexas sem node (vizinhos dele seguem ligados entre si)"""
+        problem = self.problem
+        inside = problem.neighbours(node)
+        inside = inside[self.assignment[inside] == part]
+        if len(inside) <= 1:
+            return True
+        seen = np.zeros(len(problem), dtype=bool)
+        seen[node] = True
+        seen[inside[0]] = True
+        frontier = inside[:1]
+        pending = set(inside[1:].tolist())
+        while len(frontier) and pending:
+            reached = gather_neighbours(problem.indptr, problem.indices, frontier)
+            reached = np.unique(reached[(self.assignment[reached] == part) & ~seen[reached]])
+            seen[reached] = True
+            pending.difference_update(reached.tolist())
+            frontier = reached
+        return not pending
+
+
+def initial_partition(problem, rng):
+    """Sementes espalhadas e crescimento simultâneo, sempre pelo território mais leve"""
+    m, n_parts = len(problem), problem.n_parts
+    labels = problem.component_labels()
+    # Sementes por pedaço conexo da área proporcionais ao peso dele (maiores restos), no máximo
+    # uma por município do pedaço; pedaços sem semente entram depois no território mais leve
+    weights = np.bincount(labels, weights=problem.shares.mean(axis=1))
+    quota = n_parts * weights / weights.sum()
+    sizes = np.bincount(labels)
+    allocation = np.minimum(np.floor(quota).astype(np.int64), sizes)
+    while allocation.sum() < n_parts:
+        # O excedente dos pedaços cheios vai aos que ainda têm espaço, pelos maiores restos
+        open_pieces = np.flatnonzero(allocation < sizes)
+        remainders = quota[open_pieces] - allocation[open_pieces]
+        order = open_pieces[np.lexsort((open_pieces, -remainders))]
+        allocation[order[:n_parts - allocation.sum()]] += 1
+
+    seeds = []
+    for component, count in enumerate(allocation.tolist()):
+        if not count:
+            continue
+        nodes = np.flatnonzero(labels == component)
+        chosen = [int(rng.choice(nodes))]
+        distance = problem.hop_distances(chosen)[nodes]
+        while len(chosen) < count:
+            # Mais distante das sementes já escolhidas no pedaço
+            chosen.append(int(rng.choice(nodes[distance == distance.max()])))
+            distance = np.minimum(distance, problem.hop_distances(chosen[-1:])[nodes])
+        seeds.extend(chosen)
+
+    assignment = np.full(m, -1, dtype=np.int64)
+    loads = np.zeros(n_parts)
+    frontiers = [set() for _ in range(n_parts)]
+    for part, seed in enumerate(seeds):
+        assignment[seed] = part
+        loads[part] += problem.shares[seed].sum()
+    for part, seed in enumerate(seeds):
+        frontiers[part].update(n for n in problem.neighbours(seed).tolist() if assignment[n] < 0)
+
+    while True:
+        open_parts = [part for part in range(n_parts) if frontiers[part]]
+        if not open_parts:
+            break
+        part = min(open_parts, key=lambda p: (loads[p], p))
+        node = int(rng.choice(sorted(frontiers[part])))
+        assignment[node] = part
+        loads[part] += problem.shares[node].sum()
+        for frontier in frontiers:
+            frontier.discard(node)
+        frontiers[part].update(n for n in problem.neighbours(node).tolist() if assignment[n] < 0)
+
+    # Pedaços da área sem semente vão para o território mais leve
+    for node in np.flatnonzero(assignment < 0).tolist():
+        part = int(np.argmin(loads))
+        assignment[node] = part
+        loads[part] += problem.shares[node].sum()
+    return assignment
+
+
+def local_search(problem, state, rng, deadline):
+    """Movimentos de fronteira que melhoram o objetivo; False se o prazo acabou antes de convergir"""
+    improved = True
+    while improved:
+        improved = False
+        for node in rng.permutation(len(problem)).tolist():
+            if time.monotonic() > deadline:
+                return False
+            source = state.assignment[node]
+            if state.sizes[source] <= 1:
+                continue
+            targets = np.unique(state.assignment[problem.neighbours(node)])
+            best_delta, best_target = -1e-12, None
+            for target in targets[targets != source].tolist():
+                delta = state.move_delta(node, source, target)
+                if delta < best_delta:
+                    best_delta, best_target = delta, target
+            if best_target is not None and state.stays_connected(node, source):
+                state.move(node, source, best_target)
+                improved = True
+    return True
+
+
+def solve(problem, seed, deadline):
+    """Uma tentativa: (objetivo, atribuição, completa)"""
+    rng = np.random.default_rng(seed)
+    state = PartitionState(problem, initial_partition(problem, rng))
+    complete = local_search(problem, state, rng, deadline)
+    return state.objective(), state.assignment, complete
+
+
+def _solve_task(args):
+    problem, seed, time_budget = args
+    return solve(problem, seed, time.monotonic() + time_budget)
+
+
+def optimize(problem, seed=0, restarts=8, workers=None, time_budget=10.0):
+    """Melhor de `restarts` tentativas (sementes seed, seed+1, ...) em um pool de processos"""
+    workers = max(1, min(restarts, workers or os.cpu_count() or 1))
+    tasks = [(problem, seed + attempt, time_budget) for attempt in range(restarts)]
+    if workers == 1:
+        results = [_solve_task(task) for task in tasks]
+    else:
+        # spawn: os processos não herdam threads/conexões do worker web
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(_solve_task, tasks))
+
+    # Menor objetivo; empate pela tentativa de menor índice (determinístico)
+    best = min(range(len(results)), key=lambda i: (results[i][0], i))
+    objective, assignment, _ = results[best]
+    return {
+        'objective': objective,
+        'assignment': assignment,
+        'attempt': best,
+        'complete': all(result[2] for result in results)
+    }